@@ -0,0 +1,9 @@
+"""
+Levant 后端基准测试工具。
+
+    python -m bench.serialization --scale 4          # 存档序列化微基准
+    python -m bench.worldgen --out saves/big.json    # 生成合成存档
+    python -m bench.mock_llm --port 18080            # 单独启动模拟大模型服务
+    python -m bench.scenarios --compare base.json    # 端到端场景压测并与基线对比
+    python -m bench.startup --runs 5                 # 冷启动耗时 (import / 端口就绪 / 各 SDK 首次导入)
+"""
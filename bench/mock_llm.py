@@ -0,0 +1,181 @@
+"""
+本地模拟大模型服务：兼容 OpenAI (/v1/chat/completions) 与 Anthropic (/v1/messages) 两种协议，
+支持流式输出，可配置首字延迟、每个分片的间隔、回复长度和错误率，用于离线压测 AI 接口。
+
+    python -m bench.mock_llm --port 18080 --latency 0.5 --tokens 200 --token-delay 0.01
+
+OpenAI 兼容：请求里 baseUrl 填 http://127.0.0.1:18080/v1
+Claude：设置环境变量 ANTHROPIC_BASE_URL=http://127.0.0.1:18080 (SDK 会自动读取)
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.2        # 首个分片 (或整个非流式回复) 前的等待秒数
+    token_delay: float = 0.0    # 流式输出时每个分片之间的间隔
+    tokens: int = 50            # 回复长度 (分片数，每个分片约 1 个 token)
+    jitter: float = 0.0         # 延迟的随机浮动比例，0.2 = ±20%
+    error_rate: float = 0.0     # 返回 429 的概率 (带 Retry-After)
+    retry_after: float = 0.5
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: MockConfig = MockConfig()
+    stats = {"requests": 0, "errors": 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    # --- 工具 ---
+    def _sleep(self, seconds: float):
+        if seconds > 0:
+            jitter = self.config.jitter
+            time.sleep(seconds * (1 + random.uniform(-jitter, jitter)) if jitter else seconds)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _write_sse(self, data: dict, event: str = ""):
+        head = f"event: {event}\n" if event else ""
+        self.wfile.write(f"{head}data: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _words(self):
+        return [f"w{i} " for i in range(self.config.tokens)]
+
+    # --- 路由 ---
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json(400, {"error": {"message": "invalid json"}})
+
+        with self.stats_lock:
+            self.stats["requests"] += 1
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            with self.stats_lock:
+                self.stats["errors"] += 1
+            return self._send_json(429, {"error": {"type": "rate_limit_error", "message": "mock rate limit"}},
+                                   {"Retry-After": str(self.config.retry_after)})
+
+        prompt_tokens = max(1, len(json.dumps(body.get("messages", ""))) // 4)
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            return self._openai(body, prompt_tokens)
+        if self.path.rstrip("/").endswith("/messages"):
+            return self._anthropic(body, prompt_tokens)
+        self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def _openai(self, body: dict, prompt_tokens: int):
+        model, words = body.get("model", "mock"), self._words()
+        cid, created = f"chatcmpl-{uuid.uuid4().hex[:12]}", int(time.time())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        self._sleep(self.config.latency)
+        if not body.get("stream"):
+            return self._send_json(200, {
+                "id": cid, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage})
+        self._start_sse()
+        for i, word in enumerate(words):
+            if i:
+                self._sleep(self.config.token_delay)
+            self._write_sse({"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                             "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]})
+        self._write_sse({"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        self._write_sse({"id": cid, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _anthropic(self, body: dict, prompt_tokens: int):
+        model, words = body.get("model", "mock"), self._words()
+        mid = f"msg_{uuid.uuid4().hex[:12]}"
+        self._sleep(self.config.latency)
+        if not body.get("stream"):
+            return self._send_json(200, {
+                "id": mid, "type": "message", "role": "assistant", "model": model,
+                "content": [{"type": "text", "text": "".join(words)}],
+                "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": prompt_tokens, "output_tokens": len(words)}})
+        self._start_sse()
+        self._write_sse({"type": "message_start", "message": {
+            "id": mid, "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": 1}}}, "message_start")
+        self._write_sse({"type": "content_block_start", "index": 0,
+                         "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for i, word in enumerate(words):
+            if i:
+                self._sleep(self.config.token_delay)
+            self._write_sse({"type": "content_block_delta", "index": 0,
+                             "delta": {"type": "text_delta", "text": word}}, "content_block_delta")
+        self._write_sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self._write_sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                         "usage": {"output_tokens": len(words)}}, "message_delta")
+        self._write_sse({"type": "message_stop"}, "message_stop")
+
+
+def start_mock_llm(port: int = 0, config: MockConfig = None):
+    """在后台线程启动模拟服务，返回 (server, base_url)；port=0 时自动选择空闲端口"""
+    handler = type("MockHandler", (_Handler,), {
+        "config": config or MockConfig(), "stats": {"requests": 0, "errors": 0}, "stats_lock": threading.Lock()})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def add_config_args(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--token-delay", type=float, default=defaults.token_delay)
+    parser.add_argument("--tokens", type=int, default=defaults.tokens)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(latency=args.latency, token_delay=args.token_delay, tokens=args.tokens,
+                      jitter=args.jitter, error_rate=args.error_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18080)
+    add_config_args(parser)
+    args = parser.parse_args()
+    server, url = start_mock_llm(args.port, config_from_args(args))
+    print(f"Mock LLM listening on {url}  (OpenAI: {url}/v1, Anthropic: ANTHROPIC_BASE_URL={url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,312 @@
+"""
+端到端场景基准：在本进程内启动后端 (uvicorn) 和模拟大模型服务 (bench.mock_llm)，
+并发压测读档、存档、附件解析、AI 生成，输出吞吐量与延迟分位数。全程不需要外网。
+
+    python -m bench.scenarios                                   # 全部场景
+    python -m bench.scenarios --only get_state,save_state --concurrency 8 --scale 4
+    python -m bench.scenarios --storage sqlite
+    python -m bench.scenarios --save-baseline bench_baseline.json
+    python -m bench.scenarios --compare bench_baseline.json     # 与基线对比
+
+startup_import / startup_ready 在全新子进程里测冷启动 (见 bench.startup)，次数取 min(--requests, STARTUP_RUNS)。
+
+需要在仓库根目录运行 (页面等静态文件使用相对路径)。
+存档、blob、缓存目录在运行期间指向一个临时目录，结束后整个删除，不会碰到真实的 saves/ 与 blobs/。
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.mock_llm import add_config_args, config_from_args, start_mock_llm  # noqa: E402
+from bench.startup import measure_import, measure_ready  # noqa: E402
+from bench.worldgen import generate_world  # noqa: E402
+
+SAVE_NAME = "__bench__.json"
+ALL_SCENARIOS = ["get_state", "get_state_fields", "save_state", "attachments_cold", "attachments_warm",
+                 "ai_generate_openai", "ai_generate_claude", "ai_stream_openai", "startup_import", "startup_ready"]
+STARTUP_SCENARIOS = {"startup_import", "startup_ready"}
+STARTUP_RUNS = 5  # 每次都要起一个新进程，次数不宜多
+
+
+# --- 统计 ---
+def _percentile(sorted_samples: List[float], p: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    k = (len(sorted_samples) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_samples) - 1)
+    return sorted_samples[lo] + (sorted_samples[hi] - sorted_samples[lo]) * (k - lo)
+
+
+def run_load(name: str, fn: Callable[[int], None], requests: int, concurrency: int) -> dict:
+    """并发执行 fn(i) 共 requests 次，fn 抛异常视为失败"""
+    samples, errors = [], []
+    lock = threading.Lock()
+
+    def one(i: int):
+        start = time.perf_counter()
+        try:
+            fn(i)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            samples.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    samples.sort()
+    result = {
+        "scenario": name, "requests": requests, "concurrency": concurrency, "errors": len(errors),
+        "throughput": round(len(samples) / wall, 2) if wall else 0.0,
+        "p50_ms": round(_percentile(samples, 50) * 1000, 2),
+        "p90_ms": round(_percentile(samples, 90) * 1000, 2),
+        "p99_ms": round(_percentile(samples, 99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+    }
+    if errors:
+        result["first_error"] = errors[0][:200]
+    return result
+
+
+# --- 环境 ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_backend(app):
+    import uvicorn
+    port = _free_port()
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("Backend did not start")
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def make_pdf(pages: int, text: str) -> bytes:
+    """生成一个每页含一行文字的最小 PDF (免去对 PDF 写入库的依赖)"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for i in range(pages):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text} page {i}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{num} 0 obj\n{body}\nendobj\n".encode("latin-1"))
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1"))
+    for off in offsets:
+        out.write(f"{off:010d} 00000 n \n".encode("latin-1"))
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1"))
+    return out.getvalue()
+
+
+def make_docx(paragraphs: int, text: str) -> bytes:
+    from docx import Document
+    doc = Document()
+    for i in range(paragraphs):
+        doc.add_paragraph(f"{text} {i}")
+    out = io.BytesIO()
+    doc.save(out)
+    return out.getvalue()
+
+
+# --- 场景 ---
+def isolate_server_dirs(server, root: str, storage: str):
+    """把服务端的存档/blob/缓存目录换到 root 下，并按 storage 重建存储层"""
+    server.SAVES_DIR = os.path.join(root, "saves")
+    server.BLOBS_DIR = os.path.join(root, "blobs")
+    server.ATTACHMENT_CACHE_DIR = os.path.join(root, "cache", "attachments")
+    for d in (server.SAVES_DIR, server.BLOBS_DIR):
+        os.makedirs(d, exist_ok=True)
+    server.SQLITE_DB_PATH = os.path.join(server.SAVES_DIR, "levant.db")
+    server.save_locks = server.SaveLocks(os.path.join(server.SAVES_DIR, ".locks"))
+    server.STORAGE_BACKEND = storage
+    server.save_storage = server.create_storage()
+    server.save_catalog = server.SaveCatalog(os.path.join(root, "cache"), thumbnailer=server.make_save_thumbnail,
+                                             lock=server.save_lock)
+
+
+def run(only: List[str], requests: int, concurrency: int, scale: int, storage: str, mock_config,
+        verbose: bool = False) -> List[dict]:
+    import base64
+    import logging
+    import httpx
+    import server
+
+    if not verbose:
+        # 服务端默认把每个 AI 请求的完整内容打到控制台，压测时只保留警告
+        logging.getLogger().setLevel(logging.WARNING)
+
+    data_root = tempfile.mkdtemp(prefix="levant-bench-")
+    isolate_server_dirs(server, data_root, storage)
+
+    mock, mock_url = start_mock_llm(0, mock_config)
+    # Claude SDK 未显式指定 base_url 时读取该环境变量
+    os.environ["ANTHROPIC_BASE_URL"] = mock_url
+    backend, base = start_backend(server.app)
+    client = httpx.Client(base_url=base, timeout=300, limits=httpx.Limits(max_connections=concurrency * 2))
+
+    world = generate_world(factions=50 * scale, turns=200 * scale, regions=100 * scale, lore=300 * scale)
+    world_body = json.dumps(world, ensure_ascii=False).encode("utf-8")
+    print(f"backend {base}, mock LLM {mock_url}, storage {storage}, save {len(world_body) / 1e6:.2f} MB")
+    _print_header()
+
+    def check(resp):
+        if resp.status_code >= 400:
+            raise RuntimeError(f"HTTP {resp.status_code}: {resp.text[:200]}")
+        return resp
+
+    def save_state(_):
+        check(client.post("/api/state", params={"filename": SAVE_NAME}, content=world_body,
+                          headers={"Content-Type": "application/json"}))
+
+    def ai_request(provider: str) -> dict:
+        return {"provider": provider, "model": f"mock-{provider}", "apiKey": "bench",
+                "baseUrl": f"{mock_url}/v1" if provider != "claude" else "",
+                "systemPrompt": "You are a game master.", "context": "=== [WORLD] ===\n" + "lore " * 500,
+                "userPrompt": "Advance one turn."}
+
+    def attachment_set(tag: str) -> list:
+        text = f"bench attachment {tag} " * 200
+        return [
+            {"name": f"{tag}.txt", "type": "text/plain", "data": base64.b64encode(text.encode()).decode()},
+            {"name": f"{tag}.pdf", "type": "application/pdf",
+             "data": base64.b64encode(make_pdf(20, f"bench {tag}")).decode()},
+            {"name": f"{tag}.docx", "type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+             "data": base64.b64encode(make_docx(200, f"bench {tag}")).decode()},
+        ]
+
+    warm_attachments = attachment_set("warm")
+    cold_attachments: List[list] = []
+    scenarios: Dict[str, Callable[[int], None]] = {
+        "get_state": lambda i: check(client.get("/api/state", params={"filename": SAVE_NAME})),
+        "get_state_fields": lambda i: check(client.get("/api/state", params={"filename": SAVE_NAME,
+                                                                            "fields": "players,global_vars"})),
+        "save_state": save_state,
+        # 每次内容不同，缓存不命中，测的是解析本身
+        "attachments_cold": lambda i: server.process_attachments_smart(cold_attachments[i]),
+        "attachments_warm": lambda i: server.process_attachments_smart(warm_attachments),
+        "ai_generate_openai": lambda i: check(client.post("/api/ai/generate", json=ai_request("openai"))),
+        "ai_generate_claude": lambda i: check(client.post("/api/ai/generate", json=ai_request("claude"))),
+        "ai_stream_openai": lambda i: check(client.post("/api/ai/stream", json=ai_request("openai"))),
+        "startup_import": lambda i: measure_import(),
+        "startup_ready": lambda i: measure_ready(),
+    }
+
+    disk_cache = server.ATTACHMENT_DISK_CACHE
+    results = []
+    try:
+        save_state(0)
+        for name in only:
+            if name == "attachments_cold":
+                server.ATTACHMENT_DISK_CACHE = False  # 不把一次性内容写进磁盘缓存
+                cold_attachments[:] = [attachment_set(f"cold{i}-{time.time_ns()}") for i in range(requests)]
+            elif name == "attachments_warm":
+                server.process_attachments_smart(warm_attachments)
+            if name in STARTUP_SCENARIOS:
+                # 冷启动逐个串行测，避免多个进程互相抢 CPU
+                result = run_load(name, scenarios[name], min(requests, STARTUP_RUNS), 1)
+            else:
+                result = run_load(name, scenarios[name], requests, concurrency)
+            server.ATTACHMENT_DISK_CACHE = disk_cache
+            results.append(result)
+            _print_row(result)
+    finally:
+        server.ATTACHMENT_DISK_CACHE = disk_cache
+        client.close()
+        backend.should_exit = True
+        mock.shutdown()
+        server.save_catalog.flush()  # 否则退出时 (atexit) 还会写回已删除的临时目录
+        shutil.rmtree(data_root, ignore_errors=True)
+    return results
+
+
+# --- 输出 ---
+_COLUMNS = [("scenario", 20, "s"), ("requests", 9, "d"), ("errors", 7, "d"), ("throughput", 11, ".1f"),
+            ("p50_ms", 10, ".1f"), ("p90_ms", 10, ".1f"), ("p99_ms", 10, ".1f"), ("max_ms", 10, ".1f")]
+
+
+def _print_header():
+    print("".join(f"{name:<{w}}" if fmt == "s" else f"{name:>{w}}" for name, w, fmt in _COLUMNS))
+
+
+def _print_row(result: dict):
+    print("".join(f"{result[name]:<{w}{fmt}}" if fmt == "s" else f"{result[name]:>{w}{fmt}}"
+                  for name, w, fmt in _COLUMNS))
+    if result.get("first_error"):
+        print(f"  first error: {result['first_error']}")
+
+
+def compare(results: List[dict], baseline_path: str):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    print(f"\nvs baseline {baseline_path} (negative latency / positive throughput = better)")
+    print(f"{'scenario':<20}{'throughput':>12}{'p50':>10}{'p99':>10}")
+    for r in results:
+        b = baseline.get(r["scenario"])
+        if not b:
+            continue
+
+        def delta(key):
+            return f"{(r[key] - b[key]) / b[key] * 100:+.1f}%" if b[key] else "n/a"
+        print(f"{r['scenario']:<20}{delta('throughput'):>12}{delta('p50_ms'):>10}{delta('p99_ms'):>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=",".join(ALL_SCENARIOS), help="逗号分隔的场景名")
+    parser.add_argument("--requests", type=int, default=50, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--scale", type=int, default=1, help="合成存档规模倍数")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--verbose", action="store_true", help="保留服务端 INFO 日志")
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    selected = [s.strip() for s in args.only.split(",") if s.strip()]
+    unknown = [s for s in selected if s not in ALL_SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(ALL_SCENARIOS)})")
+
+    results = run(selected, args.requests, args.concurrency, args.scale, args.storage, config_from_args(args),
+                  args.verbose)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "args": vars(args), "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\nBaseline written to {args.save_baseline}")
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,76 @@
+"""
+存档序列化基准：对比 标准库 json + GameState 全量校验 (旧路径) 与 orjson + 信任已校验存档 (新路径)
+在读档、存档两个方向上的耗时。
+
+    python -m bench.serialization              # 默认规模 (约数 MB)
+    python -m bench.serialization --scale 4    # 放大 4 倍
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from bench.worldgen import generate_world  # noqa: E402
+
+
+def _timeit(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def run(scale: int = 1, repeat: int = 5):
+    world = generate_world(factions=50 * scale, turns=200 * scale, regions=100 * scale, lore=300 * scale)
+    # 真实存档中的遮罩已被抽到 blob 存储，这里只保留引用，测的是结构本身的开销
+    for layer in world["map_data"]["layers"]:
+        if isinstance(layer["data"], list):
+            for region in layer["data"]:
+                region["maskData"] = server.BLOB_URL_PREFIX + "0" * 64 + ".png"
+        else:
+            layer["data"] = server.BLOB_URL_PREFIX + "0" * 64 + ".png"
+
+    pretty = json.dumps(world, ensure_ascii=False, indent=2).encode("utf-8")
+    compact = server.json_dumps_bytes(world)
+    state = server.GameState.model_validate(world)
+
+    def load_legacy():
+        # 旧路径：json.load + response_model 校验 + 再序列化
+        data = json.loads(pretty)
+        server.GameState.model_validate(data).model_dump_json()
+
+    def load_fast():
+        data = server.json_loads(compact)
+        server.json_dumps_bytes(data)
+
+    def save_legacy():
+        json.dumps(state.model_dump(), ensure_ascii=False, indent=2)
+
+    def save_fast():
+        server.json_dumps_bytes(state.model_dump())
+
+    backend = "orjson" if server.orjson is not None else "json (orjson not installed)"
+    print(f"save size: pretty {len(pretty) / 1e6:.2f} MB, compact {len(compact) / 1e6:.2f} MB, backend: {backend}")
+    rows = [
+        ("load", _timeit(load_legacy, repeat), _timeit(load_fast, repeat)),
+        ("save", _timeit(save_legacy, repeat), _timeit(save_fast, repeat)),
+    ]
+    print(f"{'op':<6}{'legacy ms':>12}{'fast ms':>12}{'speedup':>10}")
+    for op, legacy, fast in rows:
+        print(f"{op:<6}{legacy:>12.1f}{fast:>12.1f}{legacy / fast:>9.1f}x")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.scale, args.repeat)
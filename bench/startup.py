@@ -0,0 +1,99 @@
+"""
+冷启动基准：每次在全新的子进程里测量
+  - import: `import server` 耗时 (模块加载 + 初始化)
+  - ready:  启动 uvicorn 到 GET /api/saves 首次返回 200 的耗时 (桌面版打开浏览器前用户等待的时间)
+  - 各个按需导入模块 (SDK / 解析库) 首次使用时的导入耗时
+
+    python -m bench.startup --runs 5
+    python -m bench.scenarios --only startup_import,startup_ready --save-baseline base.json
+
+需要在仓库根目录运行。
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_IMPORT_SNIPPET = """
+import json, time, warnings
+warnings.simplefilter("ignore")
+started = time.perf_counter()
+import server
+elapsed = time.perf_counter() - started
+lazy = {{}}
+if {probe_lazy}:
+    for name in ("openai", "anthropic", "genai", "pypdf", "docx"):
+        module = getattr(server, name, None)
+        if hasattr(module, "load"):
+            module.load()
+            lazy[name] = module.import_seconds
+print(json.dumps({{"import": elapsed, "lazy": lazy}}))
+"""
+
+_SERVE_SNIPPET = """
+import warnings
+warnings.simplefilter("ignore")
+import uvicorn, server
+server.LAZY_WARMUP = False
+uvicorn.run(server.app, host="127.0.0.1", port={port}, log_level="warning")
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import(probe_lazy: bool = False) -> dict:
+    """全新进程里 import server 的耗时 (秒)；probe_lazy 时顺带测各按需模块的导入耗时"""
+    out = subprocess.run([sys.executable, "-c", _IMPORT_SNIPPET.format(probe_lazy=probe_lazy)],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_ready(timeout: float = 60.0) -> float:
+    """从启动进程到 /api/saves 返回 200 的耗时 (秒)"""
+    port = _free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", _SERVE_SNIPPET.format(port=port)], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Server exited with code {proc.returncode}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/api/saves", timeout=1) as resp:
+                    if resp.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                pass
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("Server did not become ready")
+            time.sleep(0.01)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    imports = sorted(measure_import()["import"] for _ in range(args.runs))
+    readies = sorted(measure_ready() for _ in range(args.runs))
+    lazy = measure_import(probe_lazy=True)["lazy"]
+    print(f"import server   median {imports[len(imports) // 2] * 1000:8.1f} ms   min {imports[0] * 1000:8.1f} ms")
+    print(f"ready (HTTP)    median {readies[len(readies) // 2] * 1000:8.1f} ms   min {readies[0] * 1000:8.1f} ms")
+    for name, seconds in lazy.items():
+        print(f"  first use {name:<10} +{seconds * 1000:8.1f} ms")
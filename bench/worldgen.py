@@ -0,0 +1,104 @@
+"""
+合成世界生成器：按给定规模构造结构与真实存档一致的 GameState 文档 (dict)，
+用于在离线环境下复现性能测试。相同的 seed 得到相同的存档。
+
+    python -m bench.worldgen --factions 200 --turns 1000 --out saves/bench_big.json
+"""
+import argparse
+import base64
+import json
+import random
+from typing import Any, Dict
+
+
+def _mask_data_url(rng: random.Random, size: int) -> str:
+    # 遮罩在真实存档里是 PNG 的 data URL，这里用等长的随机字节模拟体积
+    return "data:image/png;base64," + base64.b64encode(rng.randbytes(size)).decode("ascii")
+
+
+def generate_world(factions: int = 50, fields: int = 12, turns: int = 200, events_per_turn: int = 6,
+                   impacts_per_event: int = 3, regions: int = 100, mask_bytes: int = 2048,
+                   lore: int = 300, seed: int = 42) -> Dict[str, Any]:
+    rng = random.Random(seed)
+
+    schema = [{"key": f"attr_{i}", "label": f"属性{i}", "type": "number" if i % 3 else "string",
+               "visibility": "editable", "formula": ""} for i in range(fields)]
+    rule_sets = [{"id": "default", "name": "通用实体 (Default)", "fields": schema}]
+
+    players = []
+    for i in range(factions):
+        players.append({
+            "id": f"f{i}", "parentId": "", "name": f"势力{i}", "logo": "fa-solid fa-users",
+            "isProtagonist": i == 0, "avatar": "", "avatarScale": 1.0, "avatarOffsetY": 0.0, "avatars": [],
+            "color": "#%06x" % rng.randrange(0xFFFFFF), "desc": "一个合成的势力。" * 5,
+            "schemaId": "default",
+            "stats": {f["key"]: (rng.randint(0, 1000) if f["type"] == "number" else f"值{rng.randint(0, 99)}")
+                      for f in schema},
+        })
+
+    timeline = []
+    for t in range(turns):
+        events = []
+        for _ in range(events_per_turn):
+            actor = f"f{rng.randrange(factions)}"
+            impacts = []
+            for _ in range(impacts_per_event):
+                target = rng.randrange(factions)
+                key = f"attr_{rng.randrange(fields)}"
+                old = rng.randint(0, 1000)
+                impacts.append({"type": "STAT_CHANGE", "targetId": f"f{target}", "targetName": f"势力{target}",
+                                "attrKey": key, "attrLabel": key, "oldValue": old, "newValue": old + rng.randint(-50, 50),
+                                "data": {}})
+            events.append({"factionId": actor, "avatarTag": "", "timeStart": f"Year {1000 + t}",
+                           "timeEnd": f"Year {1000 + t}", "summary": f"第{t}回合的事件",
+                           "content": "事件经过的详细描述。" * 10, "impacts": impacts, "isOpen": False, "options": []})
+        timeline.append({"id": t + 1, "timeRange": f"Year {1000 + t}", "events": events})
+
+    region_list = []
+    for i in range(regions):
+        x, y = rng.randrange(4000), rng.randrange(3000)
+        w, h = rng.randint(20, 300), rng.randint(20, 300)
+        region_list.append({"id": f"r{i}", "x": x, "y": y, "w": w, "h": h, "centerX": x + w / 2, "centerY": y + h / 2,
+                            "maskData": _mask_data_url(rng, mask_bytes), "type": "territory", "name": f"地块{i}",
+                            "ownerId": f"f{rng.randrange(factions)}", "schemaId": "", "stats": {}, "icon": "", "color": ""})
+
+    layers = [
+        {"id": "layer_bg", "type": "image", "name": "底图", "visible": True, "opacity": 1.0,
+         "data": _mask_data_url(rng, mask_bytes * 8)},
+        {"id": "layer_regions", "type": "region", "name": "地块", "visible": True, "opacity": 1.0, "data": region_list},
+        {"id": "layer_markers", "type": "marker", "name": "标记", "visible": True, "opacity": 1.0, "data": []},
+    ]
+
+    lorebook = [{"keys": f"关键词{i}, keyword{i}", "content": "资料条目的内容。" * 8,
+                 "mode": "on" if i % 50 == 0 else "auto"} for i in range(lore)]
+
+    return {
+        "players": players,
+        "rule_sets": rule_sets,
+        "global_vars": [{"key": "year", "value": 1000 + turns, "type": "number", "visibility": "editable", "formula": ""}],
+        "lorebook": lorebook,
+        "timeline": timeline,
+        "stat_schema": [],
+        "map_data": {"layers": layers, "activeLayerId": "layer_regions", "image": "", "pins": [], "regions": []},
+        "currentTurnPending": [],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--factions", type=int, default=50)
+    parser.add_argument("--fields", type=int, default=12)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--events-per-turn", type=int, default=6)
+    parser.add_argument("--impacts-per-event", type=int, default=3)
+    parser.add_argument("--regions", type=int, default=100)
+    parser.add_argument("--mask-bytes", type=int, default=2048)
+    parser.add_argument("--lore", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", required=True, help="输出的存档路径 (.json)")
+    args = parser.parse_args()
+    world = generate_world(args.factions, args.fields, args.turns, args.events_per_turn, args.impacts_per_event,
+                           args.regions, args.mask_bytes, args.lore, args.seed)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(world, f, ensure_ascii=False)
+    print(f"Wrote {args.out} ({len(world['players'])} factions, {len(world['timeline'])} turns)")
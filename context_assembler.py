@@ -0,0 +1,226 @@
+"""
+按 Token 预算装配推演上下文：
+给资料条目、实体、历史回合打相关度分，按分数贪心装入预算，
+放不下的历史回合先降级为"仅摘要"，仍放不下才丢弃，并报告取舍结果。
+
+输出格式与前端 finalContextPreview 的各段落保持一致。
+"""
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional
+
+from lore_index import LoreIndex
+
+try:
+    import tiktoken  # 可选依赖：有则对 OpenAI 系模型精确计数
+except ImportError:
+    tiktoken = None
+
+_WORD_RE = re.compile(r"[a-z0-9_]+")
+_CJK_RE = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+# 无分词器时的估算系数：(每个 CJK 字符的 token 数, 其余字符每 token 的字符数)
+_TOKEN_RATIOS = {
+    "claude": (1.3, 3.5),
+    "gemini": (1.0, 4.0),
+    "default": (1.1, 4.0),
+}
+
+_encodings: Dict[str, Any] = {}
+
+
+def _encoding_for(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text: str, provider: str = "", model: str = "") -> int:
+    if not text:
+        return 0
+    provider = (provider or "").lower()
+    if provider not in ("gemini", "claude"):
+        enc = _encoding_for(model or "gpt-4o")
+        if enc is not None:
+            return len(enc.encode(text, disallowed_special=()))
+    cjk_ratio, chars_per_token = _TOKEN_RATIOS.get(provider, _TOKEN_RATIOS["default"])
+    cjk = len(_CJK_RE.findall(text))
+    return int(math.ceil(cjk * cjk_ratio + (len(text) - cjk) / chars_per_token))
+
+
+def _terms(text: str) -> set:
+    """英文按单词、中日韩按相邻二字切分的检索词集合"""
+    text = (text or "").lower()
+    terms = set(_WORD_RE.findall(text))
+    chars = _CJK_RE.findall(text)
+    terms.update(a + b for a, b in zip(chars, chars[1:]))
+    return terms
+
+
+def _overlap(query_terms: set, text: str) -> float:
+    if not query_terms:
+        return 0.0
+    hits = len(query_terms & _terms(text))
+    return hits / math.sqrt(len(query_terms))
+
+
+def _format_attr(val, visibility: str, type_: str) -> Optional[str]:
+    # 与前端 formatContextAttr 一致
+    if visibility == "hidden":
+        return None
+    meta = ["Type:Number" if type_ == "number" else "Type:String"]
+    if visibility == "readonly":
+        meta.append("ReadOnly/Auto-Calc")
+    return f"{val} <{', '.join(meta)}>"
+
+
+def _render_faction(p: dict, rule_sets: Dict[str, dict]) -> str:
+    schema = rule_sets.get(p.get("schemaId", ""))
+    stats = p.get("stats", {}) or {}
+    if schema:
+        visible = {}
+        for f in schema.get("fields", []):
+            val = stats.get(f.get("key"), "-")
+            formatted = _format_attr(val, f.get("visibility") or "editable", f.get("type", "string"))
+            if formatted is not None:
+                visible[f.get("key")] = formatted
+    else:
+        visible = stats
+    return f"ID:{p.get('id')} | {p.get('name')}\n  Desc: {p.get('desc', '')}\n  Stats: {json.dumps(visible, ensure_ascii=False)}"
+
+
+def _render_turn(turn: dict, deep: bool) -> str:
+    out = f"[Turn {turn.get('id')}] {turn.get('timeRange', '')}\n"
+    for e in turn.get("events", []):
+        out += f" • {e.get('summary', '')} (Actor: {e.get('factionId', '')})\n"
+        if deep:
+            if e.get("content"):
+                out += f"   Details: {e['content']}\n"
+            impacts = e.get("impacts") or []
+            if impacts:
+                parts = [f"{i.get('targetName')}.{i.get('attrLabel')}: {i.get('oldValue')}->{i.get('newValue')}" for i in impacts]
+                out += f"   Impacts: {'; '.join(parts)}\n"
+    return out
+
+
+class _Item:
+    __slots__ = ("kind", "ref", "label", "score", "renders", "chosen", "tokens", "order")
+
+    def __init__(self, kind, ref, label, score, renders, order):
+        self.kind = kind
+        self.ref = ref
+        self.label = label
+        self.score = score
+        self.renders = renders  # [(形态, 文本)]，按优先级排列，后面的是降级形态
+        self.chosen = None
+        self.tokens = 0
+        self.order = order
+
+
+def assemble_context(state: dict, query: str, budget: int, provider: str = "", model: str = "",
+                     reserved_text: str = "", deep_turns: int = 3, lore_index: LoreIndex = None) -> dict:
+    """
+    state: 存档文档 (dict)；query: 本次推演指令；budget: 总 token 预算
+    reserved_text: 预先占用预算的固定文本 (如系统提示词)
+    """
+    query_terms = _terms(query)
+    query_lower = (query or "").lower()
+    rule_sets = {r.get("id"): r for r in state.get("rule_sets", [])}
+    timeline = state.get("timeline", [])
+    items: List[_Item] = []
+
+    # --- 资料条目：常驻 > 关键词触发 > 文本相关 ---
+    lorebook = state.get("lorebook", [])
+    if lore_index is None:
+        lore_index = LoreIndex()
+    lore_index.update(lorebook)
+    triggered = set(lore_index.match(query))
+    for idx, entry in enumerate(lorebook):
+        mode = entry.get("mode", "auto")
+        if mode == "off":
+            continue
+        relevance = _overlap(query_terms, entry.get("keys", "") + " " + entry.get("content", ""))
+        if mode == "on":
+            score = 1000 + relevance
+        elif idx in triggered:
+            score = 500 + relevance
+        elif relevance > 0:
+            score = relevance
+        else:
+            continue
+        text = f"> [{entry.get('keys', '')}]: {entry.get('content', '')}"
+        items.append(_Item("lore", idx, entry.get("keys", ""), score, [("full", text)], idx))
+
+    # --- 实体：被点名 > 主角 > 近期活跃 ---
+    recent_activity: Dict[str, int] = {}
+    for turn in timeline[-10:]:
+        for e in turn.get("events", []):
+            recent_activity[e.get("factionId", "")] = recent_activity.get(e.get("factionId", ""), 0) + 1
+            for imp in e.get("impacts", []) or []:
+                recent_activity[imp.get("targetId", "")] = recent_activity.get(imp.get("targetId", ""), 0) + 1
+    for idx, p in enumerate(state.get("players", [])):
+        name = (p.get("name") or "").lower()
+        score = 0.0
+        if name and name in query_lower:
+            score += 500
+        if p.get("isProtagonist"):
+            score += 200
+        score += 10 * recent_activity.get(p.get("id"), 0)
+        score += _overlap(query_terms, p.get("desc", ""))
+        items.append(_Item("players", p.get("id"), p.get("name"), score, [("full", _render_faction(p, rule_sets))], idx))
+
+    # --- 历史回合：越近越重要；近期给详细形态，放不下时降级为摘要 ---
+    total = len(timeline)
+    for idx, turn in enumerate(timeline):
+        age = total - 1 - idx
+        text_blob = " ".join(e.get("summary", "") + " " + e.get("content", "") for e in turn.get("events", []))
+        score = 100 * (0.85 ** age) + 5 * _overlap(query_terms, text_blob)
+        renders = [("deep", _render_turn(turn, True)), ("shallow", _render_turn(turn, False))] if age < deep_turns \
+            else [("shallow", _render_turn(turn, False))]
+        items.append(_Item("history", turn.get("id"), turn.get("timeRange"), score, renders, idx))
+
+    # --- 贪心装箱 ---
+    reserved = count_tokens(reserved_text, provider, model)
+    remaining = budget - reserved
+    included, dropped = [], []
+    for item in sorted(items, key=lambda it: -it.score):
+        for form, text in item.renders:
+            tokens = count_tokens(text, provider, model) + 1
+            if tokens <= remaining:
+                item.chosen, item.tokens = (form, text), tokens
+                remaining -= tokens
+                break
+        (included if item.chosen else dropped).append(item)
+
+    # --- 按固定段落顺序输出 ---
+    sections = []
+    lore = sorted((i for i in included if i.kind == "lore"), key=lambda i: i.order)
+    if lore:
+        sections.append("=== [WORLD: LORE] ===\n" + "\n".join(i.chosen[1] for i in lore) + "\n")
+    players = sorted((i for i in included if i.kind == "players"), key=lambda i: i.order)
+    if players:
+        sections.append("=== [WORLD: ENTITIES] ===\n" + "\n\n".join(i.chosen[1] for i in players) + "\n")
+    history = sorted((i for i in included if i.kind == "history"), key=lambda i: i.order)
+    if history:
+        sections.append("=== [HISTORY MEMORY] ===\n" + "\n".join(i.chosen[1] for i in history))
+    context = "\n".join(sections)
+
+    def report(item: _Item) -> dict:
+        return {"type": item.kind, "ref": item.ref, "label": item.label, "score": round(item.score, 3),
+                "form": item.chosen[0] if item.chosen else None, "tokens": item.tokens}
+
+    return {
+        "context": context,
+        "tokens": reserved + count_tokens(context, provider, model),
+        "budget": budget,
+        "reserved": reserved,
+        "tokenizer": "tiktoken" if (tiktoken is not None and (provider or "").lower() not in ("gemini", "claude")) else "estimate",
+        "included": [report(i) for i in included],
+        "dropped": [report(i) for i in dropped],
+    }
@@ -0,0 +1,1194 @@
+"""
+服务端公式引擎：GlobalVar.formula / StatSchema.formula 的增量计算。
+
+公式语法是前端 recalculateState() 所用 JS 表达式的子集 (公式积木生成的全部写法)：
+数字/字符串、+ - * / %、比较、&& || ??、!、三元、属性/下标访问与 ?.、
+箭头函数 (用于 find/filter/reduce)、Math.*、parseFloat 等。
+公式只解析一次，编译成 Python 闭包；求值时只能读取存档中的数据与白名单函数，无法触达 Python 对象。
+
+依赖关系：
+- self.stats['k']、globals['k']、turn
+- ctx.players.find(p => p.id === 'x')?.stats['k']
+- utils.sumRegionStat(owner, 'k')            (按归属聚合地块属性)
+- map.regions.reduce((s, r) => s + r.stats['k'], 0)   (全图聚合)
+识别不了的写法 (直接遍历 players 等) 视为"依赖一切"，任何改动都会重算。
+公式之间构成 DAG，按拓扑序计算；成环的公式报告出来并跳过。
+"""
+import heapq
+import math
+import random
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+MAX_FORMULA_LENGTH = 4000
+TARGET_KEYS = ("global_vars", "players", "map_data")  # 公式结果会写入的顶层字段
+
+
+class FormulaError(Exception):
+    pass
+
+
+# --- 词法 ---
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<name>[^\W\d][\w$]*|\$[\w$]*)
+  | (?P<op>===|!==|\?\.|\?\?|==|!=|<=|>=|&&|\|\||=>|[-+*/%<>!?:.,()\[\]])
+""", re.VERBOSE | re.UNICODE)
+
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0"}
+
+
+def _unescape(body: str) -> str:
+    return re.sub(r"\\(.)", lambda m: _ESCAPES.get(m.group(1), m.group(1)), body)
+
+
+def tokenize(src: str) -> List[Tuple[str, Any]]:
+    tokens, pos = [], 0
+    while pos < len(src):
+        m = _TOKEN_RE.match(src, pos)
+        if not m:
+            raise FormulaError(f"Unexpected character {src[pos]!r} at {pos}")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "ws":
+            continue
+        text = m.group(kind)
+        if kind == "num":
+            tokens.append(("num", float(text)))
+        elif kind == "str":
+            tokens.append(("str", _unescape(text[1:-1])))
+        else:
+            tokens.append((kind, text))
+    tokens.append(("end", None))
+    return tokens
+
+
+# --- 语法 (Pratt 解析器) ---
+# AST 为元组：("num", v) ("str", s) ("lit", v) ("name", id) ("member", obj, prop, optional)
+# ("call", callee, args, optional) ("unary", op, x) ("bin", op, a, b) ("cond", c, a, b) ("arrow", params, body)
+
+_BINARY = {
+    "??": 3, "||": 3, "&&": 4,
+    "==": 7, "!=": 7, "===": 7, "!==": 7,
+    "<": 8, ">": 8, "<=": 8, ">=": 8,
+    "+": 10, "-": 10, "*": 11, "/": 11, "%": 11,
+}
+_LITERALS = {"true": True, "false": False, "null": None, "undefined": None,
+             "NaN": math.nan, "Infinity": math.inf}
+
+
+class _Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def expect(self, text):
+        tok = self.next()
+        if tok[1] != text or tok[0] != "op":
+            raise FormulaError(f"Expected {text!r}, got {tok[1]!r}")
+
+    def parse(self):
+        node = self.expression()
+        if self.peek()[0] != "end":
+            raise FormulaError(f"Unexpected token {self.peek()[1]!r}")
+        return node
+
+    def expression(self, min_bp=0):
+        node = self.unary()
+        while True:
+            kind, text = self.peek()
+            if kind != "op":
+                break
+            if text == "?" and min_bp <= 2:
+                self.next()
+                then = self.expression(0)
+                self.expect(":")
+                node = ("cond", node, then, self.expression(2))
+                continue
+            bp = _BINARY.get(text)
+            if bp is None or bp <= min_bp:
+                break
+            self.next()
+            node = ("bin", text, node, self.expression(bp))
+        return node
+
+    def unary(self):
+        kind, text = self.peek()
+        if kind == "op" and text in ("!", "-", "+"):
+            self.next()
+            return ("unary", text, self.unary())
+        return self.postfix(self.primary())
+
+    def _arrow_params(self):
+        """当前位置若是箭头函数的参数表，返回参数名列表 (不消耗 token)"""
+        kind, text = self.peek()
+        if kind == "name" and self.peek(1) == ("op", "=>"):
+            return [text], 1
+        if (kind, text) != ("op", "("):
+            return None, 0
+        params, i = [], 1
+        while True:
+            k, t = self.peek(i)
+            if (k, t) == ("op", ")") and not params:
+                break
+            if k != "name":
+                return None, 0
+            params.append(t)
+            i += 1
+            k, t = self.peek(i)
+            if (k, t) == ("op", ","):
+                i += 1
+                continue
+            break
+        if self.peek(i) != ("op", ")") or self.peek(i + 1) != ("op", "=>"):
+            return None, 0
+        return params, i + 1
+
+    def primary(self):
+        params, consumed = self._arrow_params()
+        if params is not None:
+            self.pos += consumed
+            self.expect("=>")
+            return ("arrow", tuple(params), self.expression(2))
+
+        kind, text = self.next()
+        if kind == "num":
+            return ("num", text)
+        if kind == "str":
+            return ("str", text)
+        if kind == "name":
+            if text in _LITERALS:
+                return ("lit", _LITERALS[text])
+            return ("name", text)
+        if (kind, text) == ("op", "("):
+            node = self.expression()
+            self.expect(")")
+            return node
+        raise FormulaError(f"Unexpected token {text!r}")
+
+    def postfix(self, node):
+        while True:
+            kind, text = self.peek()
+            if kind != "op" or text not in (".", "?.", "[", "("):
+                return node
+            self.next()
+            optional = text == "?."
+            if optional:
+                # a?.b / a?.[k] / a?.(x)
+                kind, text = self.peek()
+                if kind == "op" and text in ("[", "("):
+                    self.next()
+            if text == "[":
+                prop = self.expression()
+                self.expect("]")
+                node = ("member", node, prop, optional)
+            elif text == "(":
+                node = ("call", node, self.arguments(), optional)
+            else:
+                k, name = self.next()
+                if k != "name":
+                    raise FormulaError(f"Expected property name, got {name!r}")
+                node = ("member", node, ("str", name), optional)
+
+    def arguments(self):
+        args = []
+        if self.peek() == ("op", ")"):
+            self.next()
+            return args
+        while True:
+            args.append(self.expression())
+            if self.peek() == ("op", ","):
+                self.next()
+                continue
+            self.expect(")")
+            return args
+
+
+_ast_cache: Dict[str, tuple] = {}
+
+
+def parse_formula(src: str) -> tuple:
+    src = (src or "").strip()
+    if len(src) > MAX_FORMULA_LENGTH:
+        raise FormulaError("Formula too long")
+    node = _ast_cache.get(src)
+    if node is None:
+        node = _Parser(tokenize(src)).parse()
+        if len(_ast_cache) > 4096:
+            _ast_cache.clear()
+            _compiled_cache.clear()
+        _ast_cache[src] = node
+    return node
+
+
+# --- JS 语义的运行时辅助 ---
+
+class _JSError(Exception):
+    pass
+
+
+class _ShortCircuit(Exception):
+    pass
+
+
+def to_number(v) -> float:
+    if isinstance(v, bool):
+        return 1.0 if v else 0.0
+    if isinstance(v, (int, float)):
+        return float(v)
+    if v is None:
+        return math.nan
+    if isinstance(v, str):
+        s = v.strip()
+        if s == "":
+            return 0.0
+        try:
+            return float(s)
+        except ValueError:
+            return math.nan
+    return math.nan
+
+
+def to_str(v) -> str:
+    if v is None:
+        return "undefined"
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, float):
+        if math.isnan(v):
+            return "NaN"
+        if v.is_integer() and abs(v) < 1e21:
+            return str(int(v))
+    if isinstance(v, list):
+        return ",".join("" if x is None else to_str(x) for x in v)
+    if isinstance(v, dict):
+        return "[object Object]"
+    return str(v)
+
+
+def truthy(v) -> bool:
+    if isinstance(v, float) and math.isnan(v):
+        return False
+    return bool(v) if not isinstance(v, (dict, list)) else True
+
+
+def parse_float(v) -> float:
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return float(v)
+    m = re.match(r"\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?|[+-]?Infinity)", to_str(v))
+    return float(m.group(1).replace("Infinity", "inf")) if m else math.nan
+
+
+def parse_int(v, base=None) -> float:
+    n = parse_float(v)
+    return math.nan if math.isnan(n) or math.isinf(n) else float(int(n))
+
+
+def _is_num(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _loose_eq(a, b) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    if type(a) is type(b) or (_is_num(a) and _is_num(b)):
+        return a == b
+    if isinstance(a, (dict, list)) or isinstance(b, (dict, list)):
+        return a is b
+    return to_number(a) == to_number(b)
+
+
+def _strict_eq(a, b) -> bool:
+    if _is_num(a) and _is_num(b):
+        return a == b
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, (dict, list)):
+        return a is b
+    return a == b
+
+
+def _compare(op, a, b) -> bool:
+    if isinstance(a, str) and isinstance(b, str):
+        x, y = a, b
+    else:
+        x, y = to_number(a), to_number(b)
+        if math.isnan(x) or math.isnan(y):
+            return False
+    return {"<": x < y, ">": x > y, "<=": x <= y, ">=": x >= y}[op]
+
+
+def _divide(a, b):
+    x, y = to_number(a), to_number(b)
+    if y == 0:
+        if x == 0 or math.isnan(x):
+            return math.nan
+        return math.copysign(math.inf, x) * math.copysign(1, y)
+    return x / y
+
+
+def _modulo(a, b):
+    x, y = to_number(a), to_number(b)
+    if y == 0 or math.isinf(x) or math.isnan(x) or math.isnan(y):
+        return math.nan
+    return math.fmod(x, y)
+
+
+def _add(a, b):
+    if isinstance(a, (str, dict, list)) or isinstance(b, (str, dict, list)):
+        return to_str(a) + to_str(b)
+    return to_number(a) + to_number(b)
+
+
+def _mul(a, b):
+    x, y = to_number(a), to_number(b)
+    try:
+        return x * y
+    except OverflowError:
+        return math.inf
+
+
+_BIN_FUNCS: Dict[str, Callable] = {
+    "+": _add,
+    "-": lambda a, b: to_number(a) - to_number(b),
+    "*": _mul,
+    "/": _divide,
+    "%": _modulo,
+    "==": _loose_eq,
+    "!=": lambda a, b: not _loose_eq(a, b),
+    "===": _strict_eq,
+    "!==": lambda a, b: not _strict_eq(a, b),
+}
+
+
+def js_round(x) -> float:
+    x = to_number(x)
+    if math.isnan(x) or math.isinf(x):
+        return x
+    return float(math.floor(x + 0.5))
+
+
+def _math_fn(fn):
+    def wrapper(*args):
+        try:
+            return float(fn(*[to_number(a) for a in args]))
+        except (ValueError, OverflowError):
+            return math.nan
+    return wrapper
+
+
+def _js_max(*args):
+    nums = [to_number(a) for a in args]
+    return math.nan if any(math.isnan(n) for n in nums) else max(nums, default=-math.inf)
+
+
+def _js_min(*args):
+    nums = [to_number(a) for a in args]
+    return math.nan if any(math.isnan(n) for n in nums) else min(nums, default=math.inf)
+
+
+MATH = {
+    "max": _js_max, "min": _js_min, "round": js_round,
+    "floor": _math_fn(math.floor), "ceil": _math_fn(math.ceil), "abs": _math_fn(abs),
+    "sqrt": _math_fn(math.sqrt), "pow": _math_fn(math.pow), "log": _math_fn(math.log),
+    "exp": _math_fn(math.exp), "trunc": _math_fn(math.trunc),
+    "sign": lambda x: math.nan if math.isnan(to_number(x)) else float((to_number(x) > 0) - (to_number(x) < 0)),
+    "random": lambda: random.random(),
+    "PI": math.pi, "E": math.e,
+}
+
+BUILTINS = {
+    "Math": MATH,
+    "parseFloat": parse_float,
+    "parseInt": parse_int,
+    "Number": to_number,
+    "String": to_str,
+    "isNaN": lambda v: math.isnan(to_number(v)),
+    "isFinite": lambda v: math.isfinite(to_number(v)),
+}
+
+
+def _call(fn, *args):
+    if not callable(fn):
+        raise _JSError("not a function")
+    return fn(*args)
+
+
+def _list_method(items: list, name: str):
+    if name == "length":
+        return float(len(items))
+    if name == "find":
+        return lambda f: next((x for i, x in enumerate(items) if truthy(_call(f, x, float(i)))), None)
+    if name == "filter":
+        return lambda f: [x for i, x in enumerate(items) if truthy(_call(f, x, float(i)))]
+    if name == "map":
+        return lambda f: [_call(f, x, float(i)) for i, x in enumerate(items)]
+    if name == "some":
+        return lambda f: any(truthy(_call(f, x, float(i))) for i, x in enumerate(items))
+    if name == "every":
+        return lambda f: all(truthy(_call(f, x, float(i))) for i, x in enumerate(items))
+    if name == "includes":
+        return lambda v: any(_strict_eq(x, v) for x in items)
+    if name == "join":
+        return lambda sep=",": to_str(sep).join("" if x is None else to_str(x) for x in items)
+
+    if name == "reduce":
+        def reduce(f, *init):
+            if init:
+                acc, start = init[0], 0
+            elif items:
+                acc, start = items[0], 1
+            else:
+                raise _JSError("Reduce of empty array with no initial value")
+            for i in range(start, len(items)):
+                acc = _call(f, acc, items[i], float(i))
+            return acc
+        return reduce
+    return None
+
+
+def js_get(obj, key):
+    """只允许读取 JSON 数据 (dict/list/str) 与白名单对象，无法访问 Python 属性"""
+    if obj is None:
+        raise _JSError(f"Cannot read properties of undefined (reading '{to_str(key)}')")
+    if isinstance(obj, dict):
+        return obj.get(key if isinstance(key, str) else to_str(key))
+    if isinstance(obj, list):
+        if _is_num(key) and float(key).is_integer():
+            i = int(key)
+            return obj[i] if 0 <= i < len(obj) else None
+        if isinstance(key, str):
+            if key.isdigit():
+                i = int(key)
+                return obj[i] if i < len(obj) else None
+            return _list_method(obj, key)
+        return None
+    if isinstance(obj, str):
+        if key == "length":
+            return float(len(obj))
+        if key == "includes":
+            return lambda s: to_str(s) in obj
+        if _is_num(key) and float(key).is_integer() and 0 <= int(key) < len(obj):
+            return obj[int(key)]
+        return None
+    if _is_num(obj) and key == "toFixed":
+        return lambda digits=0: f"{obj:.{_fixed_digits(digits)}f}"
+    return None
+
+
+def _fixed_digits(digits) -> int:
+    """toFixed 的位数：与 JS 一样限制在 0..100 (NaN 当作 0)，避免超大精度拼出巨大的字符串"""
+    d = to_number(digits)
+    if math.isnan(d):
+        return 0
+    return int(min(max(d, 0), 100))
+
+
+# --- 编译为闭包 ---
+
+def _has_optional(node) -> bool:
+    while node[0] in ("member", "call"):
+        if node[3]:
+            return True
+        node = node[1]
+    return False
+
+
+def compile_formula(node) -> Callable[[dict], Any]:
+    kind = node[0]
+    if kind in ("num", "str", "lit"):
+        value = node[1]
+        return lambda env: value
+    if kind == "name":
+        name = node[1]
+
+        def lookup(env):
+            if name in env:
+                return env[name]
+            raise _JSError(f"{name} is not defined")
+        return lookup
+    if kind in ("member", "call"):
+        chain = _compile_chain(node)
+        if not _has_optional(node):
+            return chain
+
+        def guarded(env):
+            try:
+                return chain(env)
+            except _ShortCircuit:
+                return None
+        return guarded
+    if kind == "unary":
+        op, x = node[1], compile_formula(node[2])
+        if op == "!":
+            return lambda env: not truthy(x(env))
+        if op == "-":
+            return lambda env: -to_number(x(env))
+        return lambda env: to_number(x(env))
+    if kind == "bin":
+        op, a, b = node[1], compile_formula(node[2]), compile_formula(node[3])
+        if op == "&&":
+            return lambda env: (lambda l: b(env) if truthy(l) else l)(a(env))
+        if op == "||":
+            return lambda env: (lambda l: l if truthy(l) else b(env))(a(env))
+        if op == "??":
+            return lambda env: (lambda l: b(env) if l is None else l)(a(env))
+        if op in ("<", ">", "<=", ">="):
+            return lambda env: _compare(op, a(env), b(env))
+        fn = _BIN_FUNCS[op]
+        return lambda env: fn(a(env), b(env))
+    if kind == "cond":
+        c, t, f = (compile_formula(n) for n in node[1:])
+        return lambda env: t(env) if truthy(c(env)) else f(env)
+    if kind == "arrow":
+        params, body = node[1], compile_formula(node[2])
+
+        def make(env):
+            def fn(*args):
+                scope = dict(env)
+                for i, p in enumerate(params):
+                    scope[p] = args[i] if i < len(args) else None
+                return body(scope)
+            return fn
+        return make
+    raise FormulaError(f"Unsupported syntax: {kind}")
+
+
+def _compile_chain(node) -> Callable[[dict], Any]:
+    obj = node[1]
+    inner = _compile_chain(obj) if obj[0] in ("member", "call") else compile_formula(obj)
+    optional = node[3]
+    if node[0] == "member":
+        prop = compile_formula(node[2])
+
+        def get(env):
+            target = inner(env)
+            if target is None and optional:
+                raise _ShortCircuit()
+            return js_get(target, prop(env))
+        return get
+
+    args = [compile_formula(a) for a in node[2]]
+
+    def call(env):
+        fn = inner(env)
+        if fn is None and optional:
+            raise _ShortCircuit()
+        return _call(fn, *[a(env) for a in args])
+    return call
+
+
+# --- 依赖分析 ---
+
+WILDCARD = ("*",)
+_CTX_NAMES = {"globals", "players", "map", "turn", "utils"}
+
+
+def _const_key(node) -> Optional[str]:
+    if node[0] == "str":
+        return node[1]
+    if node[0] == "num":
+        return to_str(node[1])
+    return None
+
+
+def _is_ctx(node, name: str, shadowed: Set[str]) -> bool:
+    """name 或 ctx.name"""
+    if node[0] == "name":
+        return node[1] == name and name not in shadowed
+    return (node[0] == "member" and node[1] == ("name", "ctx") and "ctx" not in shadowed
+            and _const_key(node[2]) == name)
+
+
+def _member_of(node, base_pred, prop: str) -> bool:
+    return node[0] == "member" and _const_key(node[2]) == prop and base_pred(node[1])
+
+
+def analyze_dependencies(node, self_kind: str = "", self_id: str = "") -> Set[tuple]:
+    """返回依赖键集合；含 WILDCARD 表示无法静态确定"""
+    deps: Set[tuple] = set()
+    _walk(node, self_kind, self_id, frozenset(), deps)
+    return deps
+
+
+def _walk(node, sk, sid, shadowed, deps):
+    kind = node[0]
+
+    def is_self(n):
+        return n == ("name", "self") and "self" not in shadowed
+
+    if kind == "member":
+        obj, key = node[1], _const_key(node[2])
+        # self.stats['k']
+        if _member_of(obj, is_self, "stats") and key is not None and sk:
+            deps.add((sk, sid, key))
+            return
+        # self.id / self.name 等：只随该实体本身的改动变化
+        if is_self(obj) and key not in (None, "stats"):
+            if sk:
+                deps.add(("self", sk, sid))
+            return
+        # globals['k'] / ctx.globals.k
+        if _is_ctx(obj, "globals", shadowed) and key is not None:
+            deps.add(("g", key))
+            return
+        # players.find(p => p.id === 'x')?.stats['k']
+        if key is not None and obj[0] == "member" and _const_key(obj[2]) == "stats":
+            target = _find_player_id(obj[1], shadowed)
+            if target is not None:
+                deps.add(("p", target, key))
+                return
+        if _is_ctx(node, "turn", shadowed):
+            deps.add(("turn",))
+            return
+    elif kind == "name":
+        if node[1] in shadowed:
+            return
+        if node[1] == "turn":
+            deps.add(("turn",))
+        elif node[1] in _CTX_NAMES or node[1] == "ctx":
+            deps.add(WILDCARD)
+        elif node[1] == "self" and sk:
+            deps.add(WILDCARD)
+        return
+    elif kind == "call":
+        callee, args = node[1], node[2]
+        # utils.sumRegionStat(owner, 'k')
+        if _member_of(callee, lambda n: _is_ctx(n, "utils", shadowed), "sumRegionStat") and len(args) == 2:
+            owner = _owner_arg(args[0], sk, sid, shadowed)
+            key = _const_key(args[1])
+            if owner is not None and key is not None:
+                deps.add(("agg", owner, key))
+                deps.add(("owned", owner))
+                return
+        # map.regions.reduce((s, r) => ..., init)
+        if _member_of(callee, lambda n: _member_of(n, lambda m: _is_ctx(m, "map", shadowed), "regions"), "reduce") \
+                and args and args[0][0] == "arrow" and len(args[0][1]) >= 2:
+            params = args[0][1]
+            region_var = params[1]
+            inner: Set[tuple] = set()
+            if _walk_region_body(args[0][2], region_var, sk, sid, shadowed | set(params), inner):
+                deps.update(inner)
+                for a in args[1:]:
+                    _walk(a, sk, sid, shadowed, deps)
+                return
+    elif kind == "arrow":
+        _walk(node[2], sk, sid, shadowed | set(node[1]), deps)
+        return
+
+    for child in node[1:]:
+        if isinstance(child, tuple) and child and isinstance(child[0], str):
+            _walk(child, sk, sid, shadowed, deps)
+        elif isinstance(child, list):
+            for c in child:
+                _walk(c, sk, sid, shadowed, deps)
+
+
+def _find_player_id(node, shadowed) -> Optional[str]:
+    """匹配 players.find(p => p.id === 'x')，返回 'x'"""
+    if node[0] != "call" or len(node[2]) != 1:
+        return None
+    callee, arrow = node[1], node[2][0]
+    if not _member_of(callee, lambda n: _is_ctx(n, "players", shadowed), "find"):
+        return None
+    if arrow[0] != "arrow" or len(arrow[1]) != 1:
+        return None
+    var, body = arrow[1][0], arrow[2]
+    if body[0] != "bin" or body[1] not in ("==", "==="):
+        return None
+    for a, b in ((body[2], body[3]), (body[3], body[2])):
+        if _member_of(a, lambda n: n == ("name", var), "id") and b[0] == "str":
+            return b[1]
+    return None
+
+
+def _owner_arg(node, sk, sid, shadowed) -> Optional[str]:
+    if node[0] == "str":
+        return node[1]
+    if _member_of(node, lambda n: n == ("name", "self") and "self" not in shadowed, "id") and sk:
+        return sid
+    return None
+
+
+def _walk_region_body(node, var, sk, sid, shadowed, deps) -> bool:
+    """reduce 回调体里只允许 r.stats['k'] 形式访问地块，返回是否可静态分析"""
+    if node[0] == "name" and node[1] == var:
+        return False
+    if node[0] == "member" and node[1][0] == "member" and node[1][1] == ("name", var) \
+            and _const_key(node[1][2]) == "stats":
+        key = _const_key(node[2])
+        if key is None:
+            return False
+        deps.add(("aggall", key))
+        return True
+    if node[0] == "arrow":
+        return _walk_region_body(node[2], var, sk, sid, shadowed | set(node[1]), deps)
+    if node[0] in ("num", "str", "lit"):
+        return True
+    if node[0] == "name":
+        _walk(node, sk, sid, shadowed, deps)
+        return True
+    ok = True
+    for child in node[1:]:
+        if isinstance(child, tuple) and child and isinstance(child[0], str):
+            ok = _walk_region_body(child, var, sk, sid, shadowed, deps) and ok
+        elif isinstance(child, list):
+            for c in child:
+                ok = _walk_region_body(c, var, sk, sid, shadowed, deps) and ok
+    return ok
+
+
+# --- 依赖图与增量计算 ---
+
+class _Node:
+    __slots__ = ("key", "label", "formula", "fn", "deps", "owner", "target", "path", "self_obj", "index", "error")
+
+    def __init__(self, key, label, formula, target, path, self_obj, index):
+        self.key = key            # ("g", k) / ("p", id, k) / ("r", id, k)
+        self.label = label
+        self.formula = formula
+        self.target = target      # 写入结果的 dict (global_var 本身 / 实体的 stats)
+        self.path = path          # 结果的 JSON Pointer
+        self.self_obj = self_obj  # 公式中的 self
+        self.index = index        # 定义顺序 (与前端 recalculateState 一致)
+        self.fn = None
+        self.deps: Set[tuple] = set()
+        self.owner = None
+        self.error = None
+
+
+_compiled_cache: Dict[str, Callable[[dict], Any]] = {}
+
+
+def _escape_pointer(token: str) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+
+def _round_result(value, kind: str):
+    # 与前端一致：全局变量先转数字 (NaN -> 0)；实体/地块属性只接受数字
+    if kind == "g":
+        value = to_number(value)
+    elif not _is_num(value):
+        return 0
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return 0
+    value = js_round(value * 100) / 100
+    return int(value) if value.is_integer() else value
+
+
+class FormulaEngine:
+    """
+    绑定一个存档文档 (dict)。rebuild() 解析全部公式并建图；
+    recompute_all() 全量计算；apply_ops(ops) 根据已应用到文档上的 JSON-Patch 只重算受影响的公式。
+    两者都直接把结果写回文档，并返回对应的 JSON-Patch 操作。
+    """
+
+    def __init__(self, doc: dict):
+        self.doc = doc
+        self.rebuild()
+
+    # --- 建图 ---
+
+    def rebuild(self):
+        doc = self.doc
+        self.nodes: List[_Node] = []
+        self.cycles: List[List[str]] = []
+        self.errors: Dict[str, str] = {}
+        self._regions = self._collect_regions()
+        self._region_owner = {rid: r.get("ownerId", "") for rid, (r, _) in self._regions.items()}
+        self._player_ids = [p.get("id") for p in doc.get("players", [])]
+        self._turn = self._current_turn()
+
+        rule_sets = {r.get("id"): r for r in doc.get("rule_sets", [])}
+        for i, g in enumerate(doc.get("global_vars", [])):
+            if self._is_formula(g):
+                self._add_node(("g", g.get("key")), f"global:{g.get('key')}", g.get("formula"), g,
+                               f"/global_vars/{i}/value", None, value_key="value")
+        for i, p in enumerate(doc.get("players", [])):
+            schema = rule_sets.get(p.get("schemaId"))
+            if not schema:
+                continue
+            for f in schema.get("fields", []):
+                if self._is_formula(f):
+                    self._add_node(("p", p.get("id"), f.get("key")), f"{p.get('name')}.{f.get('key')}",
+                                   f.get("formula"), p, f"/players/{i}/stats", p)
+        for rid, (reg, base) in self._regions.items():
+            schema = rule_sets.get(reg.get("schemaId")) if reg.get("schemaId") else None
+            if not schema:
+                continue
+            for f in schema.get("fields", []):
+                if self._is_formula(f):
+                    self._add_node(("r", rid, f.get("key")), f"{reg.get('name')}.{f.get('key')}",
+                                   f.get("formula"), reg, f"{base}/stats", reg)
+
+        self._index()
+        self._order()
+
+    @staticmethod
+    def _is_formula(field: dict) -> bool:
+        return field.get("type") == "number" and field.get("visibility") == "readonly" and bool(field.get("formula"))
+
+    def _collect_regions(self) -> Dict[str, Tuple[dict, str]]:
+        """id -> (地块, JSON Pointer)。图层中的地块优先，其次是旧版 map_data.regions"""
+        regions: Dict[str, Tuple[dict, str]] = {}
+        map_data = self.doc.get("map_data") or {}
+        for li, layer in enumerate(map_data.get("layers") or []):
+            if layer.get("type") == "region" and isinstance(layer.get("data"), list):
+                for ri, reg in enumerate(layer["data"]):
+                    if isinstance(reg, dict):
+                        regions.setdefault(reg.get("id"), (reg, f"/map_data/layers/{li}/data/{ri}"))
+        for ri, reg in enumerate(map_data.get("regions") or []):
+            if isinstance(reg, dict):
+                regions.setdefault(reg.get("id"), (reg, f"/map_data/regions/{ri}"))
+        return regions
+
+    def _current_turn(self):
+        timeline = self.doc.get("timeline") or []
+        return timeline[-1].get("id", 0) if timeline else 0
+
+    def _add_node(self, key, label, formula, holder, path, self_obj, value_key=None):
+        node = _Node(key, label, formula, holder, path, self_obj, len(self.nodes))
+        if value_key is None:
+            node.target = holder.setdefault("stats", {})
+            node.path = f"{path}/{_escape_pointer(key[2])}"
+        try:
+            ast = parse_formula(formula)
+            source = formula.strip()
+            node.fn = _compiled_cache.get(source)
+            if node.fn is None:
+                # 同一规则集字段的公式被所有实体共享，只编译一次
+                node.fn = _compiled_cache[source] = compile_formula(ast)
+            node.deps = analyze_dependencies(ast, key[0] if key[0] != "g" else "", key[1] if key[0] != "g" else "")
+        except FormulaError as e:
+            node.error = str(e)
+            self.errors[label] = node.error
+        except RecursionError:
+            # 解析/编译/依赖分析都是递归的：嵌套过深 (如 "-" * 3000 + "1") 的公式只标记为错误
+            node.fn = None
+            node.error = "Formula nested too deeply"
+            self.errors[label] = node.error
+        if key[0] == "r":
+            node.owner = self._region_owner.get(key[1], "")
+        self.nodes.append(node)
+
+    def _index(self):
+        self._by_key: Dict[tuple, _Node] = {n.key: n for n in self.nodes}
+        self._consumers: Dict[tuple, List[_Node]] = {}
+        self._wildcards: List[_Node] = []
+        for n in self.nodes:
+            if WILDCARD in n.deps:
+                self._wildcards.append(n)
+            for d in n.deps:
+                self._consumers.setdefault(d, []).append(n)
+
+    def _upstream(self, node: _Node) -> List[_Node]:
+        if WILDCARD in node.deps:
+            return [n for n in self.nodes if n is not node and WILDCARD not in n.deps]
+        out = []
+        for d in node.deps:
+            if d[0] in ("g", "p", "r"):
+                producer = self._by_key.get(d)
+                if producer is not None:
+                    out.append(producer)
+            elif d[0] == "agg":
+                out.extend(self._region_nodes.get((d[1], d[2]), ()))
+            elif d[0] == "aggall":
+                out.extend(self._region_nodes.get(d[1], ()))
+        return out
+
+    def _order(self):
+        """Tarjan 强连通分量：非平凡分量即循环依赖，其余按拓扑序排列"""
+        self.cycles = []
+        self._region_nodes: Dict[Any, List[_Node]] = {}  # (归属, 属性) / 属性 -> 地块公式
+        for n in self.nodes:
+            if n.key[0] == "r":
+                self._region_nodes.setdefault((n.owner, n.key[2]), []).append(n)
+                self._region_nodes.setdefault(n.key[2], []).append(n)
+            if n.error == "Circular dependency":
+                n.error = None
+        upstream = {id(n): self._upstream(n) for n in self.nodes}
+        index_of, low, on_stack, stack = {}, {}, set(), []
+        order: List[_Node] = []
+        counter = [0]
+
+        for root in self.nodes:
+            if id(root) in index_of:
+                continue
+            work = [(root, iter(upstream[id(root)]))]
+            index_of[id(root)] = low[id(root)] = counter[0]
+            counter[0] += 1
+            stack.append(root)
+            on_stack.add(id(root))
+            while work:
+                node, it = work[-1]
+                advanced = False
+                for up in it:
+                    if id(up) not in index_of:
+                        index_of[id(up)] = low[id(up)] = counter[0]
+                        counter[0] += 1
+                        stack.append(up)
+                        on_stack.add(id(up))
+                        work.append((up, iter(upstream[id(up)])))
+                        advanced = True
+                        break
+                    if id(up) in on_stack:
+                        low[id(node)] = min(low[id(node)], index_of[id(up)])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[id(parent)] = min(low[id(parent)], low[id(node)])
+                if low[id(node)] == index_of[id(node)]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(id(member))
+                        component.append(member)
+                        if member is node:
+                            break
+                    if len(component) > 1 or node in upstream[id(node)]:
+                        component.sort(key=lambda n: n.index)
+                        self.cycles.append([n.label for n in component])
+                        for m in component:
+                            m.error = "Circular dependency"
+                    else:
+                        order.append(node)
+        # Tarjan 按"上游先完成"的顺序产出分量，正好是拓扑序
+        self.order = order
+        self._pos = {id(n): i for i, n in enumerate(order)}
+
+    # --- 求值 ---
+
+    def _context(self) -> dict:
+        doc = self.doc
+        globals_map = {}
+        for g in doc.get("global_vars", []):
+            val = g.get("value")
+            if g.get("type") == "number":
+                val = parse_float(val)
+                val = 0 if math.isnan(val) else val
+            globals_map[g.get("key")] = val
+        regions = [r for r, _ in self._regions.values()]
+        map_view = dict(doc.get("map_data") or {})
+        map_view["regions"] = regions
+
+        def owned(owner_id):
+            return [r for r in regions if r.get("ownerId") == owner_id]
+
+        def sum_region_stat(owner_id, stat_key):
+            total = 0.0
+            for r in regions:
+                if r.get("ownerId") == owner_id:
+                    val = parse_float((r.get("stats") or {}).get(stat_key))
+                    total += 0 if math.isnan(val) else val
+            return total
+
+        ctx = {"globals": globals_map, "players": doc.get("players", []), "map": map_view,
+               "turn": self._turn, "utils": {"getOwnedRegions": owned, "sumRegionStat": sum_region_stat}}
+        env = dict(BUILTINS)
+        env.update(ctx)
+        env["ctx"] = ctx
+        return env
+
+    def _evaluate(self, node: _Node, env: dict) -> Optional[dict]:
+        """计算单个公式并写回，值有变化时返回 JSON-Patch 操作"""
+        if node.fn is None or node.error:
+            return None
+        scope = env
+        if node.self_obj is not None:
+            scope = dict(env)
+            scope["self"] = node.self_obj
+        try:
+            raw = node.fn(scope)
+        except (_JSError, _ShortCircuit, RecursionError, TypeError, ValueError, ZeroDivisionError):
+            raw = 0  # 前端 try { ... } catch(e) { return 0; }
+        value = _round_result(raw, node.key[0])
+
+        if node.key[0] == "g":
+            if node.target.get("value") == value:
+                return None
+            node.target["value"] = value
+            env["globals"][node.key[1]] = value
+        else:
+            if node.target.get(node.key[2]) == value:
+                return None
+            node.target[node.key[2]] = value
+        return {"op": "add", "path": node.path, "value": value}
+
+    def recompute_all(self) -> List[dict]:
+        env = self._context()
+        ops = []
+        for node in self.order:
+            op = self._evaluate(node, env)
+            if op:
+                ops.append(op)
+        return ops
+
+    def _output_keys(self, node: _Node) -> List[tuple]:
+        if node.key[0] == "r":
+            return [node.key, ("agg", node.owner, node.key[2]), ("aggall", node.key[2])]
+        return [node.key]
+
+    def recompute(self, changed: Iterable[tuple]) -> List[dict]:
+        """只重算依赖 changed 中任一键的公式 (及其下游)"""
+        changed = list(changed)
+        if not changed:
+            return []
+        heap: List[Tuple[int, int]] = []
+        queued: Set[int] = set()
+
+        def push_consumers(keys):
+            for key in keys:
+                for n in self._consumers.get(key, ()):
+                    if id(n) in self._pos and id(n) not in queued:
+                        queued.add(id(n))
+                        heapq.heappush(heap, (self._pos[id(n)], id(n)))
+                producer = self._by_key.get(key)
+                # 用户直接改了只读的计算字段：重新算回来
+                if producer is not None and id(producer) in self._pos and id(producer) not in queued:
+                    queued.add(id(producer))
+                    heapq.heappush(heap, (self._pos[id(producer)], id(producer)))
+            for n in self._wildcards:
+                if id(n) in self._pos and id(n) not in queued:
+                    queued.add(id(n))
+                    heapq.heappush(heap, (self._pos[id(n)], id(n)))
+
+        push_consumers(changed)
+        env = self._context()
+        ops = []
+        while heap:
+            pos, _ = heapq.heappop(heap)
+            node = self.order[pos]
+            op = self._evaluate(node, env)
+            if op:
+                ops.append(op)
+                keys = self._output_keys(node)
+                for key in keys:
+                    for n in self._consumers.get(key, ()):
+                        if id(n) in self._pos and id(n) not in queued:
+                            queued.add(id(n))
+                            heapq.heappush(heap, (self._pos[id(n)], id(n)))
+                for n in self._wildcards:
+                    if id(n) in self._pos and id(n) not in queued and self._pos[id(n)] > pos:
+                        queued.add(id(n))
+                        heapq.heappush(heap, (self._pos[id(n)], id(n)))
+        return ops
+
+    # --- 从 JSON-Patch 推导受影响的键 ---
+
+    def changed_keys(self, ops: List[dict]) -> Optional[Set[tuple]]:
+        """已应用到文档上的 ops 影响了哪些键；结构性改动 (增删实体、改公式/规则集) 返回 None"""
+        keys: Set[tuple] = set()
+        for op in ops:
+            if op.get("op") in ("move", "copy"):
+                return None
+            if op.get("op") == "test":
+                continue
+            parts = [p.replace("~1", "/").replace("~0", "~") for p in op.get("path", "").split("/")[1:]]
+            result = self._keys_for_path(parts, op.get("op"))
+            if result is None:
+                return None
+            keys.update(result)
+        return keys
+
+    def _keys_for_path(self, parts: List[str], op: str) -> Optional[Set[tuple]]:
+        doc = self.doc
+        if not parts:
+            return None
+        section = parts[0]
+        if section in ("lorebook", "currentTurnPending", "stat_schema"):
+            return set()
+        if section == "timeline":
+            turn = self._current_turn()
+            if turn != self._turn:
+                self._turn = turn
+                return {("turn",)}
+            return set()
+        if section == "global_vars":
+            if len(parts) == 3 and parts[2] == "value" and op != "remove":
+                g = self._at(doc.get("global_vars"), parts[1])
+                return {("g", g.get("key"))} if g is not None else None
+            return None
+        if section == "players":
+            if len(parts) < 3:
+                return None
+            p = self._at(doc.get("players"), parts[1])
+            if p is None or [x.get("id") for x in doc.get("players", [])] != self._player_ids:
+                return None
+            if parts[2] == "stats":
+                if len(parts) == 4:
+                    return {("p", p.get("id"), parts[3])}
+                return {("p", p.get("id"), k) for k in (p.get("stats") or {})} | {("self", "p", p.get("id"))}
+            if parts[2] in ("schemaId", "id"):
+                return None
+            return {("self", "p", p.get("id"))}
+        if section == "map_data":
+            return self._region_keys(parts)
+        return None
+
+    def _region_keys(self, parts: List[str]) -> Optional[Set[tuple]]:
+        if len(parts) >= 5 and parts[1] == "layers" and parts[3] == "data":
+            base, rest = f"/map_data/layers/{parts[2]}/data/{parts[4]}", parts[5:]
+        elif len(parts) >= 3 and parts[1] == "regions":
+            base, rest = f"/map_data/regions/{parts[2]}", parts[3:]
+        elif len(parts) >= 2 and parts[1] in ("layers", "regions"):
+            if len(parts) >= 4 and parts[1] == "layers" and parts[3] not in ("data", "type"):
+                return set()  # 图层名称/可见性等
+            return None
+        else:
+            return set()
+        if not rest:
+            return None
+        rid = next((i for i, (_, p) in self._regions.items() if p == base), None)
+        if rid is None:
+            return None
+        reg = self._regions[rid][0]
+        if reg.get("id") != rid:
+            return None
+        if rest[0] == "stats":
+            if len(rest) == 2:
+                return {("r", rid, rest[1]), ("agg", self._region_owner.get(rid, ""), rest[1]), ("aggall", rest[1])}
+            owner = self._region_owner.get(rid, "")
+            return {("owned", owner), ("self", "r", rid)} | {("aggall", k) for k in (reg.get("stats") or {})}
+        if rest[0] == "ownerId":
+            old, new = self._region_owner.get(rid, ""), reg.get("ownerId", "")
+            self._region_owner[rid] = new
+            for n in self.nodes:
+                if n.key[0] == "r" and n.key[1] == rid:
+                    n.owner = new
+            # 地块易主会改变上下游关系，重排拓扑序
+            self._order()
+            return {("owned", old), ("owned", new), ("self", "r", rid)}
+        if rest[0] == "schemaId":
+            return None
+        return {("self", "r", rid)}
+
+    @staticmethod
+    def _at(items, token):
+        if not isinstance(items, list) or not token.isdigit() or int(token) >= len(items):
+            return None
+        return items[int(token)]
+
+    def apply_ops(self, ops: List[dict]) -> List[dict]:
+        """文档已应用 ops 之后调用：增量重算 (结构性改动则重建后全量重算)"""
+        keys = self.changed_keys(ops)
+        if keys is None:
+            self.rebuild()
+            return self.recompute_all()
+        return self.recompute(keys)
+
+    def report(self) -> dict:
+        return {"formulas": len(self.nodes), "cycles": self.cycles, "errors": self.errors}
@@ -0,0 +1,67 @@
+"""
+按需导入：大模型 SDK、PDF/Word 解析库在第一次用到时才加载，缩短服务端冷启动时间。
+
+    genai = lazy_module("google.generativeai")
+    genai.configure(api_key=...)    # 第一次访问属性时才真正 import
+
+warm_up([...]) 在后台线程里预先导入，服务启动后调用，首个 AI 请求/附件解析就不必再等待。
+"""
+import importlib
+import threading
+import time
+from types import ModuleType
+from typing import Callable, List, Optional
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Optional[ModuleType] = None
+        self._lock = threading.Lock()
+        self.import_seconds: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self) -> ModuleType:
+        module = self._module
+        if module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    self._module = importlib.import_module(self._name)
+                    self.import_seconds = time.perf_counter() - started
+                module = self._module
+        return module
+
+    def __getattr__(self, attr: str):
+        # 只有找不到的属性 (即模块内容) 才会走到这里
+        return getattr(self.load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r} ({'loaded' if self.loaded else 'not loaded'})>"
+
+
+def lazy_module(name: str) -> LazyModule:
+    return LazyModule(name)
+
+
+def warm_up(modules: List[LazyModule], delay: float = 0.0,
+            on_done: Optional[Callable[[LazyModule, Optional[Exception]], None]] = None) -> threading.Thread:
+    """在后台线程依次导入 modules；on_done(module, error) 在每个模块导入后回调"""
+    def run():
+        if delay > 0:
+            time.sleep(delay)
+        for module in modules:
+            error = None
+            try:
+                module.load()
+            except Exception as e:  # 缺少可选依赖等，留到真正使用时再报错
+                error = e
+            if on_done is not None:
+                on_done(module, error)
+
+    thread = threading.Thread(target=run, name="lazy-warm-up", daemon=True)
+    thread.start()
+    return thread
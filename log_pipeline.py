@@ -0,0 +1,144 @@
+"""
+异步结构化日志：请求线程只把日志记录放进队列，格式化、脱敏、截断、写盘都在后台线程完成。
+
+用法：
+    logger.info("AI Request Received", extra={"payload": req})
+payload 可以是任意对象 (dict / pydantic 模型 / 字符串)，只有在日志真正输出时才会被脱敏并序列化。
+文件日志为 JSON Lines，控制台保持原来的文本格式。
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Callable, List, Optional
+
+
+def _truncate(obj: Any, max_chars: int) -> Any:
+    if max_chars <= 0:
+        return obj
+    if isinstance(obj, str):
+        if len(obj) > max_chars:
+            return f"{obj[:max_chars]}...<truncated {len(obj) - max_chars} chars>"
+        return obj
+    if isinstance(obj, dict):
+        return {k: _truncate(v, max_chars) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_truncate(v, max_chars) for v in obj]
+    return obj
+
+
+class PayloadRenderer:
+    """把 record.payload 变成可输出的对象：采样 -> model_dump -> 脱敏 -> 截断"""
+
+    def __init__(self, redactor: Optional[Callable[[Any], Any]] = None, max_chars: int = 0, sample_rate: float = 1.0):
+        self.redactor = redactor
+        self.max_chars = max_chars
+        self.sample_rate = sample_rate
+
+    def render(self, record: logging.LogRecord):
+        if not hasattr(record, "payload"):
+            return None
+        cached = getattr(record, "_payload_rendered", None)
+        if cached is not None:
+            return cached
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            rendered = "<payload not sampled>"
+        else:
+            payload = record.payload
+            if hasattr(payload, "model_dump"):
+                payload = payload.model_dump()
+            if self.redactor is not None:
+                payload = self.redactor(payload)
+            rendered = _truncate(payload, self.max_chars)
+        # 同一条记录会被多个 handler 输出，只渲染一次
+        record._payload_rendered = rendered
+        return rendered
+
+
+class JsonLineFormatter(logging.Formatter):
+    def __init__(self, renderer: PayloadRenderer):
+        super().__init__()
+        self.renderer = renderer
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        payload = self.renderer.render(record)
+        if payload is not None:
+            entry["payload"] = payload
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """原有的文本格式，payload 以缩进 JSON 附在消息后"""
+
+    def __init__(self, renderer: PayloadRenderer, fmt: str):
+        super().__init__(fmt)
+        self.renderer = renderer
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        payload = self.renderer.render(record)
+        if payload is None:
+            return text
+        if isinstance(payload, str):
+            return f"{text}: {payload}"
+        return f"{text}. Payload:\n{json.dumps(payload, indent=2, ensure_ascii=False, default=str)}"
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    标准 QueueHandler.prepare() 会在调用线程里先 format 一遍，热路径上仍要付出序列化开销；
+    这里原样入队，格式化全部交给监听线程。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _Listener(QueueListener):
+    def stop(self):
+        # 允许重复调用 (手动 stop 之后 atexit 还会再调一次)
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(log_file: str, level: int = logging.INFO, async_mode: bool = True, json_lines: bool = True,
+                  payload_max_chars: int = 0, payload_sample_rate: float = 1.0,
+                  redactor: Optional[Callable[[Any], Any]] = None,
+                  max_bytes: int = 5 * 1024 * 1024, backup_count: int = 3) -> Optional[QueueListener]:
+    renderer = PayloadRenderer(redactor, payload_max_chars, payload_sample_rate)
+    text_fmt = "%(asctime)s [%(levelname)s] %(message)s"
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(JsonLineFormatter(renderer) if json_lines else TextFormatter(renderer, text_fmt))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(TextFormatter(renderer, text_fmt))
+    handlers: List[logging.Handler] = [file_handler, console_handler]
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for h in list(root.handlers):
+        root.removeHandler(h)
+
+    if not async_mode:
+        for h in handlers:
+            root.addHandler(h)
+        return None
+
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = _Listener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出时把队列里剩余的日志写完
+    atexit.register(listener.stop)
+    return listener
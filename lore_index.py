@@ -0,0 +1,132 @@
+"""
+资料库关键词索引：对所有 "auto" 资料条目的关键词建立 Aho-Corasick 自动机，
+一次扫描推演文本即可得到全部被触发的条目，代替前端逐条 includes() 的线性扫描。
+
+匹配规则与前端 openContextModal 保持一致：
+keys 按半角/全角逗号切分、去空白、转小写，文本同样转小写后做子串匹配。
+"""
+import re
+from collections import deque
+from typing import Dict, List, Set
+
+KEY_SPLIT_RE = re.compile(r"[,，]")
+
+
+def split_keys(keys: str) -> List[str]:
+    return [k.strip().lower() for k in KEY_SPLIT_RE.split(keys or "") if k.strip()]
+
+
+def signature_digest(signature: List[tuple]) -> str:
+    """
+    (keys, mode) 列表的 32 位 FNV-1a 摘要，按 UTF-16 码元计算，与前端 LevantAPI.loreDigest 逐位一致。
+    前端用它确认本地资料库 (可能有未保存的修改) 与建索引时的一致。
+    """
+    h = 0x811C9DC5
+    text = "".join(f"{keys}\u0001{mode}\u0000" for keys, mode in signature)
+    data = text.encode("utf-16-le", "surrogatepass")
+    for i in range(0, len(data), 2):
+        h = ((h ^ (data[i] | data[i + 1] << 8)) * 0x01000193) & 0xFFFFFFFF
+    return f"{h:08x}"
+
+
+class LoreIndex:
+    """
+    增量维护的多模式匹配索引。
+    - 关键词集合不变 (只改了内容/顺序/模式)：只更新 关键词 -> 条目 映射，不动自动机。
+    - 新增关键词：插入 trie 后重算失配链接 (与 trie 大小线性相关)。
+    - 删除的关键词：先在映射里置空，积累过多时再整体重建。
+    """
+
+    def __init__(self):
+        self._reset()
+        self.signature: List[tuple] = []
+        self.digest = signature_digest([])
+
+    def _reset(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[str]] = [[]]  # 节点 -> 在此结束的关键词 (含失配链上的)
+        self._keywords: Set[str] = set()  # 已插入 trie 的关键词 (可能已无条目引用)
+        self._entries: Dict[str, Set[int]] = {}  # 关键词 -> 条目下标
+
+    def update(self, lorebook: List[dict]) -> bool:
+        """根据最新的资料库同步索引，返回是否有变化"""
+        signature = [(e.get("keys") or "", e.get("mode") or "auto") for e in lorebook]
+        if signature == self.signature:
+            return False
+
+        entries: Dict[str, Set[int]] = {}
+        for idx, (keys, mode) in enumerate(signature):
+            if mode != "auto":
+                continue
+            for kw in split_keys(keys):
+                entries.setdefault(kw, set()).add(idx)
+
+        added = [kw for kw in entries if kw not in self._keywords]
+        dead = len(self._keywords) - (len(entries) - len(added))
+        if dead > max(64, len(entries)):
+            # 废弃关键词太多，整体重建
+            self._reset()
+            added = list(entries)
+
+        for kw in added:
+            self._insert(kw)
+        if added:
+            self._build_links()
+
+        self._entries = entries
+        self.signature = signature
+        self.digest = signature_digest(signature)
+        return True
+
+    def _insert(self, kw: str):
+        node = 0
+        for ch in kw:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._keywords.add(kw)
+
+    def _build_links(self):
+        # 先清空合并过的输出，再按 BFS 重算失配链接与输出
+        ends = {}
+        for kw in self._keywords:
+            node = 0
+            for ch in kw:
+                node = self._goto[node][ch]
+            ends[node] = kw
+        self._out = [[ends[n]] if n in ends else [] for n in range(len(self._goto))]
+        self._fail = [0] * len(self._goto)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[child] = self._goto[f].get(ch, 0) if self._goto[f].get(ch, 0) != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+                queue.append(child)
+
+    def match(self, text: str) -> List[int]:
+        """返回被 text 触发的条目下标 (升序)"""
+        hit_keywords = set()
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for ch in (text or "").lower():
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                hit_keywords.update(out[node])
+
+        triggered: Set[int] = set()
+        for kw in hit_keywords:
+            triggered.update(self._entries.get(kw, ()))
+        return sorted(triggered)
@@ -0,0 +1,139 @@
+"""
+存档结构迁移：每个存档带 schemaVersion，读档时若低于 CURRENT_SCHEMA_VERSION，
+按顺序执行尚未执行过的迁移并写回存储，之后的读档不再做任何修补。
+
+新增迁移：在 MIGRATIONS 末尾追加 (版本号, 函数)，函数原地修改文档；版本号必须连续递增。
+
+离线批量迁移整个存档目录 (服务端未运行时执行)：
+    python migrations.py                     # 迁移全部存档 (默认 JSON 后端)
+    python migrations.py --storage sqlite
+    python migrations.py --dry-run a.json b.json
+"""
+import argparse
+import sys
+from typing import Callable, List, Tuple
+
+SCHEMA_VERSION_KEY = "schemaVersion"
+
+
+def _v1_rule_sets(doc: dict):
+    """旧存档只有 stat_schema (或更早的 schema)：包装成默认规则集，所有实体挂到它下面"""
+    if "rule_sets" in doc:
+        return
+    old_schema = doc.get("stat_schema", doc.get("schema", [])) or []
+    doc["rule_sets"] = [{"id": "default", "name": "通用实体 (Default)", "fields": old_schema}]
+    for player in doc.get("players", []):
+        if "schemaId" not in player:
+            player["schemaId"] = "default"
+
+
+def _v2_faction_schema_ids(doc: dict):
+    """schemaId 缺失或指向不存在的规则集的实体，回落到第一个规则集"""
+    if not doc.get("rule_sets"):
+        return
+    valid_ids = [r.get("id") for r in doc["rule_sets"]]
+    fallback_id = valid_ids[0] if valid_ids else "default"
+    for player in doc.get("players", []):
+        if player.get("schemaId") not in valid_ids:
+            player["schemaId"] = fallback_id
+
+
+def _v3_map_layers(doc: dict):
+    """旧版散装地图 (image / regions / pins) 转成图层，与前端 applyState 的迁移一致；之后丢弃旧字段"""
+    map_data = doc.get("map_data")
+    if not isinstance(map_data, dict):
+        doc["map_data"] = map_data = {"layers": [], "activeLayerId": ""}
+    layers = map_data.get("layers") or []
+    image, regions, pins = map_data.get("image"), map_data.get("regions") or [], map_data.get("pins") or []
+    if not layers and (image or regions):
+        if image:
+            layers.append({"id": "layer_bg_migrated", "type": "image", "name": "Base Map",
+                           "visible": True, "opacity": 1.0, "data": image})
+        if regions:
+            layers.append({"id": "layer_reg_migrated", "type": "region", "name": "Territories",
+                           "visible": True, "opacity": 1.0, "data": regions})
+        if pins:
+            layers.append({"id": "layer_pin_migrated", "type": "marker", "name": "Markers",
+                           "visible": True, "opacity": 1.0, "data": pins})
+        map_data["activeLayerId"] = layers[0]["id"] if layers else ""
+    map_data["layers"] = layers
+    for layer in layers:
+        if layer.get("type") == "region" and isinstance(layer.get("data"), list):
+            for region in layer["data"]:
+                region.setdefault("schemaId", "")
+                region.setdefault("stats", {})
+    for key in ("image", "regions", "pins"):
+        map_data.pop(key, None)
+
+
+# (目标版本, 迁移函数)：按顺序执行
+MIGRATIONS: List[Tuple[int, Callable[[dict], None]]] = [
+    (1, _v1_rule_sets),
+    (2, _v2_faction_schema_ids),
+    (3, _v3_map_layers),
+]
+CURRENT_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def needs_migration(doc: dict) -> bool:
+    return doc.get(SCHEMA_VERSION_KEY, 0) < CURRENT_SCHEMA_VERSION
+
+
+def migrate_document(doc: dict) -> List[int]:
+    """原地升级到当前版本，返回执行过的迁移版本号 (已是最新时为空)"""
+    version = doc.get(SCHEMA_VERSION_KEY, 0)
+    applied = []
+    for target, migrate in MIGRATIONS:
+        if target > version:
+            migrate(doc)
+            applied.append(target)
+    if applied or SCHEMA_VERSION_KEY not in doc:
+        doc[SCHEMA_VERSION_KEY] = max(version, CURRENT_SCHEMA_VERSION)
+    return applied
+
+
+# --- 命令行：离线批量迁移 ---
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help="存档名 (默认全部)")
+    parser.add_argument("--storage", choices=["json", "sqlite"], default=None, help="默认沿用 server.STORAGE_BACKEND")
+    parser.add_argument("--dry-run", action="store_true", help="只列出需要迁移的存档，不写回")
+    args = parser.parse_args(argv)
+
+    import server  # 复用服务端的存储层 (增量日志、分支存档、blob 抽取)
+    if args.storage and args.storage != server.STORAGE_BACKEND:
+        server.STORAGE_BACKEND = args.storage
+        server.save_storage = server.create_storage()
+    storage = server.save_storage
+
+    names = args.names or storage.list_saves()
+    # 分支存档要在父存档之后迁移，继承的部分才能继续共享
+    def depth(name: str) -> int:
+        d, info = 0, storage.branch_info(name)
+        while info and d < len(names):
+            d, info = d + 1, storage.branch_info(info["parent"])
+        return d
+
+    migrated = failed = 0
+    for name in sorted(names, key=depth):
+        try:
+            doc = storage.load(name)
+            if not needs_migration(doc):
+                continue
+            version = doc.get(SCHEMA_VERSION_KEY, 0)
+            if args.dry_run:
+                print(f"{name}: v{version} -> v{CURRENT_SCHEMA_VERSION} (dry run)")
+            else:
+                server.migrate_and_store(name, doc)
+                print(f"{name}: v{version} -> v{CURRENT_SCHEMA_VERSION}")
+            migrated += 1
+        except Exception as e:
+            failed += 1
+            print(f"{name}: failed: {e}")
+    print(f"{len(names)} saves, {migrated} {'to migrate' if args.dry_run else 'migrated'}, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
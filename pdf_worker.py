@@ -0,0 +1,30 @@
+"""
+PDF 分块提取：server.py 把大 PDF 按页分块交给进程池，子进程执行这里的 extract_pages。
+
+spawn 模式下子进程按模块名重新导入被调用的函数所在的模块；放在这个独立的小模块里，
+子进程就不会重复执行 server.py 的导入期初始化 (建目录、配置日志、构造存储层/存档目录缓存等)。
+因此本模块不能有任何导入时的副作用。
+"""
+from typing import List
+
+
+def extract_pages(source, start: int, end: int, budget: int) -> List[str]:
+    """提取 [start, end) 页的文本，累计超过 budget 字符后提前停止；source 为文件路径或文件对象"""
+    import pypdf  # 用到时才导入 (服务端进程里 pypdf 是延迟加载的)
+
+    reader = pypdf.PdfReader(source)
+    if reader.is_encrypted:
+        try:
+            reader.decrypt("")
+        except Exception:
+            pass
+    texts = []
+    total = 0
+    for i in range(start, min(end, len(reader.pages))):
+        t = reader.pages[i].extract_text()
+        if t:
+            texts.append(t)
+            total += len(t) + 1
+        if total > budget:
+            break
+    return texts
@@ -0,0 +1,432 @@
+"""
+地图区块的服务端几何索引：把 maskData (PNG 遮罩) 转成按行游程编码 (RLE)，
+再按包围盒建 R 树，支持 "某点属于哪个区块"、"某势力拥有哪些区块"、区块面积与相邻关系查询，
+无需在浏览器里解码图片，公式和 AI 上下文也能直接使用领土信息。
+
+坐标约定 (与前端一致)：区块的 x/y/w/h/centerX/centerY 是占整张底图的百分比 (0~100)，
+遮罩图片的像素尺寸就是区块在原底图上的像素包围盒，因此 遮罩宽度 / w = 底图每 1% 的像素数。
+
+RLE 结果按遮罩内容的 sha256 缓存到 cache/region_masks/ (内容寻址，永不失效)。
+为已有存档预先转换：
+    python region_index.py convert saves/*.json
+"""
+import base64
+import bisect
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from PIL import Image  # 可选依赖：有则用它解码 PNG (快得多)，否则用内置的纯 Python 解码器
+except ImportError:
+    Image = None
+
+MASK_CACHE_ENTRIES = 4096   # 内存中保留的遮罩数
+RTREE_NODE_SIZE = 16
+ADJACENCY_GAP_PX = 4        # 两个区块相隔不超过这么多像素 (地图上的边界线宽) 视为相邻
+
+_BLOB_DIGEST_RE = re.compile(r"/api/blobs/([0-9a-f]{64})")
+
+
+# --- PNG 解码 ---
+
+def _paeth(a: int, b: int, c: int) -> int:
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+
+def _decode_png_pure(raw: bytes) -> Tuple[int, int, List[bytes]]:
+    """只支持 8 位、非隔行的 PNG (浏览器 canvas.toDataURL 的输出)；返回每行的 "不透明度" 字节"""
+    if raw[:8] != b"\x89PNG\r\n\x1a\n":
+        raise ValueError("not a PNG")
+    pos, idat, palette, trns = 8, [], None, None
+    width = height = color_type = 0
+    while pos < len(raw):
+        length, ctype = struct.unpack(">I4s", raw[pos:pos + 8])
+        data = raw[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if ctype == b"IHDR":
+            width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", data)
+            if depth != 8 or interlace:
+                raise ValueError("unsupported PNG (need 8-bit, non-interlaced)")
+        elif ctype == b"PLTE":
+            palette = data
+        elif ctype == b"tRNS":
+            trns = data
+        elif ctype == b"IDAT":
+            idat.append(data)
+        elif ctype == b"IEND":
+            break
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+    stride = width * channels
+    pixels = zlib.decompress(b"".join(idat))
+
+    rows, prev = [], bytearray(stride)
+    for y in range(height):
+        start = y * (stride + 1)
+        ftype, line = pixels[start], bytearray(pixels[start + 1:start + 1 + stride])
+        if ftype == 1:
+            for i in range(channels, stride):
+                line[i] = (line[i] + line[i - channels]) & 0xFF
+        elif ftype == 2:
+            for i in range(stride):
+                line[i] = (line[i] + prev[i]) & 0xFF
+        elif ftype == 3:
+            for i in range(stride):
+                left = line[i - channels] if i >= channels else 0
+                line[i] = (line[i] + ((left + prev[i]) >> 1)) & 0xFF
+        elif ftype == 4:
+            for i in range(stride):
+                left = line[i - channels] if i >= channels else 0
+                up_left = prev[i - channels] if i >= channels else 0
+                line[i] = (line[i] + _paeth(left, prev[i], up_left)) & 0xFF
+        prev = line
+        if color_type == 6:
+            rows.append(bytes(line[3::4]))
+        elif color_type == 4:
+            rows.append(bytes(line[1::2]))
+        elif color_type == 3:
+            alpha = trns or b""
+            rows.append(bytes(alpha[i] if i < len(alpha) else 255 for i in line))
+        elif color_type == 2:
+            rows.append(bytes(max(line[i:i + 3]) for i in range(0, stride, 3)))
+        else:
+            rows.append(bytes(line))
+    return width, height, rows
+
+
+def decode_mask_image(raw: bytes) -> Tuple[int, int, List[bytes]]:
+    """遮罩图片 -> (宽, 高, 每行的覆盖度字节)；有透明通道用透明度，否则用亮度 (与 SVG mask 一致)"""
+    if Image is not None:
+        with Image.open(io.BytesIO(raw)) as img:
+            channel = img.getchannel("A") if "A" in img.getbands() else img.convert("L")
+            width, height = channel.size
+            data = channel.tobytes()
+        return width, height, [data[y * width:(y + 1) * width] for y in range(height)]
+    return _decode_png_pure(raw)
+
+
+# --- 遮罩的游程编码 ---
+
+_INSIDE = bytes(1 if i >= 128 else 0 for i in range(256))
+_RUN_RE = re.compile(b"\x01+")
+
+
+class RegionMask:
+    """按行的游程：rows[y] = [x0, x1, x0, x1, ...] (半开区间 [x0, x1))"""
+
+    def __init__(self, width: int, height: int, rows: Dict[int, List[int]]):
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self.pixels = sum(row[i + 1] - row[i] for row in rows.values() for i in range(0, len(row), 2))
+
+    @classmethod
+    def from_image(cls, raw: bytes) -> "RegionMask":
+        width, height, lines = decode_mask_image(raw)
+        rows = {}
+        for y, line in enumerate(lines):
+            runs = [x for m in _RUN_RE.finditer(line.translate(_INSIDE)) for x in m.span()]
+            if runs:
+                rows[y] = runs
+        return cls(width, height, rows)
+
+    def contains(self, mx: int, my: int) -> bool:
+        row = self.rows.get(my)
+        if not row:
+            return False
+        i = bisect.bisect_right(row, mx)
+        return i % 2 == 1  # 落在某个 [x0, x1) 内
+
+    def to_json(self) -> dict:
+        return {"w": self.width, "h": self.height, "rows": [[y] + runs for y, runs in sorted(self.rows.items())]}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "RegionMask":
+        return cls(data["w"], data["h"], {r[0]: r[1:] for r in data["rows"]})
+
+
+def mask_key(ref: str) -> str:
+    """遮罩的内容标识：blob 引用直接用其 sha256，内联 data URL 取其哈希"""
+    m = _BLOB_DIGEST_RE.search(ref)
+    return m.group(1) if m else hashlib.sha256(ref.encode("utf-8")).hexdigest()
+
+
+class MaskStore:
+    def __init__(self, cache_dir: str, loader: Callable[[str], bytes]):
+        """loader(maskData) -> 图片字节 (blob 引用或 data URL 由调用方解析)"""
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self._masks: "OrderedDict[str, RegionMask]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, ref: str) -> RegionMask:
+        key = mask_key(ref)
+        with self._lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                mask = RegionMask.from_json(json.load(f))
+        except (OSError, ValueError, KeyError):
+            mask = RegionMask.from_image(self.loader(ref))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(mask.to_json(), f, separators=(",", ":"))
+            os.replace(tmp, path)
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > MASK_CACHE_ENTRIES:
+                self._masks.popitem(last=False)
+        return mask
+
+
+def load_mask_bytes(ref: str, blobs_dir: str) -> bytes:
+    """maskData (blob 引用 / data URL) -> 图片字节"""
+    m = _BLOB_DIGEST_RE.search(ref)
+    if m:
+        digest = m.group(1)
+        with open(os.path.join(blobs_dir, digest[:2], digest), "rb") as f:
+            return f.read()
+    if ref.startswith("data:"):
+        return base64.b64decode(ref.split(",", 1)[1])
+    raise ValueError("unsupported maskData (expected a blob reference or data URL)")
+
+
+# --- R 树 (STR 批量构建，只读) ---
+
+class RTree:
+    def __init__(self, entries: Iterable[Tuple[float, float, float, float, Any]], node_size: int = RTREE_NODE_SIZE):
+        """entries: (minx, miny, maxx, maxy, item)"""
+        self.node_size = node_size
+        level = [(e[0], e[1], e[2], e[3], e[4], None) for e in entries]  # 叶子项：children 为 None
+        self.size = len(level)
+        while len(level) > node_size:
+            level = self._pack(level)
+        self.root = (self._bounds(level), level) if level else None
+
+    @staticmethod
+    def _bounds(nodes) -> Tuple[float, float, float, float]:
+        return (min(n[0] for n in nodes), min(n[1] for n in nodes), max(n[2] for n in nodes), max(n[3] for n in nodes))
+
+    def _pack(self, nodes):
+        # Sort-Tile-Recursive：先按 x 切成竖条，每条内再按 y 分组
+        n = self.node_size
+        groups = -(-len(nodes) // n)
+        slice_count = max(1, int(groups ** 0.5 + 0.999))
+        per_slice = slice_count * n
+        nodes = sorted(nodes, key=lambda e: e[0] + e[2])
+        parents = []
+        for s in range(0, len(nodes), per_slice):
+            strip = sorted(nodes[s:s + per_slice], key=lambda e: e[1] + e[3])
+            for g in range(0, len(strip), n):
+                children = strip[g:g + n]
+                parents.append((*self._bounds(children), None, children))
+        return parents
+
+    def search(self, minx: float, miny: float, maxx: float, maxy: float) -> List[Any]:
+        """包围盒与给定矩形相交的全部项"""
+        out = []
+        if self.root is None:
+            return out
+        stack = [self.root[1]]
+        while stack:
+            for node in stack.pop():
+                if node[0] > maxx or node[2] < minx or node[1] > maxy or node[3] < miny:
+                    continue
+                if node[5] is None:
+                    out.append(node[4])
+                else:
+                    stack.append(node[5])
+        return out
+
+
+# --- 区块索引 ---
+
+class RegionEntry:
+    def __init__(self, order: int, layer_id: str, region: dict, mask: Optional[RegionMask], error: str = ""):
+        self.order = order  # 绘制顺序，越大越靠上
+        self.layer_id = layer_id
+        self.region = region
+        self.mask = mask
+        self.error = error
+        self.x, self.y = float(region.get("x", 0)), float(region.get("y", 0))
+        self.w, self.h = float(region.get("w", 0)), float(region.get("h", 0))
+        # 底图每 1% 对应的像素数；遮罩在底图像素网格上的偏移
+        self.sx = mask.width / self.w if mask and self.w else 0.0
+        self.sy = mask.height / self.h if mask and self.h else 0.0
+        self.ox, self.oy = round(self.x * self.sx), round(self.y * self.sy)
+
+    def contains(self, px: float, py: float) -> bool:
+        if not (self.x <= px <= self.x + self.w and self.y <= py <= self.y + self.h):
+            return False
+        if self.mask is None:
+            return True  # 遮罩不可用时退化为包围盒
+        mx = min(int((px - self.x) * self.sx), self.mask.width - 1)
+        my = min(int((py - self.y) * self.sy), self.mask.height - 1)
+        return self.mask.contains(mx, my)
+
+    @property
+    def area(self) -> float:
+        """占整张底图的面积百分比"""
+        if self.mask is None or not self.sx or not self.sy:
+            return self.w * self.h / 100
+        return self.mask.pixels / (self.sx * self.sy) / 100
+
+    def summary(self) -> dict:
+        r = self.region
+        out = {"id": r.get("id"), "name": r.get("name", ""), "layerId": self.layer_id, "ownerId": r.get("ownerId", ""),
+               "type": r.get("type", "territory"), "x": self.x, "y": self.y, "w": self.w, "h": self.h,
+               "centerX": r.get("centerX"), "centerY": r.get("centerY"), "area": round(self.area, 4),
+               "pixels": self.mask.pixels if self.mask else None}
+        if self.error:
+            out["error"] = self.error
+        return out
+
+
+def _contact(a: RegionEntry, b: RegionEntry, gap: int) -> int:
+    """a 中与 b 相距不超过 gap 像素的行数 (近似为共享边界长度，单位为像素)"""
+    rows_b = {}
+    for y, runs in b.mask.rows.items():
+        rows_b[y + b.oy] = ([x + b.ox for x in runs[0::2]], [x + b.ox for x in runs[1::2]])
+    count = 0
+    for y, runs in a.mask.rows.items():
+        ay = y + a.oy
+        near = [rows_b[yy] for yy in range(ay - gap, ay + gap + 1) if yy in rows_b]
+        if not near:
+            continue
+        hit = False
+        for i in range(0, len(runs), 2):
+            x0, x1 = runs[i] + a.ox - gap, runs[i + 1] + a.ox + gap
+            for starts, ends in near:
+                # b 在这一行中第一个结束点 > x0 的区间，是否在 x1 之前开始
+                j = bisect.bisect_right(ends, x0)
+                if j < len(ends) and starts[j] < x1:
+                    hit = True
+                    break
+            if hit:
+                break
+        count += hit
+    return count
+
+
+class RegionIndex:
+    def __init__(self, entries: List[RegionEntry]):
+        self.entries = entries
+        self.by_id = {e.region.get("id"): e for e in entries}
+        self.tree = RTree((e.x, e.y, e.x + e.w, e.y + e.h, e) for e in entries)
+
+    @classmethod
+    def build(cls, doc: dict, masks: MaskStore) -> "RegionIndex":
+        map_data = doc.get("map_data") or {}
+        sources = [("", map_data.get("regions") or [])]  # 旧存档的顶层 regions
+        sources += [(layer.get("id", ""), layer.get("data") or []) for layer in map_data.get("layers") or []
+                    if layer.get("type") == "region" and isinstance(layer.get("data"), list)]
+        entries = []
+        for layer_id, regions in sources:
+            for region in regions:
+                if not isinstance(region, dict):
+                    continue
+                mask, error = None, ""
+                if region.get("maskData"):
+                    try:
+                        mask = masks.get(region["maskData"])
+                    except Exception as e:
+                        error = f"mask unavailable: {e}"
+                entries.append(RegionEntry(len(entries), layer_id, region, mask, error))
+        return cls(entries)
+
+    def at(self, px: float, py: float) -> List[RegionEntry]:
+        """包含该点的区块，最上层的在前"""
+        hits = [e for e in self.tree.search(px, py, px, py) if e.contains(px, py)]
+        return sorted(hits, key=lambda e: -e.order)
+
+    def owned_by(self, owner_id: Optional[str]) -> List[RegionEntry]:
+        if owner_id is None:
+            return list(self.entries)
+        return [e for e in self.entries if e.region.get("ownerId", "") == owner_id]
+
+    def owners(self) -> Dict[str, dict]:
+        totals: Dict[str, dict] = {}
+        for e in self.entries:
+            t = totals.setdefault(e.region.get("ownerId", ""), {"regions": 0, "area": 0.0})
+            t["regions"] += 1
+            t["area"] = round(t["area"] + e.area, 4)
+        return totals
+
+    def neighbors(self, region_id: str, gap: int = ADJACENCY_GAP_PX) -> List[dict]:
+        a = self.by_id.get(region_id)
+        if a is None:
+            raise KeyError(region_id)
+        # 候选：包围盒 (外扩 gap 像素) 相交的区块
+        mx = gap / a.sx if a.sx else 0.0
+        my = gap / a.sy if a.sy else 0.0
+        out = []
+        for b in self.tree.search(a.x - mx, a.y - my, a.x + a.w + mx, a.y + a.h + my):
+            if b is a:
+                continue
+            if a.mask is None or b.mask is None or abs(a.sx - b.sx) > 0.01 * a.sx or abs(a.sy - b.sy) > 0.01 * a.sy:
+                # 缺遮罩或来自不同比例的底图：只能按包围盒判断
+                out.append({**b.summary(), "contact": None})
+                continue
+            contact = _contact(a, b, gap)
+            if contact:
+                out.append({**b.summary(), "contact": round(contact / a.sy, 4)})  # 换算成底图百分比
+        return sorted(out, key=lambda s: -(s["contact"] or 0))
+
+
+# --- 命令行：为已有存档预先转换遮罩 ---
+
+def convert_saves(files: List[str], cache_dir: str, blobs_dir: str) -> int:
+    masks = MaskStore(cache_dir, lambda ref: load_mask_bytes(ref, blobs_dir))
+    total_png = total_rle = 0
+    for path in files:
+        with open(path, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+        index = RegionIndex.build(doc, masks)
+        png = rle = failed = 0
+        for e in index.entries:
+            if e.mask is None:
+                failed += bool(e.error)
+                continue
+            try:
+                png += len(load_mask_bytes(e.region["maskData"], blobs_dir))
+            except (OSError, ValueError):
+                pass
+            rle += len(json.dumps(e.mask.to_json(), separators=(",", ":")))
+        total_png, total_rle = total_png + png, total_rle + rle
+        print(f"{path}: {len(index.entries)} regions, PNG masks {png / 1024:.1f} KB -> RLE {rle / 1024:.1f} KB"
+              + (f", {failed} failed" if failed else ""))
+    print(f"total: {total_png / 1024:.1f} KB -> {total_rle / 1024:.1f} KB")
+    return 0
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 2 or argv[0] != "convert":
+        print(__doc__)
+        return 2
+    files = [p for pattern in argv[1:] for p in (glob.glob(pattern) or [pattern])]
+    return convert_saves(files, os.path.join("cache", "region_masks"), "blobs")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+"""
+存档目录索引：为每个存档维护一条摘要 (回合数、最近回合时间、势力数、大小、修改时间、地图缩略图)，
+读档对话框一次请求拿到全部信息，无需逐个加载存档。
+
+- 存档/打补丁/删除时由服务端直接更新对应条目 (手头已有文档，摘要是 O(1) 的)
+- 列表时用存储后端的 stamp (文件 mtime/大小、SQLite 修订号) 校验，
+  只有被外部改动过的存档 (如手工拷贝进 saves/) 才会重新加载并生成摘要
+- 索引按后端分别持久化到 cache/，重启后无需重建；写盘延迟到下一次列表或进程退出
+"""
+import atexit
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from storage import SaveStorage, atomic_write
+
+
+def summarize_save(doc: dict) -> Dict[str, Any]:
+    timeline = doc.get("timeline") or []
+    players = doc.get("players") or []
+    last = timeline[-1] if timeline else {}
+    protagonist = next((p.get("name") for p in players if p.get("isProtagonist")), None)
+    layers = (doc.get("map_data") or {}).get("layers") or []
+    return {
+        "turns": len(timeline),
+        "lastTurnId": last.get("id"),
+        "lastTimeRange": last.get("timeRange", ""),
+        "events": sum(len(t.get("events") or []) for t in timeline),
+        "factions": len(players),
+        "protagonist": protagonist,
+        "lore": len(doc.get("lorebook") or []),
+        "layers": len(layers),
+        "revision": doc.get("revision", 0),
+        "branch": {"parent": doc["branch"]["parent"], "turns": doc["branch"]["turns"]} if doc.get("branch") else None,
+    }
+
+
+class SaveCatalog:
+    def __init__(self, cache_dir: str, thumbnailer: Optional[Callable[[dict], Optional[str]]] = None,
+                 lock: Optional[Callable[[str], Any]] = None):
+        """
+        thumbnailer(doc) -> 缩略图 URL 或 None
+        lock(name) -> 上下文管理器，加载存档时持有 (与服务端读写存档共用)
+        """
+        self.cache_dir = cache_dir
+        self.thumbnailer = thumbnailer
+        self.load_lock = lock
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, dict]] = {}  # 后端名 -> {存档名 -> 条目}
+        self._dirty = set()
+        atexit.register(self.flush)
+
+    def _path(self, backend: str) -> str:
+        return os.path.join(self.cache_dir, f"save_catalog.{backend}.json")
+
+    def _table(self, backend: str) -> Dict[str, dict]:
+        table = self._entries.get(backend)
+        if table is None:
+            table = {}
+            try:
+                with open(self._path(backend), "r", encoding="utf-8") as f:
+                    table = json.load(f).get("saves", {})
+            except (OSError, ValueError):
+                pass
+            self._entries[backend] = table
+        return table
+
+    def _build(self, storage: SaveStorage, name: str, doc: dict) -> Optional[dict]:
+        stamp = storage.stamp(name)
+        if stamp is None:
+            return None
+        entry = {"name": name, "stamp": stamp, **storage.stat(name), **summarize_save(doc)}
+        entry["thumbnail"] = self.thumbnailer(doc) if self.thumbnailer else None
+        return entry
+
+    def update(self, storage: SaveStorage, name: str, doc: dict):
+        entry = self._build(storage, name, doc)
+        with self._lock:
+            table = self._table(storage.name)
+            if entry is None:
+                table.pop(name, None)
+            else:
+                table[name] = entry
+            self._dirty.add(storage.name)
+
+    def remove(self, storage: SaveStorage, name: str):
+        with self._lock:
+            if self._table(storage.name).pop(name, None) is not None:
+                self._dirty.add(storage.name)
+
+    def revision(self, storage: SaveStorage, name: str) -> Optional[int]:
+        """目录里记录的修订号；条目与存档当前的 stamp 不符 (其他进程改过、或从未收录) 时返回 None"""
+        stamp = storage.stamp(name)
+        with self._lock:
+            entry = self._table(storage.name).get(name)
+        if entry is None or stamp is None or entry.get("stamp") != stamp:
+            return None
+        return entry.get("revision")
+
+    def list(self, storage: SaveStorage) -> List[dict]:
+        names = storage.list_saves()
+        with self._lock:
+            table = self._table(storage.name)
+            stale = [n for n in names if n not in table or table[n].get("stamp") != storage.stamp(n)]
+            removed = [n for n in table if n not in set(names)]
+            for n in removed:
+                del table[n]
+            if removed:
+                self._dirty.add(storage.name)
+
+        for name in stale:
+            try:
+                if self.load_lock is not None:
+                    with self.load_lock(name):
+                        self.update(storage, name, storage.load(name))
+                else:
+                    self.update(storage, name, storage.load(name))
+            except Exception as e:
+                # 损坏的存档也列出来，只是没有摘要
+                with self._lock:
+                    self._table(storage.name)[name] = {"name": name, "stamp": storage.stamp(name),
+                                                       "error": str(e)}
+
+        self.flush()
+        with self._lock:
+            table = self._table(storage.name)
+            return [{k: v for k, v in table[n].items() if k != "stamp"} for n in names if n in table]
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            snapshots = {b: dict(self._entries.get(b, {})) for b in dirty}
+        for backend, table in snapshots.items():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # 派生数据，不必 fsync；多个 worker 都会写，由 atomic_write 保证不会写出半个文件
+            atomic_write(self._path(backend), json.dumps({"saves": table}, ensure_ascii=False).encode("utf-8"),
+                         durable=False)
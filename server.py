@@ -1,48 +1,106 @@
 import uvicorn
 import webbrowser
+import argparse
 from fastapi import FastAPI, HTTPException, Body, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, Response
-from pydantic import BaseModel
-from typing import List, Dict, Any
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from typing import List, Dict, Any, Optional
 import json
-from fastapi.staticfiles import StaticFiles
 import os
 import time
+import copy
+import asyncio
+import hashlib
+import mimetypes
+import random
+import threading
 import logging
-from logging.handlers import RotatingFileHandler
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import tempfile
 
 # --- 新增依赖 ---
-import google.generativeai as genai
-from openai import OpenAI  # 用于支持 DeepSeek, Qwen, Yi, Local LLM 等
-import anthropic # 新增 Claude 支持
 import base64
 import io
 import re  # <--- 新增正则模块，用于精准清洗 Base64
-from pypdf import PdfReader  # 用于解析 PDF
-from docx import Document    # 用于解析 Word
+
+# [新增] 大模型 SDK 与文档解析库按需导入 (第一次用到时才加载)，启动后在后台预热，见 lazy_import.py
+from lazy_import import lazy_module, warm_up
+genai = lazy_module("google.generativeai")
+glm = lazy_module("google.ai.generativelanguage")  # Gemini 的底层 gRPC 客户端 (按 apiKey/代理 各建一个)
+openai = lazy_module("openai")        # 用于支持 DeepSeek, Qwen, Yi, Local LLM 等
+anthropic = lazy_module("anthropic")  # 新增 Claude 支持
+pypdf = lazy_module("pypdf")          # 用于解析 PDF
+docx = lazy_module("docx")            # 用于解析 Word
+
+try:
+    import orjson  # [新增] 可选依赖：更快的 JSON 编解码，未安装时回退到标准库
+except ImportError:
+    orjson = None
+
+from lore_index import LoreIndex
+from storage import BRANCH_KEY, BranchStorage, SaveLocks, SaveStorage, SqliteStorage, append_durable, atomic_write
+from context_assembler import assemble_context
+from formula_engine import FormulaEngine, TARGET_KEYS as FORMULA_TARGET_KEYS
+from log_pipeline import setup_logging
+from pdf_worker import extract_pages as extract_pdf_pages
+from metrics import registry as metrics_registry, SIZE_BUCKETS
+from save_catalog import SaveCatalog
+from static_assets import AssetCache, CachedStaticFiles
+from region_index import ADJACENCY_GAP_PX, MaskStore, RegionIndex, load_mask_bytes
+from migrations import CURRENT_SCHEMA_VERSION, SCHEMA_VERSION_KEY, migrate_document, needs_migration
 
 # --- 0. 目录与日志设置 ---
 SAVES_DIR = "saves"
 LOGS_DIR = "logs"
+BLOBS_DIR = "blobs"  # [新增] 图片/遮罩/立绘的内容寻址存储，所有存档共享
+DOCUMENTS_DIR = "documents"  # [新增] 文档库元数据与提取出的文本 (原文件存在 blobs/)
+CACHE_DIR = "cache"          # [新增] 可随时删除的派生数据 (附件解析结果、存档目录索引、缩略图)
 
-for d in [SAVES_DIR, LOGS_DIR]:
+# [新增] 存档/增量日志/blob 写盘后 fsync：崩溃或断电后不会留下截断的文件 (关闭可提速，但断电可能丢失最近一次保存)
+SAVE_FSYNC = True
+# [新增] 多 worker 部署 (python server.py --workers N) 时由启动器写入环境变量，各 worker 进程据此调整日志轮转
+WORKERS_ENV = "LEVANT_WORKERS"
+WORKER_COUNT = int(os.environ.get(WORKERS_ENV, "1") or 1)
+
+for d in [SAVES_DIR, LOGS_DIR, BLOBS_DIR, DOCUMENTS_DIR]:
     if not os.path.exists(d):
         os.makedirs(d)
 
 # 配置日志：同时输出到控制台和文件
+# ★★★ [新增] 异步结构化日志：请求线程只入队，脱敏/序列化/写盘在后台线程完成 ★★★
+LOG_ASYNC = True                 # False 时退回同步写日志 (调试用)
+LOG_JSON = True                  # 文件日志为 JSON Lines；控制台保持文本格式
+LOG_PAYLOAD_MAX_CHARS = 20000    # 单个字段 (Prompt / 回复) 的最大记录长度，0 = 不截断
+LOG_PAYLOAD_SAMPLE_RATE = 1.0    # 记录完整 payload 的比例，其余只记录消息行
+LOG_MAX_BYTES = 5 * 1024 * 1024  # 单个日志文件上限；多 worker 时不轮转 (多个进程同时改名会互相覆盖)，改由外部 logrotate 处理
+
 log_file_path = os.path.join(LOGS_DIR, "system.log")
-logging.basicConfig(
+log_listener = setup_logging(
+    log_file_path,
     level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        RotatingFileHandler(log_file_path, maxBytes=5*1024*1024, backupCount=3, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
+    async_mode=LOG_ASYNC,
+    json_lines=LOG_JSON,
+    payload_max_chars=LOG_PAYLOAD_MAX_CHARS,
+    payload_sample_rate=LOG_PAYLOAD_SAMPLE_RATE,
+    redactor=lambda obj: smart_clean_payload(obj),  # 只在日志真正输出时执行
+    max_bytes=LOG_MAX_BYTES if WORKER_COUNT == 1 else 0,
 )
 logger = logging.getLogger("Levant")
 
-app = FastAPI(title="LevantD Engine Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动时在后台预热 SDK、预载页面 (start_warm_up 定义在后面，这里调用时已经存在)
+    start_warm_up()
+    yield
+
+app = FastAPI(title="LevantD Engine Backend", lifespan=lifespan)
 
 # --- ★★★ [新增] 挂载静态音频目录 ★★★ ---
 # 这一步告诉后端：如果有人访问 /sounds/xxx，就去 www/sounds 文件夹找
@@ -50,7 +108,9 @@ if not os.path.exists("www/sounds"):
     os.makedirs("www/sounds") # 如果没有文件夹，自动创建一个
 
 # 将 /sounds 路径映射到 www/sounds 文件夹
-app.mount("/sounds", StaticFiles(directory="www/sounds"), name="sounds")
+# [新增] 支持 Range 请求 (拖动进度)，浏览器缓存一周，之后凭 ETag 校验
+SOUNDS_CACHE_CONTROL = "public, max-age=604800"
+app.mount("/sounds", CachedStaticFiles(directory="www/sounds", cache_control=SOUNDS_CACHE_CONTROL), name="sounds")
 
 
 # --- 全局异常捕获中间件 (记录所有未捕获的错误) ---
@@ -62,6 +122,63 @@ async def log_exceptions(request: Request, call_next):
         logger.error(f"Unhandled Exception on {request.url.path}: {str(e)}", exc_info=True)
         return JSONResponse(status_code=500, content={"detail": "Internal Server Error. Check logs."})
 
+# ★★★ [新增] 运行指标：GET /metrics (Prometheus 文本格式) ★★★
+HTTP_REQUESTS = metrics_registry.counter(
+    "levant_http_requests_total", "HTTP requests by route and status", ["method", "route", "status"])
+HTTP_LATENCY = metrics_registry.histogram(
+    "levant_http_request_duration_seconds", "Time until response headers are sent", ["method", "route"])
+HTTP_REQUEST_SIZE = metrics_registry.histogram(
+    "levant_http_request_size_bytes", "Request body size (Content-Length)", ["method", "route"], SIZE_BUCKETS)
+HTTP_RESPONSE_SIZE = metrics_registry.histogram(
+    "levant_http_response_size_bytes", "Response body size (Content-Length)", ["method", "route"], SIZE_BUCKETS)
+ATTACHMENT_EXTRACT = metrics_registry.histogram(
+    "levant_attachment_extract_seconds", "Attachment text extraction time", ["kind"])
+AI_LATENCY = metrics_registry.histogram(
+    "levant_ai_request_duration_seconds", "AI provider call duration", ["provider", "model", "mode"])
+AI_REQUESTS = metrics_registry.counter(
+    "levant_ai_requests_total", "AI provider calls by outcome (ok / error / cached)", ["provider", "model", "outcome"])
+AI_TOKENS = metrics_registry.counter(
+    "levant_ai_tokens_total", "Tokens reported by the provider", ["provider", "model", "direction"])
+
+def _route_label(request: Request) -> str:
+    # 用路由模板而不是实际路径，避免 /api/blobs/{name} 之类产生无限多的标签
+    route = request.scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    if request.url.path.startswith("/sounds/"):
+        return "/sounds"
+    return "<unmatched>"
+
+@app.middleware("http")
+async def collect_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await call_next(request)
+        return response
+    finally:
+        # 流式响应 (SSE) 只统计到响应头发出为止，完整耗时见 levant_ai_request_duration_seconds
+        method, route = request.method, _route_label(request)
+        HTTP_LATENCY.observe(time.perf_counter() - started, method, route)
+        HTTP_REQUESTS.inc(method, route, str(response.status_code if response is not None else 500))
+        if request.headers.get("content-length"):
+            HTTP_REQUEST_SIZE.observe(int(request.headers["content-length"]), method, route)
+        if response is not None and response.headers.get("content-length"):
+            HTTP_RESPONSE_SIZE.observe(int(response.headers["content-length"]), method, route)
+
+def record_ai_call(req: "AIRequest", mode: str, started: float, outcome: str, usage: dict = None):
+    provider, model = req.provider.lower(), req.model or ""
+    AI_REQUESTS.inc(provider, model, outcome)
+    if outcome != "cached":
+        AI_LATENCY.observe(time.perf_counter() - started, provider, model, mode)
+    for direction, count in (usage or {}).items():
+        if count:
+            AI_TOKENS.inc(provider, model, direction, amount=count)
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(content=metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- 2. CORS 设置 ---
 app.add_middleware(
     CORSMiddleware,
@@ -69,6 +186,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],  # [新增] 跨域的前端也要读到存档修订号
 )
 
 # --- 数据模型 (全员防爆版) ---
@@ -217,6 +335,10 @@ class Turn(BaseModel):
     events: List[TimelineEvent] = []
 
 class GameState(BaseModel):
+    # [新增] 存档结构版本，低于 migrations.CURRENT_SCHEMA_VERSION 的存档在首次读取时升级并写回
+    schemaVersion: int = 0
+    # [新增] 修订号，服务端每次写入 +1 (客户端读档拿到的 ETag)
+    revision: int = 0
     global_vars: List[GlobalVar] = []
     
     # ★★★ 确保这里定义正确
@@ -245,102 +367,1092 @@ class AIRequest(BaseModel):
     proxyPort: str = "7890"
     # 新增: 附件列表，格式为 [{"type": "image/png", "data": "base64..."}, {"type": "text/plain", "data": "文本内容..."}]
     attachments: List[Dict[str, str]] = [] 
+    # [新增] 已通过 /api/documents 上传的文档 ID，代替内联 Base64
+    attachmentIds: List[str] = []
+    # [新增] 缓存选项
+    cache: bool = False          # 启用服务端响应缓存 (相同请求直接返回上次结果)
+    bypassCache: bool = False    # 跳过缓存命中，强制重新生成并刷新缓存
+    promptCache: bool = False    # 启用提供商原生的提示词缓存 (Claude cache_control)
 
 # --- API 路由 ---
 
 @app.get("/api/saves")
-def get_saves_list():
+def get_saves_list(details: bool = False):
     try:
-        files = [f for f in os.listdir(SAVES_DIR) if f.endswith('.json')]
+        files = save_storage.list_saves()
         logger.info(f"Loaded save list: {len(files)} files found.")
+        if details:
+            # [新增] 附带每个存档的摘要 (回合数、势力数、大小、缩略图…)，来自目录索引
+            return {"files": sorted(files), "saves": save_catalog.list(save_storage)}
         return {"files": sorted(files)}
     except Exception as e:
         logger.error(f"Error fetching save list: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/state", response_model=GameState)
-def get_state(filename: str):
-    filepath = os.path.join(SAVES_DIR, filename)
-    if filename == 'savegame.json' and not os.path.exists(filepath) and os.path.exists("savegame.json"):
-        filepath = "savegame.json"
-    
-    if not os.path.exists(filepath):
+# --- [新增] 内容寻址 Blob 存储 ---
+# 存档里的 data:...;base64 大字段 (地图图层、地块遮罩、立绘) 抽出来按 sha256 存到 blobs/，
+# JSON 里只保留 "/api/blobs/<sha256>.<ext>" 引用。相同图片在所有存档间只存一份。
+BLOB_URL_PREFIX = "/api/blobs/"
+BLOB_MIN_INLINE_SIZE = 1024  # 小于这个长度的 data URL 直接内联，不值得单独存
+BLOB_GC_GRACE_SECONDS = 3600  # 新写入的 blob 可能还没来得及被存档引用 (其他 worker 的保存正在进行)，GC 时跳过
+_DATA_URL_RE = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(?:;[\w=.+-]+)*;base64,', re.IGNORECASE)
+_BLOB_REF_RE = re.compile(r'/api/blobs/([0-9a-f]{64})')
+
+def _blob_path(digest: str) -> str:
+    return os.path.join(BLOBS_DIR, digest[:2], digest)
+
+def store_blob_bytes(raw: bytes) -> str:
+    """把原始字节写入 blob 目录 (已存在则跳过)，返回 sha256"""
+    digest = hashlib.sha256(raw).hexdigest()
+    path = _blob_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, raw, durable=SAVE_FSYNC)
+    return digest
+
+def store_blob(data_url: str) -> str:
+    """把一个 data URL 写入 blob 目录，返回引用 URL"""
+    m = _DATA_URL_RE.match(data_url)
+    mime = (m.group(1) or "application/octet-stream").lower()
+    digest = store_blob_bytes(base64.b64decode(data_url[m.end():].strip(), validate=False))
+    ext = mimetypes.guess_extension(mime) or ".bin"
+    return f"{BLOB_URL_PREFIX}{digest}{ext}"
+
+def load_blob_as_data_url(ref: str) -> str:
+    name = ref[len(BLOB_URL_PREFIX):]
+    digest = name.split(".", 1)[0]
+    mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    with open(_blob_path(digest), "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')}"
+
+def externalize_blobs(obj, stored: Optional[list] = None):
+    """递归把大 data URL 换成 blob 引用 (原地修改 dict/list，返回新值)；stored 不为 None 时收集新换出的引用"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            obj[k] = externalize_blobs(v, stored)
+        return obj
+    if isinstance(obj, list):
+        for i, v in enumerate(obj):
+            obj[i] = externalize_blobs(v, stored)
+        return obj
+    if isinstance(obj, str) and len(obj) >= BLOB_MIN_INLINE_SIZE and obj.startswith("data:") and _DATA_URL_RE.match(obj):
+        try:
+            ref = store_blob(obj)
+            if stored is not None:
+                stored.append(ref)
+            return ref
+        except Exception as e:
+            logger.warning(f"Blob externalize failed, keeping inline data: {e}")
+    return obj
+
+def inline_blob_refs(obj):
+    """externalize_blobs 的逆操作，用于导出可独立使用的存档"""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            obj[k] = inline_blob_refs(v)
+        return obj
+    if isinstance(obj, list):
+        for i, v in enumerate(obj):
+            obj[i] = inline_blob_refs(v)
+        return obj
+    if isinstance(obj, str) and obj.startswith(BLOB_URL_PREFIX):
+        try:
+            return load_blob_as_data_url(obj)
+        except OSError:
+            logger.warning(f"Missing blob referenced by save: {obj}")
+    return obj
+
+# --- [新增] 快速 JSON 序列化 ---
+STATE_JSON_PRETTY = False  # 存档是否缩进输出 (便于手工查看，但体积更大、写入更慢)
+STATE_TRUST_SAVED = True   # 读档时信任磁盘上的存档 (写入时已校验)，不再经 GameState 二次校验
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_bytes(obj, pretty: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def state_document(state: "GameState") -> dict:
+    """存档入库前的统一出口：抽出 blob，得到可直接存储的文档"""
+    return externalize_blobs(state.model_dump())
+
+def dump_state_json(state: "GameState") -> bytes:
+    return json_dumps_bytes(state_document(state), pretty=STATE_JSON_PRETTY)
+
+# --- [新增] 增量存档 (JSON Patch 日志 + 定期压缩) ---
+# 每个存档 xxx.json 旁边维护一个 xxx.json.journal，每行一批 JSON-Patch 操作。
+# 读档时 = 快照 + 重放日志；日志过长时压缩回快照。
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_COMPACT_ENTRIES = 200            # 日志条数上限
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024  # 日志体积上限
+STATE_CACHE_SIZE = 4                     # 内存中缓存的已展开存档数量
+REVISION_KEY = "revision"                # [新增] 存档修订号，每次写入 +1 (乐观并发的 ETag；日志行也记录它)
+
+_state_cache: "OrderedDict[str, tuple]" = OrderedDict()  # filepath -> (stamp, doc)
+# 只保护各个缓存字典本身 (_state_cache / _region_indexes / _formula_engines)；存档内容的读写互斥见 save_lock
+_cache_lock = threading.Lock()
+
+# 由服务端维护的顶层字段：界面状态里没有它们，补丁中触及它们的操作一律忽略
+SERVER_MANAGED_KEYS = (REVISION_KEY, SCHEMA_VERSION_KEY, BRANCH_KEY)
+
+class StatePatch(BaseModel):
+    ops: List[Dict[str, Any]] = []
+
+class JsonPatchError(Exception):
+    pass
+
+def strip_managed_ops(ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """去掉 path/from 落在服务端维护字段上的操作 (旧版前端会把这些字段当成已删除)"""
+    def root(path):
+        # 非法指针留给 apply_json_patch 报错
+        if not isinstance(path, str) or not path.startswith("/"):
+            return None
+        return path[1:].split("/")[0].replace("~1", "/").replace("~0", "~")
+    return [op for op in ops
+            if root(op.get("path")) not in SERVER_MANAGED_KEYS and root(op.get("from")) not in SERVER_MANAGED_KEYS]
+
+def _parse_pointer(path: str) -> List[str]:
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise JsonPatchError(f"Invalid JSON pointer: {path}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+def _resolve_parent(doc, tokens: List[str]):
+    node = doc
+    for tok in tokens[:-1]:
+        if isinstance(node, list):
+            try:
+                node = node[int(tok)]
+            except (ValueError, IndexError):
+                raise JsonPatchError(f"Path segment not found: {tok}")
+        elif isinstance(node, dict):
+            if tok not in node:
+                raise JsonPatchError(f"Path segment not found: {tok}")
+            node = node[tok]
+        else:
+            raise JsonPatchError(f"Cannot traverse into scalar at: {tok}")
+    return node
+
+def _list_index(node: list, tok: str, allow_end: bool) -> int:
+    if allow_end and tok == "-":
+        return len(node)
+    try:
+        idx = int(tok)
+    except ValueError:
+        raise JsonPatchError(f"Invalid array index: {tok}")
+    limit = len(node) if allow_end else len(node) - 1
+    if idx < 0 or idx > limit:
+        raise JsonPatchError(f"Array index out of range: {tok}")
+    return idx
+
+def _pointer_get(doc, path: str):
+    tokens = _parse_pointer(path)
+    if not tokens:
+        return doc
+    parent = _resolve_parent(doc, tokens)
+    tok = tokens[-1]
+    if isinstance(parent, list):
+        return parent[_list_index(parent, tok, allow_end=False)]
+    if isinstance(parent, dict) and tok in parent:
+        return parent[tok]
+    raise JsonPatchError(f"Path not found: {path}")
+
+def _pointer_add(doc, path: str, value):
+    tokens = _parse_pointer(path)
+    if not tokens:
+        raise JsonPatchError("Replacing the document root is not allowed")
+    parent = _resolve_parent(doc, tokens)
+    tok = tokens[-1]
+    if isinstance(parent, list):
+        parent.insert(_list_index(parent, tok, allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[tok] = value
+    else:
+        raise JsonPatchError(f"Cannot add into scalar at: {path}")
+
+def _pointer_remove(doc, path: str):
+    tokens = _parse_pointer(path)
+    if not tokens:
+        raise JsonPatchError("Removing the document root is not allowed")
+    parent = _resolve_parent(doc, tokens)
+    tok = tokens[-1]
+    if isinstance(parent, list):
+        return parent.pop(_list_index(parent, tok, allow_end=False))
+    if isinstance(parent, dict) and tok in parent:
+        return parent.pop(tok)
+    raise JsonPatchError(f"Path not found: {path}")
+
+def apply_json_patch(doc, ops: List[Dict[str, Any]]):
+    """按 RFC 6902 的子集 (add/remove/replace/move/copy/test) 原地修改 doc"""
+    for op in ops:
+        kind = op.get("op")
+        path = op.get("path", "")
+        if kind == "add":
+            _pointer_add(doc, path, op.get("value"))
+        elif kind == "remove":
+            _pointer_remove(doc, path)
+        elif kind == "replace":
+            _pointer_get(doc, path)  # 目标必须存在
+            tokens = _parse_pointer(path)
+            parent = _resolve_parent(doc, tokens)
+            if isinstance(parent, list):
+                parent[_list_index(parent, tokens[-1], allow_end=False)] = op.get("value")
+            else:
+                parent[tokens[-1]] = op.get("value")
+        elif kind == "move":
+            value = _pointer_remove(doc, op.get("from", ""))
+            _pointer_add(doc, path, value)
+        elif kind == "copy":
+            _pointer_add(doc, path, copy.deepcopy(_pointer_get(doc, op.get("from", ""))))
+        elif kind == "test":
+            if _pointer_get(doc, path) != op.get("value"):
+                raise JsonPatchError(f"Test failed at: {path}")
+        else:
+            raise JsonPatchError(f"Unsupported op: {kind}")
+    return doc
+
+# [新增] 补丁落盘前只校验它触及的部分：被改动的顶层字段，timeline 只校验被改动的回合
+_STATE_FIELD_ADAPTERS = {k: TypeAdapter(f.annotation) for k, f in GameState.model_fields.items()}
+_TURN_ADAPTER = TypeAdapter(Turn)
+
+def validate_patched(doc: dict, ops: List[Dict[str, Any]]):
+    """doc 已经应用了 ops；不符合 GameState 时抛 ValidationError (此时不能写入日志，否则压缩和读档都会失败)"""
+    keys, turns = set(), set()
+    for op in ops:
+        for path in (op.get("path"), op.get("from")):
+            tokens = _parse_pointer(path) if path is not None else []
+            if not tokens or tokens[0] not in _STATE_FIELD_ADAPTERS:
+                continue
+            if tokens[0] == "timeline" and len(tokens) > 1 and "timeline" not in keys:
+                turns.add(tokens[1])
+            else:
+                keys.add(tokens[0])
+    for key in keys:
+        if key in doc:
+            _STATE_FIELD_ADAPTERS[key].validate_python(doc[key])
+    timeline = doc.get("timeline", [])
+    if "timeline" in keys or not isinstance(timeline, list):
+        return
+    for tok in turns:
+        idx = len(timeline) - 1 if tok == "-" else (int(tok) if tok.isdigit() else None)
+        # 被删掉的末尾回合不需要校验
+        if idx is not None and idx < len(timeline):
+            _TURN_ADAPTER.validate_python(timeline[idx])
+
+def _journal_path(filepath: str) -> str:
+    return filepath + JOURNAL_SUFFIX
+
+def _state_stamp(filepath: str):
+    """快照与日志的 (mtime, size) 组合，用于判断缓存是否过期"""
+    st = os.stat(filepath)
+    jpath = _journal_path(filepath)
+    jsize = os.path.getsize(jpath) if os.path.exists(jpath) else 0
+    return (st.st_mtime_ns, st.st_size, jsize)
+
+def _read_journal(filepath: str) -> List[tuple]:
+    """返回 [(修订号或 None, ops)]"""
+    jpath = _journal_path(filepath)
+    if not os.path.exists(jpath):
+        return []
+    entries = []
+    with open(jpath, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json_loads(line)
+                entries.append((entry.get("rev"), entry["ops"]))
+            except Exception:
+                # 最后一行可能在崩溃时只写了一半，丢弃即可
+                logger.warning(f"Skipping corrupted journal line in {jpath}")
+    return entries
+
+def load_state_document(filepath: str) -> dict:
+    """读取快照并重放增量日志，结果缓存在内存中"""
+    stamp = _state_stamp(filepath)
+    with _cache_lock:
+        cached = _state_cache.get(filepath)
+        if cached and cached[0] == stamp:
+            _state_cache.move_to_end(filepath)
+            return cached[1]
+
+    with open(filepath, "rb") as f:
+        data = json_loads(f.read())
+    base_rev = data.get(REVISION_KEY, 0)
+    for rev, ops in _read_journal(filepath):
+        if rev is not None and rev <= base_rev:
+            # 快照已经包含这一行 (压缩/全量保存写完快照后、删除日志前崩溃)，不能重放第二次
+            continue
+        try:
+            apply_json_patch(data, ops)
+        except JsonPatchError as e:
+            logger.warning(f"Journal replay stopped for {filepath}: {e}")
+            break
+    # 旧存档里还内联着 base64：读出时换成引用并立即写回 (调用方持有 save_lock)。
+    # 只改内存的话，磁盘上仍是内联数据，blob GC 扫描存档文件时会把这些刚存入的 blob 当成无人引用删掉。
+    stored = []
+    externalize_blobs(data, stored)
+    if stored and _state_stamp(filepath) == stamp:  # 读档期间文件被别处改写过就不写回，下次读档再换
+        atomic_write(filepath, json_dumps_bytes(data, pretty=STATE_JSON_PRETTY), durable=SAVE_FSYNC)
+        if os.path.exists(_journal_path(filepath)):
+            os.remove(_journal_path(filepath))
+        stamp = _state_stamp(filepath)
+        logger.info(f"Inline images moved to blob store: {filepath} ({len(stored)} blobs)")
+
+    _remember_state(filepath, stamp, data)
+    return data
+
+def _remember_state(filepath: str, stamp, data: dict):
+    with _cache_lock:
+        _state_cache[filepath] = (stamp, data)
+        _state_cache.move_to_end(filepath)
+        while len(_state_cache) > STATE_CACHE_SIZE:
+            _state_cache.popitem(last=False)
+
+def _forget_state(filepath: str):
+    with _cache_lock:
+        _state_cache.pop(filepath, None)
+
+def compact_journal(filepath: str, data: dict):
+    """把展开后的状态写回快照，并清空日志"""
+    state = GameState.model_validate(data)
+    atomic_write(filepath, dump_state_json(state), durable=SAVE_FSYNC)
+    jpath = _journal_path(filepath)
+    if os.path.exists(jpath):
+        os.remove(jpath)
+    _forget_state(filepath)
+
+# --- [新增] 可插拔存储层 ---
+# 读档/存档/补丁/删除都经由 save_storage，默认仍是每个存档一个 JSON 文件。
+STORAGE_BACKEND = "json"                              # "json" | "sqlite"
+SQLITE_DB_PATH = os.path.join(SAVES_DIR, "levant.db")  # STORAGE_BACKEND = "sqlite" 时使用
+
+class JsonFileStorage(SaveStorage):
+    """saves/xxx.json 快照 + xxx.json.journal 增量日志"""
+    name = "json"
+
+    def __init__(self):
+        # 日志路径 -> (文件大小, 行数)：追加前的大小对得上就直接 +1，否则 (其他进程写过/压缩过) 重新数一遍
+        self._journal_lines: Dict[str, tuple] = {}
+
+    def path(self, name: str) -> str:
+        filepath = os.path.join(SAVES_DIR, name)
+        if name == 'savegame.json' and not os.path.exists(filepath) and os.path.exists("savegame.json"):
+            filepath = "savegame.json"
+        return filepath
+
+    def list_saves(self) -> List[str]:
+        return sorted(f for f in os.listdir(SAVES_DIR) if f.endswith('.json'))
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def load(self, name: str) -> dict:
+        return load_state_document(self.path(name))
+
+    def save(self, name: str, doc: dict):
+        filepath = os.path.join(SAVES_DIR, name)
+        # [新增] 先写临时文件再替换：崩溃或并发保存不会留下截断/交错的存档
+        atomic_write(filepath, json_dumps_bytes(doc, pretty=STATE_JSON_PRETTY), durable=SAVE_FSYNC)
+        # 全量存档后，旧的增量日志作废
+        jpath = _journal_path(filepath)
+        if os.path.exists(jpath):
+            os.remove(jpath)
+        self._journal_lines.pop(jpath, None)
+        _forget_state(filepath)
+
+    def commit_patch(self, name: str, doc: dict, ops: List[Dict[str, Any]]) -> int:
+        filepath = self.path(name)
+        jpath = _journal_path(filepath)
+        entry = {"ts": time.time(), "rev": doc.get(REVISION_KEY), "ops": ops}
+        line = json_dumps_bytes(entry) + b"\n"
+        append_durable(jpath, line, durable=SAVE_FSYNC)
+
+        size = os.path.getsize(jpath)
+        known = self._journal_lines.get(jpath)
+        if known and known[0] == size - len(line):
+            entries = known[1] + 1
+        else:
+            with open(jpath, "rb") as f:
+                entries = sum(1 for _ in f)
+        self._journal_lines[jpath] = (size, entries)
+
+        if entries >= JOURNAL_COMPACT_ENTRIES or size >= JOURNAL_COMPACT_BYTES:
+            try:
+                compact_journal(filepath, doc)
+            except Exception as e:
+                # 补丁已经落盘，压缩失败不影响这次保存，下次补丁再试
+                logger.error(f"Journal compaction failed for {name}: {e}")
+            else:
+                self._journal_lines.pop(jpath, None)
+                logger.info(f"Journal compacted: {name} ({entries} entries)")
+                return 0
+        _remember_state(filepath, _state_stamp(filepath), doc)
+        return entries
+
+    def delete(self, name: str) -> bool:
+        filepath = os.path.join(SAVES_DIR, name)
+        if not os.path.exists(filepath):
+            return False
+        os.remove(filepath)
+        if os.path.exists(_journal_path(filepath)):
+            os.remove(_journal_path(filepath))
+        self._journal_lines.pop(_journal_path(filepath), None)
+        _forget_state(filepath)
+        return True
+
+    def invalidate(self, name: str):
+        _forget_state(self.path(name))
+
+    def _stats(self, name: str):
+        filepath = self.path(name)
+        try:
+            snap = os.stat(filepath)
+        except FileNotFoundError:
+            return None, None
+        try:
+            journal = os.stat(_journal_path(filepath))
+        except FileNotFoundError:
+            journal = None
+        return snap, journal
+
+    def stamp(self, name: str):
+        snap, journal = self._stats(name)
+        if snap is None:
+            return None
+        return [snap.st_mtime_ns, snap.st_size] + ([journal.st_mtime_ns, journal.st_size] if journal else [])
+
+    def stat(self, name: str) -> dict:
+        snap, journal = self._stats(name)
+        if snap is None:
+            raise FileNotFoundError(name)
+        if journal is None:
+            return {"size": snap.st_size, "mtime": snap.st_mtime}
+        return {"size": snap.st_size + journal.st_size, "mtime": max(snap.st_mtime, journal.st_mtime)}
+
+    def blob_refs_text(self):
+        # 直接扫描原始文件 (含增量日志)，不必解析
+        for f in os.listdir(SAVES_DIR):
+            path = os.path.join(SAVES_DIR, f)
+            if os.path.isfile(path) and (f.endswith(".json") or f.endswith(JOURNAL_SUFFIX)):
+                with open(path, "r", encoding="utf-8", errors="ignore") as fh:
+                    yield fh.read()
+
+def create_storage() -> SaveStorage:
+    if STORAGE_BACKEND == "sqlite":
+        inner = SqliteStorage(SQLITE_DB_PATH, cache_size=STATE_CACHE_SIZE, on_load=externalize_blobs,
+                              durable=SAVE_FSYNC)
+    else:
+        inner = JsonFileStorage()
+    # [新增] 分支存档 (写时复制) 包在具体后端之外，分支索引按后端分别存放
+    return BranchStorage(inner, os.path.join(SAVES_DIR, f"branches.{inner.name}.idx"), cache_size=STATE_CACHE_SIZE,
+                         durable=SAVE_FSYNC)
+
+save_storage = create_storage()
+
+def check_save_name(filename: str):
+    if ".." in filename or "/" in filename or "\\" in filename:
+        raise HTTPException(status_code=400, detail="Invalid filename.")
+
+def require_save(filename: str):
+    if not save_storage.exists(filename):
         logger.warning(f"Save file not found: {filename}")
         raise HTTPException(status_code=404, detail=f"Save file not found: {filename}")
+
+# ★★★ [新增] 多 worker 部署：按存档加锁 + 修订号乐观并发 ★★★
+# save_lock 按存档 (分支族) 加锁：进程内是每个存档一把线程锁，进程间是锁文件；不同存档的读写互不阻塞。
+# 客户端读档时拿到 ETag (修订号)，保存时用 If-Match 带回；期间存档被别人改过则返回 412，而不是悄悄覆盖。
+SAVE_LOCK_DIR = os.path.join(SAVES_DIR, ".locks")
+save_locks = SaveLocks(SAVE_LOCK_DIR)
+
+@contextmanager
+def save_lock(*names: str):
+    while True:
+        keys = {save_storage.lock_name(n) for n in names}
+        try:
+            with save_locks.hold(*keys):
+                # 等锁期间分支关系可能被改变 (父存档被删除等)，锁名变了就重新加锁
+                if keys != {save_storage.lock_name(n) for n in names}:
+                    continue
+                yield
+                return
+        except TimeoutError:
+            logger.warning(f"Timed out waiting for save lock: {', '.join(names)}")
+            raise HTTPException(status_code=503, detail="Save is busy, please retry.")
+
+def state_etag(doc: dict) -> str:
+    return f'"{doc.get(REVISION_KEY, 0)}"'
+
+def check_if_match(request: Request, filename: str, current: Optional[int]):
+    """
+    If-Match 与当前修订号不符时返回 412；没带 If-Match 的旧客户端照常无条件写入。
+    current 为 None 表示存档不存在或已损坏，此时任何 If-Match 都不成立。
+    """
+    header = request.headers.get("if-match")
+    if not header:
+        return
+    tags = {t.strip()[2:] if t.strip().startswith("W/") else t.strip() for t in header.split(",")}
+    if current is not None and ("*" in tags or f'"{current}"' in tags):
+        return
+    logger.warning(f"Rejected stale write to {filename}: If-Match {header}, current revision {current}")
+    raise HTTPException(status_code=412, detail=f"Save was modified elsewhere (current revision: {current}). Reload and retry.")
+
+def current_revision(filename: str) -> Optional[int]:
+    """全量保存前取当前修订号：存档目录的条目仍对应当前 stamp 时直接用，否则才读档；读不出来 (损坏) 返回 None"""
+    revision = save_catalog.revision(save_storage, filename)
+    if revision is not None:
+        return revision
+    try:
+        return save_storage.load(filename).get(REVISION_KEY, 0)
+    except Exception as e:
+        logger.warning(f"Cannot read current revision of {filename}, it will be overwritten: {e}")
+        return None
+
+def next_revision(doc: dict) -> dict:
+    """写入前调用：修订号 +1，返回对应的补丁操作 (增量存档时随补丁一起写入日志)"""
+    doc[REVISION_KEY] = doc.get(REVISION_KEY, 0) + 1
+    return {"op": "add", "path": f"/{REVISION_KEY}", "value": doc[REVISION_KEY]}
+
+# ★★★ [新增] 存档目录索引：读档对话框一次拿到所有存档的摘要 ★★★
+SAVE_THUMBNAIL_DIR = os.path.join(CACHE_DIR, "thumbnails")
+SAVE_THUMBNAIL_SIZE = 256  # 缩略图最长边 (像素)
+
+try:
+    from PIL import Image  # 可选依赖：有则生成小缩略图，否则直接返回原图 (由浏览器缩放)
+except ImportError:
+    Image = None
+
+_thumbnail_failures = set()  # 无法解码的底图，不再反复尝试
+
+def _map_image_ref(doc: dict):
+    map_data = doc.get("map_data") or {}
+    for layer in map_data.get("layers") or []:
+        if layer.get("type") == "image" and isinstance(layer.get("data"), str) and layer["data"]:
+            return layer["data"]
+    return map_data.get("image") or None
+
+def make_save_thumbnail(doc: dict):
+    """返回地图缩略图 URL；缩略图按底图的 sha256 缓存，底图不变就不会重新生成"""
+    ref = _map_image_ref(doc)
+    if not ref:
+        return None
+    if ref.startswith(BLOB_URL_PREFIX):
+        digest = ref[len(BLOB_URL_PREFIX):].split(".", 1)[0]
+        source = _blob_path(digest)
+    elif ref.startswith("data:"):
+        # 未抽取到 blob 的小图，直接用原图
+        return None if len(ref) > BLOB_MIN_INLINE_SIZE else ref
+    else:
+        return ref
+    if Image is None or digest in _thumbnail_failures:
+        return ref
+
+    thumb = os.path.join(SAVE_THUMBNAIL_DIR, f"{digest}.jpg")
+    if not os.path.exists(thumb):
+        try:
+            os.makedirs(SAVE_THUMBNAIL_DIR, exist_ok=True)
+            with Image.open(source) as img:
+                img.thumbnail((SAVE_THUMBNAIL_SIZE, SAVE_THUMBNAIL_SIZE))
+                if img.mode in ("RGBA", "LA", "P"):
+                    img = img.convert("RGBA")
+                    canvas = Image.new("RGB", img.size, (255, 255, 255))
+                    canvas.paste(img, mask=img.split()[-1])
+                    img = canvas
+                tmp = f"{thumb}.{os.getpid()}.{threading.get_ident()}.tmp"
+                img.convert("RGB").save(tmp, "JPEG", quality=75)
+            os.replace(tmp, thumb)
+        except Exception as e:
+            logger.warning(f"Thumbnail generation failed for {digest[:12]}: {e}")
+            _thumbnail_failures.add(digest)
+            return ref
+    return f"/api/saves/thumbnails/{digest}.jpg"
+
+save_catalog = SaveCatalog(CACHE_DIR, thumbnailer=make_save_thumbnail, lock=save_lock)
+
+@app.get("/api/saves/thumbnails/{name}")
+def get_save_thumbnail(name: str):
+    if not re.fullmatch(r"[0-9a-f]{64}\.jpg", name):
+        raise HTTPException(status_code=400, detail="Invalid thumbnail name.")
+    path = os.path.join(SAVE_THUMBNAIL_DIR, name)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Thumbnail not found")
+    return FileResponse(path, media_type="image/jpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+# ★★★ [新增] 存档结构迁移：旧版本存档只升级一次并写回，之后读档不再做兼容修补 (见 migrations.py) ★★★
+def migrate_and_store(filename: str, doc: dict) -> dict:
+    """把 save_storage.load 得到的文档升级到当前版本并写回 (调用方持有 save_lock)"""
+    version = doc.get(SCHEMA_VERSION_KEY, 0)
+    applied = migrate_document(doc)
+    next_revision(doc)
+    save_storage.save(filename, doc)
+    save_catalog.update(save_storage, filename, doc)
+    logger.info(f"Save migrated: {filename} v{version} -> v{CURRENT_SCHEMA_VERSION} (steps {applied})")
+    return doc
+
+def load_state(filename: str) -> dict:
+    """读档统一入口 (调用方持有 save_lock)：版本已是最新时只多一次整数比较"""
+    doc = save_storage.load(filename)
+    if not needs_migration(doc):
+        return doc
+    info = save_storage.branch_info(filename)
+    if info and save_storage.exists(info["parent"]):
+        # 先迁移父存档，分支继承的部分迁移后与父存档相同，可以继续共享
+        load_state(info["parent"])
+        doc = save_storage.load(filename)
+        if not needs_migration(doc):
+            return doc
+    return migrate_and_store(filename, doc)
+
+def _json_bytes_response(data) -> Response:
+    return Response(content=json_dumps_bytes(data), media_type="application/json")
+
+@app.get("/api/state", response_model=GameState)
+def get_state(filename: str, response: Response, inline_blobs: bool = False, validate: bool = False, fields: str = ""):
+    require_save(filename)
     
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            
-            # --- 【强力兼容补丁】 ---
-            
-            # 1. 如果存档里有 stat_schema 但没有 rule_sets (旧存档升级)
-            if "rule_sets" not in data:
-                # 尝试找旧的字段
-                old_schema = data.get("stat_schema", data.get("schema", []))
-                
-                # 如果旧字段也没有，那就给个空的默认值
-                if not old_schema:
-                    old_schema = []
-                    
-                # 构造默认规则集
-                data["rule_sets"] = [{
-                    "id": "default",
-                    "name": "通用实体 (Default)",
-                    "fields": old_schema
-                }]
-                
-                # 给所有实体打上默认标签
-                for player in data.get("players", []):
-                    if "schemaId" not in player:
-                        player["schemaId"] = "default"
-            
-            # 2. 如果存档里有 schemaId 字段丢失的情况 (针对你刚才遇到的 bug)
-            # 强制检查所有 rule_sets 的 ID，如果没有匹配的，就回落到第一个规则集
-            if data.get("rule_sets"):
-                valid_ids = [r["id"] for r in data["rule_sets"]]
-                fallback_id = valid_ids[0] if valid_ids else "default"
-                
-                for player in data.get("players", []):
-                    if "schemaId" not in player or player["schemaId"] not in valid_ids:
-                        player["schemaId"] = fallback_id
-
-            logger.info(f"Game state loaded: {filename}")
+        with save_lock(filename):
+            data = load_state(filename)
+            # [新增] 修订号作为 ETag，保存时通过 If-Match 带回
+            response.headers["ETag"] = etag = state_etag(data)
+
+            # [新增] 投影：fields=players,global_vars 只返回指定的顶层字段
+            wanted = [f.strip() for f in fields.split(",") if f.strip()]
+            if wanted:
+                data = {k: data[k] for k in wanted if k in data}
+
+            logger.info(f"Game state loaded: {filename}" + (f" (fields: {','.join(wanted)})" if wanted else ""))
+            if inline_blobs:
+                # 导出/分享用：把 blob 引用还原成 data URL，得到可独立使用的存档
+                data = inline_blob_refs(copy.deepcopy(data))
+            if wanted or (STATE_TRUST_SAVED and not validate):
+                # 直接返回序列化好的字节，跳过 response_model 对每个嵌套模型的校验与重建
+                raw = _json_bytes_response(data)
+                raw.headers["ETag"] = etag
+                return raw
             return data
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error reading save file {filename}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error reading save file: {str(e)}")
 
+# ★★★ [新增] 分页读取：大战役只取需要的回合/图层 ★★★
+# 数据来自已解析并缓存的存档文档 (含增量日志)，只序列化请求的那一页。
+def _page(items: list, offset, limit: int) -> dict:
+    total = len(items)
+    limit = max(0, min(limit, 500))
+    if offset is None:
+        # 未指定 offset 时返回最后一页 (界面通常只需要最近的回合)
+        offset = max(0, total - limit)
+    offset = max(0, min(offset, total))
+    return {"total": total, "offset": offset, "limit": limit, "items": items[offset:offset + limit]}
+
+@app.get("/api/state/timeline")
+def get_timeline_page(filename: str, offset: int = None, limit: int = 20, summary: bool = False):
+    require_save(filename)
+    with save_lock(filename):
+        page = _page(load_state(filename).get("timeline", []), offset, limit)
+        if summary:
+            # 只要回合目录：去掉事件正文与影响明细
+            page["items"] = [{"id": t.get("id"), "timeRange": t.get("timeRange"),
+                              "events": [{"factionId": e.get("factionId"), "summary": e.get("summary")}
+                                         for e in t.get("events", [])]}
+                             for t in page["items"]]
+        return _json_bytes_response(page)
+
+@app.get("/api/state/layers")
+def get_layers_page(filename: str, offset: int = 0, limit: int = 20, ids: str = "", include_data: bool = True):
+    require_save(filename)
+    with save_lock(filename):
+        layers = load_state(filename).get("map_data", {}).get("layers", [])
+        wanted = {i.strip() for i in ids.split(",") if i.strip()}
+        if wanted:
+            layers = [l for l in layers if l.get("id") in wanted]
+        page = _page(layers, offset, limit)
+        if not include_data:
+            # 只要图层列表 (名称/类型/可见性)，不带图片与地块数据
+            page["items"] = [{k: v for k, v in l.items() if k != "data"} for l in page["items"]]
+        return _json_bytes_response(page)
+
+# [新增] 查询某个实体受到的全部影响 (SQLite 后端走索引)
+@app.get("/api/state/impacts")
+def get_impacts(filename: str, targetId: str):
+    require_save(filename)
+    with save_lock(filename):
+        items = save_storage.find_impacts(filename, targetId)
+    return _json_bytes_response({"targetId": targetId, "total": len(items), "items": items})
+
+# ★★★ [新增] 地图区块查询：遮罩转成游程编码，按包围盒建 R 树 (见 region_index.py) ★★★
+# 坐标与前端一致，是占底图的百分比 (0~100)；面积为占整张底图的百分比。
+REGION_MASK_CACHE_DIR = os.path.join(CACHE_DIR, "region_masks")
+
+region_masks = MaskStore(REGION_MASK_CACHE_DIR, lambda ref: load_mask_bytes(ref, BLOBS_DIR))
+_region_indexes: "OrderedDict[str, tuple]" = OrderedDict()  # 存档名 -> (stamp, RegionIndex)，调用方持有 save_lock
+
+def get_region_index(filename: str) -> RegionIndex:
+    doc = load_state(filename)
+    stamp = save_storage.stamp(filename)
+    with _cache_lock:
+        cached = _region_indexes.get(filename)
+        if cached and cached[0] == stamp:
+            _region_indexes.move_to_end(filename)
+            return cached[1]
+    started = time.perf_counter()
+    index = RegionIndex.build(doc, region_masks)
+    logger.info(f"Region index built for {filename}: {len(index.entries)} regions in {time.perf_counter() - started:.2f}s")
+    with _cache_lock:
+        _region_indexes[filename] = (stamp, index)
+        while len(_region_indexes) > STATE_CACHE_SIZE:
+            _region_indexes.popitem(last=False)
+    return index
+
+@app.get("/api/map/regions")
+def get_regions(filename: str, owner: str = None):
+    """全部区块 (或 owner 指定势力的区块) 的位置与面积，附各势力领土汇总；owner= 空字符串表示无主区块"""
+    require_save(filename)
+    with save_lock(filename):
+        index = get_region_index(filename)
+        items = [e.summary() for e in index.owned_by(owner)]
+        owners = index.owners()
+    return _json_bytes_response({"total": len(items), "items": items, "owners": owners})
+
+@app.get("/api/map/regions/at")
+def get_regions_at(filename: str, x: float, y: float):
+    """包含点 (x, y) 的区块，最上层的在前"""
+    require_save(filename)
+    with save_lock(filename):
+        items = [e.summary() for e in get_region_index(filename).at(x, y)]
+    return _json_bytes_response({"x": x, "y": y, "items": items})
+
+@app.get("/api/map/regions/{region_id}/neighbors")
+def get_region_neighbors(filename: str, region_id: str, gap: int = ADJACENCY_GAP_PX):
+    """与该区块相邻 (相隔不超过 gap 个底图像素) 的区块；contact 为接触长度 (底图高度的百分比)"""
+    require_save(filename)
+    gap = max(0, min(gap, 64))
+    with save_lock(filename):
+        try:
+            items = get_region_index(filename).neighbors(region_id, gap)
+        except KeyError:
+            raise HTTPException(status_code=404, detail=f"Region not found: {region_id}")
+    return _json_bytes_response({"id": region_id, "gap": gap, "items": items})
+
 @app.post("/api/state")
-def save_state(filename: str, state: GameState):
-    if ".." in filename or "/" in filename or "\\" in filename:
-        raise HTTPException(status_code=400, detail="Invalid filename.")
+def save_state(filename: str, state: GameState, request: Request, response: Response):
+    check_save_name(filename)
     
-    filepath = os.path.join(SAVES_DIR, filename)
     try:
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(state.model_dump_json(indent=2))
-        logger.info(f"Game state saved: {filename}")
-        return {"status": "saved", "filename": filename}
+        with save_lock(filename):
+            # 不读整个旧存档 (损坏的存档也要能被覆盖)，只取修订号
+            current = current_revision(filename) if save_storage.exists(filename) else None
+            check_if_match(request, filename, current)
+            doc = state_document(state)
+            migrate_document(doc)  # 前端新建的存档不带版本号时，入库前补齐
+            # 修订号以服务端为准 (请求体里的是客户端读档时的旧值)
+            doc[REVISION_KEY] = current or 0
+            next_revision(doc)
+            save_storage.save(filename, doc)
+            save_catalog.update(save_storage, filename, doc)
+        logger.info(f"Game state saved: {filename} (revision {doc[REVISION_KEY]})")
+        response.headers["ETag"] = state_etag(doc)
+        return {"status": "saved", "filename": filename, "revision": doc[REVISION_KEY]}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error saving file {filename}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error saving file: {str(e)}")
 
+# ★★★ [新增] 增量存档接口：只追加变化部分，不重写整个文件 ★★★
+@app.patch("/api/state")
+def patch_state(filename: str, patch: StatePatch, request: Request, response: Response, recalc: bool = False):
+    check_save_name(filename)
+    # 没有快照可打补丁时返回 404，前端需回退到全量保存
+    require_save(filename)
+    patch.ops = strip_managed_ops(patch.ops)
+    if not patch.ops:
+        return {"status": "unchanged", "filename": filename}
+
+    try:
+        for op in patch.ops:
+            if "value" in op:
+                op["value"] = externalize_blobs(op["value"])
+
+        with save_lock(filename):
+            data = load_state(filename)
+            check_if_match(request, filename, data.get(REVISION_KEY, 0))
+            # 修改前通知存储层 (分支存档据此把子分支继承的旧内容先复制过去，不必事后重新读档)
+            save_storage.prepare_patch(filename, data, patch.ops,
+                                       extra_keys=(REVISION_KEY,) + (FORMULA_TARGET_KEYS if recalc else ()))
+            try:
+                apply_json_patch(data, patch.ops)
+            except JsonPatchError as e:
+                # 内存中的文档可能已被部分修改，丢弃缓存，下次从存储重新读取
+                save_storage.invalidate(filename)
+                logger.warning(f"Rejected patch for {filename}: {e}")
+                raise HTTPException(status_code=409, detail=f"Patch conflict: {str(e)}")
+
+            # [新增] recalc=true：服务端增量重算受影响的公式，结果随补丁一起落盘并返回给前端
+            derived = []
+            if recalc:
+                engine, fresh = get_formula_engine(filename, data)
+                derived = engine.recompute_all() if fresh else engine.apply_ops(patch.ops)
+            try:
+                validate_patched(data, patch.ops + derived)
+            except ValidationError as e:
+                save_storage.invalidate(filename)
+                logger.warning(f"Rejected invalid patch for {filename}: {e.error_count()} errors")
+                raise HTTPException(status_code=422, detail=f"Patched state is invalid: {e.errors(include_url=False)[:5]}")
+            entries = save_storage.commit_patch(filename, data, patch.ops + derived + [next_revision(data)])
+            save_catalog.update(save_storage, filename, data)
+
+        logger.info(f"Game state patched: {filename} ({len(patch.ops)} ops, {len(derived)} derived, revision {data[REVISION_KEY]})")
+        response.headers["ETag"] = state_etag(data)
+        return {"status": "patched", "filename": filename, "journal": entries, "derived": derived,
+                "revision": data[REVISION_KEY]}
+    except HTTPException:
+        raise
+    except Exception as e:
+        save_storage.invalidate(filename)
+        logger.error(f"Error patching file {filename}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error patching file: {str(e)}")
+
 @app.delete("/api/saves/{filename}")
 def delete_save(filename: str):
-    if ".." in filename or "/" in filename or "\\" in filename:
-        raise HTTPException(status_code=400, detail="Invalid filename.")
-    filepath = os.path.join(SAVES_DIR, filename)
-    if os.path.exists(filepath):
-        try:
-            os.remove(filepath)
-            logger.info(f"Deleted save file: {filename}")
-            return {"status": "deleted", "filename": filename}
-        except Exception as e:
-            logger.error(f"Error deleting file {filename}: {e}")
-            raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
-    else:
+    check_save_name(filename)
+    try:
+        with save_lock(filename):
+            found = save_storage.delete(filename)
+            with _cache_lock:
+                _formula_engines.pop(filename, None)
+                _region_indexes.pop(filename, None)
+            save_catalog.remove(save_storage, filename)
+        with _lore_lock:
+            _lore_indexes.pop(filename, None)
+    except Exception as e:
+        logger.error(f"Error deleting file {filename}: {e}")
+        raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")
+    if not found:
         raise HTTPException(status_code=404, detail="File not found")
+    logger.info(f"Deleted save file: {filename}")
+    return {"status": "deleted", "filename": filename}
+
+# ★★★ [新增] 分支存档：从任意回合分叉出 "如果…" 支线，只保存分叉后的部分 ★★★
+# 继承的回合、势力、地图图层等都与父存档共享；父存档改动被继承的内容前，会先复制一份给分支 (写时复制)。
+# 注意：分支保留父存档当前的势力属性/全局变量 (与界面上删除回合的行为一致)，不回滚被截掉回合的影响。
+BRANCH_DIFF_TURN_LIMIT = 50  # diff 中每侧最多列出的分叉回合数
+
+@app.post("/api/saves/{filename}/branch")
+def create_branch(filename: str, name: str, turn: int = None):
+    check_save_name(filename)
+    check_save_name(name)
+    require_save(filename)
+    if not name.endswith(".json"):
+        name += ".json"
+    try:
+        with save_lock(filename, name):
+            if save_storage.exists(name):
+                raise HTTPException(status_code=409, detail=f"Save already exists: {name}")
+            turns = len(load_state(filename).get("timeline", [])) if turn is None else turn
+            info = save_storage.create_branch(filename, name, turns)
+            save_catalog.update(save_storage, name, save_storage.load(name))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error branching {filename} -> {name}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error creating branch: {str(e)}")
+    logger.info(f"Branch created: {filename} -> {name} at turn {info['turns']}")
+    return {"status": "created", "filename": name, "branch": info}
+
+def _faction_diff(a: list, b: list) -> dict:
+    fa = {p.get("id"): p for p in a}
+    fb = {p.get("id"): p for p in b}
+    changed = {}
+    for fid in fa.keys() & fb.keys():
+        sa, sb = fa[fid].get("stats") or {}, fb[fid].get("stats") or {}
+        stats = {k: [sa.get(k), sb.get(k)] for k in sa.keys() | sb.keys() if sa.get(k) != sb.get(k)}
+        other = sorted(k for k in fa[fid].keys() | fb[fid].keys()
+                       if k != "stats" and fa[fid].get(k) != fb[fid].get(k))
+        if stats or other:
+            changed[fid] = {"name": fb[fid].get("name"), "stats": stats, "fields": other}
+    return {
+        "added": [{"id": fid, "name": fb[fid].get("name")} for fid in fb.keys() - fa.keys()],
+        "removed": [{"id": fid, "name": fa[fid].get("name")} for fid in fa.keys() - fb.keys()],
+        "changed": changed,
+    }
+
+def _turn_summaries(turns: list) -> list:
+    return [{"id": t.get("id"), "timeRange": t.get("timeRange", ""),
+             "events": [e.get("summary", "") for e in t.get("events", []) or []]}
+            for t in turns[:BRANCH_DIFF_TURN_LIMIT]]
+
+@app.get("/api/saves/diff")
+def diff_saves(a: str, b: str):
+    """比较两个存档 (通常是同一战役的两条分支)：共同回合数、各自分叉后的回合、势力/全局变量差异"""
+    for name in (a, b):
+        check_save_name(name)
+        require_save(name)
+    with save_lock(a, b):
+        da, db = load_state(a), load_state(b)
+        ta, tb = da.get("timeline", []), db.get("timeline", [])
+        # 直接父子关系时，继承的回合必然相同，不必逐个比较
+        common = 0
+        for x, y in ((a, b), (b, a)):
+            info = save_storage.branch_info(y)
+            if info and info["parent"] == x:
+                common = info["turns"]
+        while common < min(len(ta), len(tb)) and ta[common] == tb[common]:
+            common += 1
+        ga = {v.get("key"): v.get("value") for v in da.get("global_vars", [])}
+        gb = {v.get("key"): v.get("value") for v in db.get("global_vars", [])}
+        result = {
+            "a": {"filename": a, "branch": da.get("branch"), "turns": len(ta), "divergent": _turn_summaries(ta[common:])},
+            "b": {"filename": b, "branch": db.get("branch"), "turns": len(tb), "divergent": _turn_summaries(tb[common:])},
+            "commonTurns": common,
+            "factions": _faction_diff(da.get("players", []), db.get("players", [])),
+            "globalVars": {k: [ga.get(k), gb.get(k)] for k in ga.keys() | gb.keys() if ga.get(k) != gb.get(k)},
+            "sections": sorted(k for k in (da.keys() | db.keys()) - {"branch", "timeline"} if da.get(k) != db.get(k)),
+        }
+    return _json_bytes_response(result)
+
+# --- [新增] 资料库关键词索引 (服务端 "auto" 条目触发) ---
+_lore_indexes: Dict[str, LoreIndex] = {}  # 存档名 -> 索引
+_lore_lock = threading.Lock()
+
+class LoreMatchRequest(BaseModel):
+    filename: str
+    text: str = ""
+
+@app.post("/api/lore/match")
+def lore_match(req: LoreMatchRequest):
+    check_save_name(req.filename)
+    require_save(req.filename)
+
+    with save_lock(req.filename):
+        lorebook = load_state(req.filename).get("lorebook", [])
+    with _lore_lock:
+        index = _lore_indexes.setdefault(req.filename, LoreIndex())
+        if index.update(lorebook):
+            logger.info(f"Lore index updated: {req.filename} ({len(lorebook)} entries)")
+        triggered = index.match(req.text)
+        digest = index.digest
+
+    # 返回条目总数与全部条目 (keys, mode) 的摘要，前端据此确认与本地资料库一致后再采用结果
+    return {
+        "count": len(lorebook),
+        "digest": digest,
+        "triggered": triggered,
+        "keys": [lorebook[i].get("keys", "") for i in triggered],
+    }
+
+# --- [新增] 按 Token 预算装配上下文 ---
+class ContextAssembleRequest(BaseModel):
+    filename: str
+    query: str = ""              # 本次推演指令，用于相关度排序与资料触发
+    provider: str = ""
+    model: str = ""
+    budget: int = 8000           # 总 token 预算 (含 systemPrompt)
+    systemPrompt: str = ""
+    deepTurns: int = 3           # 最近几回合优先给出完整详情
+
+@app.post("/api/context/assemble")
+def context_assemble(req: ContextAssembleRequest):
+    check_save_name(req.filename)
+    require_save(req.filename)
+
+    with save_lock(req.filename):
+        state = load_state(req.filename)
+        with _lore_lock:
+            index = _lore_indexes.setdefault(req.filename, LoreIndex())
+            result = assemble_context(state, req.query, req.budget, provider=req.provider, model=req.model,
+                                      reserved_text=req.systemPrompt, deep_turns=req.deepTurns, lore_index=index)
+
+    logger.info(f"Context assembled for {req.filename}: {result['tokens']}/{req.budget} tokens, "
+                f"{len(result['included'])} included, {len(result['dropped'])} dropped")
+    return result
+
+# --- [新增] 服务端公式引擎 (增量计算 GlobalVar / StatSchema 公式) ---
+_formula_engines: "OrderedDict[str, FormulaEngine]" = OrderedDict()  # 存档名 -> 引擎，调用方持有 save_lock
+
+def get_formula_engine(filename: str, doc: dict):
+    """返回 (引擎, 是否新建)。引擎绑定缓存中的文档对象，文档被重新读取后自动重建"""
+    with _cache_lock:
+        engine = _formula_engines.get(filename)
+    fresh = engine is None or engine.doc is not doc
+    if fresh:
+        engine = FormulaEngine(doc)
+        report = engine.report()
+        if report["cycles"] or report["errors"]:
+            logger.warning(f"Formula problems in {filename}: cycles={report['cycles']} errors={report['errors']}")
+    with _cache_lock:
+        _formula_engines[filename] = engine
+        _formula_engines.move_to_end(filename)
+        while len(_formula_engines) > STATE_CACHE_SIZE:
+            _formula_engines.popitem(last=False)
+    return engine, fresh
+
+@app.post("/api/formulas/recalculate")
+def recalculate_formulas(filename: str):
+    check_save_name(filename)
+    require_save(filename)
+    with save_lock(filename):
+        data = load_state(filename)
+        save_storage.prepare_patch(filename, data, [], extra_keys=(REVISION_KEY,) + FORMULA_TARGET_KEYS)
+        engine, fresh = get_formula_engine(filename, data)
+        if not fresh:
+            engine.rebuild()
+        ops = engine.recompute_all()
+        if ops:
+            save_storage.commit_patch(filename, data, ops + [next_revision(data)])
+        report = engine.report()
+    logger.info(f"Formulas recalculated for {filename}: {report['formulas']} formulas, {len(ops)} changed")
+    return {"status": "ok", "filename": filename, "ops": ops, **report}
+
+# ★★★ [新增] Blob 下载接口：内容寻址，永不变化，可以让浏览器永久缓存 ★★★
+@app.get("/api/blobs/{name}")
+def get_blob(name: str, request: Request):
+    digest = name.split(".", 1)[0]
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=400, detail="Invalid blob name.")
+    path = _blob_path(digest)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+# [新增] 清理不再被任何存档 (含增量日志) 引用的 blob
+@app.post("/api/blobs/gc")
+def gc_blobs():
+    referenced = set()
+    # 不加锁：存档都是整文件替换写入；扫描期间新写入的 blob 由 BLOB_GC_GRACE_SECONDS 保护
+    for text in save_storage.blob_refs_text():
+        referenced.update(_BLOB_REF_RE.findall(text))
+    referenced.update(f[:-5] for f in os.listdir(DOCUMENTS_DIR) if f.endswith(".json"))
+    removed = 0
+    cutoff = time.time() - BLOB_GC_GRACE_SECONDS
+    for root, _, files in os.walk(BLOBS_DIR):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                if f not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    logger.info(f"Blob GC: {len(referenced)} referenced, {removed} removed.")
+    return {"status": "ok", "referenced": len(referenced), "removed": removed}
 
 # ★★★ [新增] 获取背景音乐列表接口 ★★★
 @app.get("/api/music-list")
@@ -413,10 +1525,225 @@ def is_vision_model(provider: str, model_name: str) -> bool:
     # 3. 兜底策略：默认视为不支持，防止报错
     return False 
 
+# --- [新增] 附件解析缓存 ---
+# 同一份规则书 PDF 每次推演都会重新上传，按内容哈希缓存提取出的文本，跳过重复解析。
+# 内存里是按字符数限额的 LRU，可选再落一份到磁盘 (重启后仍然有效)。
+ATTACHMENT_CACHE_DIR = os.path.join(CACHE_DIR, "attachments")
+ATTACHMENT_CACHE_MAX_CHARS = 16 * 1000 * 1000      # 内存缓存总字符数上限
+ATTACHMENT_DISK_CACHE = True                      # 是否启用磁盘缓存
+ATTACHMENT_DISK_CACHE_BYTES = 200 * 1024 * 1024   # 磁盘缓存总大小上限
+ATTACHMENT_TEXT_LIMIT = 50000                     # 单个附件注入上下文的最大字符数
+ATTACHMENT_ERROR_KINDS = ("PDF ERROR", "WORD ERROR", "BINARY FILE IGNORED")  # 解析失败，不缓存 (下次重试)
+
+_attachment_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (kind, content)
+_attachment_cache_chars = 0
+_attachment_cache_lock = threading.Lock()
+
+def _attachment_cache_key(mime_type: str, data_b64: str) -> str:
+    # 直接对 Base64 文本取哈希，命中时连解码都省掉
+    h = hashlib.sha256(mime_type.encode("utf-8"))
+    h.update(data_b64.encode("ascii", errors="ignore"))
+    return h.hexdigest()
+
+def _attachment_cache_get(key: str):
+    with _attachment_cache_lock:
+        hit = _attachment_cache.get(key)
+        if hit:
+            _attachment_cache.move_to_end(key)
+            return hit
+    if ATTACHMENT_DISK_CACHE:
+        path = os.path.join(ATTACHMENT_CACHE_DIR, f"{key}.json")
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                hit = (entry["kind"], entry["content"])
+                if hit[0] in ATTACHMENT_ERROR_KINDS:
+                    return None  # 旧版本缓存下来的失败结果，重新解析
+                _attachment_cache_put(key, hit, persist=False)
+                return hit
+            except Exception as e:
+                logger.warning(f"Attachment disk cache read failed ({key[:12]}): {e}")
+    return None
+
+def _attachment_cache_put(key: str, entry: tuple, persist: bool = True):
+    global _attachment_cache_chars
+    with _attachment_cache_lock:
+        if key not in _attachment_cache:
+            _attachment_cache[key] = entry
+            _attachment_cache_chars += len(entry[1])
+        _attachment_cache.move_to_end(key)
+        while _attachment_cache_chars > ATTACHMENT_CACHE_MAX_CHARS and len(_attachment_cache) > 1:
+            _, old = _attachment_cache.popitem(last=False)
+            _attachment_cache_chars -= len(old[1])
+
+    if persist and ATTACHMENT_DISK_CACHE:
+        try:
+            os.makedirs(ATTACHMENT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(ATTACHMENT_CACHE_DIR, f"{key}.json")
+            # 原子替换：并发写同一条目或中途崩溃都不会留下半截 JSON；缓存可以重建，不必 fsync
+            raw = json.dumps({"kind": entry[0], "content": entry[1]}, ensure_ascii=False).encode("utf-8")
+            atomic_write(path, raw, durable=False)
+            _prune_attachment_disk_cache()
+        except Exception as e:
+            logger.warning(f"Attachment disk cache write failed ({key[:12]}): {e}")
+
+def _prune_attachment_disk_cache():
+    files = []
+    total = 0
+    for f in os.listdir(ATTACHMENT_CACHE_DIR):
+        if not f.endswith(".json"):
+            continue  # 其他线程/进程正在写的临时文件
+        path = os.path.join(ATTACHMENT_CACHE_DIR, f)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((st.st_atime, st.st_size, path))
+        total += st.st_size
+    # 超限时从最久未访问的开始删
+    for _, size, path in sorted(files):
+        if total <= ATTACHMENT_DISK_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+# --- [新增] PDF 并行提取 ---
+# 大 PDF 按页分块，交给进程池并行 extract_text()；按页序收集结果，
+# 一旦累计字符数超过 ATTACHMENT_TEXT_LIMIT 就取消剩余分块，不再解析注定被截断的部分。
+PDF_PAGES_PER_CHUNK = 8                               # 每个子任务处理的页数
+PDF_PARALLEL_MIN_PAGES = 16                           # 少于这个页数直接在当前线程解析
+PDF_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+_attachment_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="attachment")
+
+def _get_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+        return _pdf_pool
+
+def _pdf_extract_parallel(path: str, page_count: int, budget: int) -> List[str]:
+    pool = _get_pdf_pool()
+    chunks = [(p, min(p + PDF_PAGES_PER_CHUNK, page_count)) for p in range(0, page_count, PDF_PAGES_PER_CHUNK)]
+    pending = deque()
+    texts = []
+    total = 0
+    next_chunk = 0
+    # 最多保持 2 倍 worker 数的分块在途，按页序消费
+    while next_chunk < len(chunks) or pending:
+        while next_chunk < len(chunks) and len(pending) < PDF_WORKERS * 2:
+            start, end = chunks[next_chunk]
+            pending.append(pool.submit(extract_pdf_pages, path, start, end, budget - total))
+            next_chunk += 1
+        part = pending.popleft().result()
+        texts.extend(part)
+        total += sum(len(t) + 1 for t in part)
+        if total > budget:
+            for f in pending:
+                f.cancel()
+            break
+    return texts
+
+def extract_pdf_text(name: str, file_bytes: bytes, source_path: str = None) -> List[str]:
+    """返回各页文本；页数多时走进程池，source_path 为磁盘上已有的同一文件 (可省去临时文件)"""
+    reader = pypdf.PdfReader(io.BytesIO(file_bytes))
+    if reader.is_encrypted:
+        try: reader.decrypt("")
+        except: pass
+    page_count = len(reader.pages)
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        return extract_pdf_pages(io.BytesIO(file_bytes), 0, page_count, ATTACHMENT_TEXT_LIMIT)
+
+    tmp_path = None
+    try:
+        if source_path is None:
+            # 子进程按路径读取，避免把整个文件 pickle 给每个分块
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix=".pdf", dir=CACHE_DIR)
+            with os.fdopen(fd, "wb") as f:
+                f.write(file_bytes)
+            source_path = tmp_path
+        started = time.time()
+        texts = _pdf_extract_parallel(source_path, page_count, ATTACHMENT_TEXT_LIMIT)
+        logger.info(f"PDF {name}: {page_count} pages, parallel extract in {time.time() - started:.2f}s")
+        return texts
+    except BrokenProcessPool:
+        logger.warning(f"PDF process pool unavailable, extracting {name} in-thread")
+        return extract_pdf_pages(io.BytesIO(file_bytes), 0, page_count, ATTACHMENT_TEXT_LIMIT)
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def extract_attachment_text(name: str, mime_type: str, file_bytes: bytes, source_path: str = None):
+    """把 PDF / Word / 文本附件解析成纯文本，返回 (类型标题, 内容)"""
+    started = time.perf_counter()
+    file_stream = io.BytesIO(file_bytes)
+    extracted_content = ""
+    kind = ""
+    
+    # --- PDF ---
+    if "pdf" in mime_type or name.lower().endswith(".pdf"):
+        try:
+            # 检查文件头签名
+            sig = file_bytes[:4]
+            if sig != b'%PDF':
+                logger.warning(f"File {name} does not look like a PDF. Signature: {sig}")
+
+            pages_text = extract_pdf_text(name, file_bytes, source_path)
+            extracted_content = "\n".join(pages_text) if pages_text else "[PDF contains no text]"
+            kind = "PDF CONTENT"
+        except Exception as e:
+            logger.warning(f"PDF Error {name}: {e}")
+            kind = "PDF ERROR"
+            extracted_content = "[Unreadable PDF]"
+
+    # --- Word ---
+    elif "word" in mime_type or "document" in mime_type or name.lower().endswith(".docx"):
+        try:
+            doc = docx.Document(file_stream)
+            extracted_content = "\n".join([p.text for p in doc.paragraphs])
+            kind = "WORD CONTENT"
+        except Exception as e:
+             logger.warning(f"DOCX Error {name}: {e}")
+             kind = "WORD ERROR"
+             extracted_content = "[Unreadable DOCX]"
+    
+    # --- Text ---
+    else:
+        try:
+            extracted_content = file_bytes.decode('utf-8')
+            kind = "TEXT FILE"
+        except:
+            try:
+                extracted_content = file_bytes.decode('gbk')
+                kind = "TEXT FILE"
+            except:
+                kind = "BINARY FILE IGNORED"
+
+    if len(extracted_content) > ATTACHMENT_TEXT_LIMIT:
+         extracted_content = extracted_content[:ATTACHMENT_TEXT_LIMIT] + "\n...[Truncated]"
+    ATTACHMENT_EXTRACT.observe(time.perf_counter() - started, kind)
+    return kind, extracted_content
+
 # --- 核心：智能附件处理器 (ETL) ---
+def _extract_and_cache(name: str, mime_type: str, file_bytes: bytes, cache_key: str):
+    entry = extract_attachment_text(name, mime_type, file_bytes)
+    if entry[0] not in ATTACHMENT_ERROR_KINDS:
+        _attachment_cache_put(cache_key, entry)
+    return entry
+
 def process_attachments_smart(attachments, allow_native_doc=False, allow_image=False):
     text_to_append = ""
     media_parts = []
+    # [新增] 多个附件并发解析：先按顺序登记 (文本 或 Future)，最后按原顺序拼接
+    outputs = []
 
     for att in attachments:
         name = att.get('name', 'unknown')
@@ -437,7 +1764,7 @@ def process_attachments_smart(attachments, allow_native_doc=False, allow_image=F
                 if allow_image:
                     media_parts.append({"type": "image", "mime_type": mime_type, "data": data_b64})
                 else:
-                    text_to_append += f"\n[System: User uploaded image '{name}', but current model does not support vision. Image discarded.]\n"
+                    outputs.append(f"\n[System: User uploaded image '{name}', but current model does not support vision. Image discarded.]\n")
                 continue
 
             # === 2. PDF / Word / 文本处理 ===
@@ -445,94 +1772,479 @@ def process_attachments_smart(attachments, allow_native_doc=False, allow_image=F
                  media_parts.append({"type": "document", "mime_type": mime_type, "data": data_b64})
                  continue
 
-            # 解码
-            try:
-                # 兼容性解码
-                file_bytes = base64.b64decode(data_b64.encode('utf-8'), validate=False)
-            except Exception as b64_err:
-                logger.error(f"Base64 Decode Error for {name}: {b64_err}")
-                text_to_append += f"\n[System: File '{name}' corrupted during upload.]\n"
-                continue
-
-            file_stream = io.BytesIO(file_bytes)
-            extracted_content = ""
-            header = ""
-            
-            # --- PDF ---
-            if "pdf" in mime_type or name.lower().endswith(".pdf"):
-                try:
-                    reader = PdfReader(file_stream)
-                    if reader.is_encrypted:
-                        try: reader.decrypt("")
-                        except: pass
-                    
-                    # 检查文件头签名
-                    file_stream.seek(0)
-                    sig = file_stream.read(4)
-                    if sig != b'%PDF':
-                        logger.warning(f"File {name} does not look like a PDF. Signature: {sig}")
-
-                    file_stream.seek(0)
-                    pages_text = []
-                    for page in reader.pages:
-                        t = page.extract_text()
-                        if t: pages_text.append(t)
-                    extracted_content = "\n".join(pages_text) if pages_text else "[PDF contains no text]"
-                    header = f"=== PDF CONTENT: {name} ==="
-                except Exception as e:
-                    logger.warning(f"PDF Error {name}: {e}")
-                    header = f"=== PDF ERROR: {name} ==="
-                    extracted_content = "[Unreadable PDF]"
-
-            # --- Word ---
-            elif "word" in mime_type or "document" in mime_type or name.lower().endswith(".docx"):
-                try:
-                    doc = Document(file_stream)
-                    extracted_content = "\n".join([p.text for p in doc.paragraphs])
-                    header = f"=== WORD CONTENT: {name} ==="
-                except Exception as e:
-                     logger.warning(f"DOCX Error {name}: {e}")
-                     header = f"=== WORD ERROR: {name} ==="
-                     extracted_content = "[Unreadable DOCX]"
-            
-            # --- Text ---
+            # [新增] 先查解析缓存
+            cache_key = _attachment_cache_key(mime_type, data_b64)
+            cached = _attachment_cache_get(cache_key)
+            if cached:
+                logger.info(f"Attachment cache hit: {name}")
+                outputs.append((name, cached))
             else:
+                # 解码
                 try:
-                    extracted_content = file_bytes.decode('utf-8')
-                    header = f"=== TEXT FILE: {name} ==="
-                except:
-                    try:
-                        extracted_content = file_bytes.decode('gbk')
-                        header = f"=== TEXT FILE: {name} ==="
-                    except:
-                        header = f"=== BINARY FILE IGNORED: {name} ==="
-
-            if extracted_content:
-                if len(extracted_content) > 50000:
-                     extracted_content = extracted_content[:50000] + "\n...[Truncated]"
-                text_to_append += f"\n\n{header}\n{extracted_content}\n"
+                    # 兼容性解码
+                    file_bytes = base64.b64decode(data_b64.encode('utf-8'), validate=False)
+                except Exception as b64_err:
+                    logger.error(f"Base64 Decode Error for {name}: {b64_err}")
+                    outputs.append(f"\n[System: File '{name}' corrupted during upload.]\n")
+                    continue
+
+                outputs.append((name, _attachment_executor.submit(_extract_and_cache, name, mime_type, file_bytes, cache_key)))
             
+        except Exception as e:
+            logger.error(f"Processing failed for {name}: {e}")
+            outputs.append(f"\n[System: Error processing {name}]\n")
+
+    for out in outputs:
+        if isinstance(out, str):
+            text_to_append += out
+            continue
+        name, entry = out
+        try:
+            kind, extracted_content = entry if isinstance(entry, tuple) else entry.result()
         except Exception as e:
             logger.error(f"Processing failed for {name}: {e}")
             text_to_append += f"\n[System: Error processing {name}]\n"
+            continue
+        if extracted_content:
+            text_to_append += f"\n\n=== {kind}: {name} ===\n{extracted_content}\n"
+
+    return text_to_append, media_parts
+
+# --- [新增] 文档库：上传一次，之后按 ID 引用 ---
+# 原文件按内容哈希存入 blobs/ (ID 即 sha256)，documents/<id>.json 记录元数据，
+# documents/<id>.txt 是后台提取好的文本。推演请求只需带 attachmentIds。
+_document_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="doc-extract")
+_document_jobs: Dict[str, Any] = {}  # id -> Future (提取进行中/刚完成)
+_document_lock = threading.Lock()
+
+def _document_meta_path(doc_id: str) -> str:
+    return os.path.join(DOCUMENTS_DIR, f"{doc_id}.json")
+
+def _document_text_path(doc_id: str) -> str:
+    return os.path.join(DOCUMENTS_DIR, f"{doc_id}.txt")
+
+def _read_document_meta(doc_id: str):
+    if not re.fullmatch(r"[0-9a-f]{64}", doc_id):
+        return None
+    path = _document_meta_path(doc_id)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _write_document_meta(meta: dict):
+    # 其他 worker 可能正在读取 (轮询提取状态)，不能让它读到写了一半的文件
+    atomic_write(_document_meta_path(meta["id"]), json.dumps(meta, ensure_ascii=False).encode("utf-8"),
+                 durable=SAVE_FSYNC)
+
+def _extract_document_job(meta: dict):
+    """后台任务：从 blob 读取原文件并提取文本"""
+    try:
+        if "image" in meta["type"]:
+            meta["kind"], meta["status"] = "IMAGE", "ready"
+        else:
+            with open(_blob_path(meta["id"]), "rb") as f:
+                file_bytes = f.read()
+            kind, content = extract_attachment_text(meta["name"], meta["type"], file_bytes, source_path=_blob_path(meta["id"]))
+            atomic_write(_document_text_path(meta["id"]), content.encode("utf-8"), durable=SAVE_FSYNC)
+            meta["kind"], meta["status"] = kind, "ready"
+        logger.info(f"Document ready: {meta['name']} ({meta['id'][:12]})")
+    except Exception as e:
+        logger.error(f"Document extraction failed for {meta['name']}: {e}", exc_info=True)
+        meta["status"] = "error"
+    _write_document_meta(meta)
+    return meta
+
+def _submit_document_job(meta: dict):
+    """提交后台提取任务 (调用方持有 _document_lock)"""
+    doc_id = meta["id"]
+    job = _document_executor.submit(_extract_document_job, dict(meta))
+    _document_jobs[doc_id] = job
+    job.add_done_callback(lambda _: _document_jobs.pop(doc_id, None))
+    return job
+
+def get_document_text(doc_id: str):
+    """返回 (meta, 提取文本)；如果后台还在提取，则等待其完成"""
+    with _document_lock:
+        job = _document_jobs.get(doc_id)
+        if job is None:
+            meta = _read_document_meta(doc_id)
+            if meta and meta.get("status") == "processing":
+                # 本进程没有对应的任务 (在其他 worker 里提取，或提取时进程重启过)：就地重新提取，
+                # 否则附件会以空文本的形式从提示词里悄悄消失
+                logger.info(f"Document {doc_id[:12]} still processing without a local job, extracting on demand")
+                job = _submit_document_job(meta)
+    if job is not None:
+        job.result()
+    meta = _read_document_meta(doc_id)
+    if not meta or meta.get("status") != "ready":
+        return meta, ""
+    text_path = _document_text_path(doc_id)
+    if not os.path.exists(text_path):
+        return meta, ""
+    with open(text_path, "r", encoding="utf-8") as f:
+        return meta, f.read()
+
+def process_document_refs(doc_ids: List[str], allow_native_doc=False, allow_image=False):
+    """文档库版本的 process_attachments_smart，输出格式一致"""
+    text_to_append = ""
+    media_parts = []
+    for doc_id in doc_ids:
+        meta = _read_document_meta(doc_id)
+        if not meta:
+            text_to_append += f"\n[System: Attachment '{doc_id}' not found in document library.]\n"
+            continue
+        name, mime_type = meta["name"], meta["type"]
+
+        # 图片 / 原生 PDF 仍需要原始数据，直接从 blob 读取
+        if "image" in mime_type or (allow_native_doc and "pdf" in mime_type):
+            if "image" in mime_type and not allow_image:
+                text_to_append += f"\n[System: User uploaded image '{name}', but current model does not support vision. Image discarded.]\n"
+                continue
+            with open(_blob_path(doc_id), "rb") as f:
+                data_b64 = base64.b64encode(f.read()).decode("ascii")
+            media_parts.append({"type": "image" if "image" in mime_type else "document", "mime_type": mime_type, "data": data_b64})
+            continue
 
+        meta, content = get_document_text(doc_id)
+        if meta.get("status") == "error":
+            text_to_append += f"\n[System: Error processing {name}]\n"
+        elif content:
+            text_to_append += f"\n\n=== {meta['kind']}: {name} ===\n{content}\n"
     return text_to_append, media_parts
 
+def collect_attachments(req: "AIRequest", allow_native_doc=False, allow_image=False):
+    """合并内联附件与文档库引用"""
+    text_part, media_parts = process_attachments_smart(req.attachments, allow_native_doc=allow_native_doc, allow_image=allow_image)
+    if req.attachmentIds:
+        doc_text, doc_media = process_document_refs(req.attachmentIds, allow_native_doc=allow_native_doc, allow_image=allow_image)
+        text_part += doc_text
+        media_parts += doc_media
+    return text_part, media_parts
+
+# ★★★ [新增] 文档上传接口：请求体直接是文件原始字节，不需要 Base64 ★★★
+@app.post("/api/documents")
+async def upload_document(request: Request, name: str, type: str = ""):
+    raw = await request.body()
+    if not raw:
+        raise HTTPException(status_code=400, detail="Empty document.")
+    mime_type = type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+    doc_id = await run_in_threadpool(store_blob_bytes, raw)
+    # 元数据读写 (含 fsync) 与加锁都是阻塞操作，放到线程池里，不占用事件循环
+    meta = await run_in_threadpool(_register_document, doc_id, name, mime_type, len(raw))
+    logger.info(f"Document uploaded: {name} ({len(raw)} bytes, {doc_id[:12]})")
+    return meta
+
+def _register_document(doc_id: str, name: str, mime_type: str, size: int) -> dict:
+    with _document_lock:
+        meta = _read_document_meta(doc_id)
+        # 同一份文件已经上传过 (内容寻址去重)；"processing" 只有本进程确实有任务在跑时才算，
+        # 否则是进程中途退出遗留下来的状态，需要重新提交提取
+        if meta and (meta.get("status") == "ready" or (meta.get("status") == "processing" and doc_id in _document_jobs)):
+            return meta
+        meta = {"id": doc_id, "name": name, "type": mime_type, "size": size,
+                "status": "processing", "kind": "", "uploadedAt": time.time()}
+        _write_document_meta(meta)
+        _submit_document_job(meta)
+    return meta
+
+@app.get("/api/documents")
+def list_documents():
+    docs = []
+    for f in sorted(os.listdir(DOCUMENTS_DIR)):
+        if f.endswith(".json"):
+            meta = _read_document_meta(f[:-5])
+            if meta:
+                docs.append(meta)
+    return {"documents": docs}
+
+@app.get("/api/documents/{doc_id}")
+def get_document(doc_id: str):
+    meta = _read_document_meta(doc_id)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return meta
+
+@app.delete("/api/documents/{doc_id}")
+def delete_document(doc_id: str):
+    meta = _read_document_meta(doc_id)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Document not found")
+    for path in (_document_meta_path(doc_id), _document_text_path(doc_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    logger.info(f"Document deleted: {meta['name']} ({doc_id[:12]})")
+    return {"status": "deleted", "id": doc_id}
+
+# --- [新增] 启动后后台预热 ---
+# SDK 与解析库在首次使用时才导入；服务启动后稍等片刻在后台线程预先导入，
+# 既不拖慢端口绑定，首个 AI 请求/附件解析也不必再付出导入开销。
+LAZY_WARMUP = True          # False 时完全按需导入 (省内存，首个请求会慢 1~2 秒)
+LAZY_WARMUP_DELAY = 1.0     # 启动后等待的秒数，让首屏请求先跑完
+
+def _log_warm_up(module, error):
+    if error is not None:
+        logger.warning(f"Warm-up import failed: {module!r}: {error}")
+    else:
+        logger.info(f"Warm-up imported {module!r} in {module.import_seconds or 0:.2f}s")
+
+def start_warm_up():
+    if LAZY_WARMUP:
+        warm_up([openai, anthropic, genai, pypdf, docx], delay=LAZY_WARMUP_DELAY, on_done=_log_warm_up)
+    # 页面文件读入内存并预先压缩，首次打开页面时不必等压缩
+    threading.Thread(target=static_assets.preload, args=(STATIC_PAGES,), name="asset-preload", daemon=True).start()
+
+# --- [新增] 提供商客户端池 ---
+# 按 (类型, apiKey 哈希, baseUrl, 代理) 缓存 SDK 客户端，复用 HTTP 连接池和 TLS 会话。
+# 代理配置挂在每个客户端自己的 httpx 实例 (Gemini 为 gRPC channel) 上，不再改写进程级的 os.environ。
+CLIENT_IDLE_TTL = 900  # 秒，闲置超过该时间的客户端会被关闭回收
+
+_client_pool: Dict[tuple, list] = {}  # key -> [client, last_used]
+_client_pool_lock = threading.Lock()
+
+def _proxy_url(req: AIRequest):
+    if req.useProxy and req.proxyPort:
+        return f"http://127.0.0.1:{req.proxyPort}"
+    return None
+
+def _create_client(kind: str, req: AIRequest):
+    proxy = _proxy_url(req)
+    base_url = req.baseUrl.strip() or "https://api.openai.com/v1"
+    # 使用 SDK 自带的 httpx 客户端子类 (保留其超时/连接池默认值)，只额外指定代理
+    if kind == "claude":
+        return anthropic.Anthropic(api_key=req.apiKey, http_client=anthropic.DefaultHttpxClient(proxy=proxy))
+    if kind == "claude_async":
+        return anthropic.AsyncAnthropic(api_key=req.apiKey, http_client=anthropic.DefaultAsyncHttpxClient(proxy=proxy))
+    if kind == "openai":
+        return openai.OpenAI(api_key=req.apiKey, base_url=base_url, http_client=openai.DefaultHttpxClient(proxy=proxy))
+    if kind == "openai_async":
+        return openai.AsyncOpenAI(api_key=req.apiKey, base_url=base_url,
+                                  http_client=openai.DefaultAsyncHttpxClient(proxy=proxy))
+    if kind == "gemini":
+        return glm.GenerativeServiceClient(client_options={"api_key": req.apiKey},
+                                           transport=_gemini_transport(glm.GenerativeServiceClient, "grpc", proxy))
+    if kind == "gemini_async":
+        return glm.GenerativeServiceAsyncClient(
+            client_options={"api_key": req.apiKey},
+            transport=_gemini_transport(glm.GenerativeServiceAsyncClient, "grpc_asyncio", proxy))
+    raise ValueError(f"Unknown client kind: {kind}")
+
+def _gemini_transport(client_cls, name: str, proxy: Optional[str]):
+    """Gemini 走 gRPC：代理作为该客户端自己的 channel 参数 (grpc.http_proxy)，不经过环境变量"""
+    transport_cls = client_cls.get_transport_class(name)
+
+    def channel(*args, **kwargs):
+        if proxy:
+            kwargs["options"] = list(kwargs.get("options") or []) + [("grpc.http_proxy", proxy)]
+        return transport_cls.create_channel(*args, **kwargs)
+
+    return lambda **kwargs: transport_cls(channel=channel, **kwargs)
+
+_client_loop = None          # 异步客户端所在的事件循环 (首次在异步路由里取客户端时记录)
+_closing_tasks: set = set()  # 正在关闭的异步客户端任务，保持引用以免被 GC 提前回收
+
+def _close_client(client):
+    try:
+        # gRPC 客户端 (Gemini) 没有 close()，关闭的是它的 transport
+        close = getattr(client, "close", None) or client.transport.close
+        result = close()
+        if asyncio.iscoroutine(result):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None
+            if loop is not None:
+                task = loop.create_task(result)
+                _closing_tasks.add(task)
+                task.add_done_callback(_closing_tasks.discard)
+            elif _client_loop is not None and _client_loop.is_running():
+                # 在同步路由的线程里淘汰：httpx 连接池属于客户端所在的事件循环，交给它去关闭
+                asyncio.run_coroutine_threadsafe(result, _client_loop)
+            else:
+                asyncio.run(result)
+    except Exception as e:
+        logger.warning(f"Error closing provider client: {e}")
+
+def get_provider_client(kind: str, req: AIRequest):
+    now = time.monotonic()
+    key_hash = hashlib.sha256(req.apiKey.encode("utf-8")).hexdigest()
+    key = (kind, key_hash, req.baseUrl.strip(), _proxy_url(req))
+    global _client_loop
+    if _client_loop is None:
+        try:
+            _client_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+    with _client_pool_lock:
+        for k in [k for k, v in _client_pool.items() if now - v[1] > CLIENT_IDLE_TTL]:
+            _close_client(_client_pool.pop(k)[0])
+        entry = _client_pool.get(key)
+        if entry is None:
+            entry = [_create_client(kind, req), now]
+            _client_pool[key] = entry
+            logger.info(f"Provider client created: {kind} (pool size {len(_client_pool)})")
+        entry[1] = now
+        return entry[0]
+
+# Gemini SDK 的 genai.configure 是进程级的，不同 apiKey/代理的请求会互相覆盖：
+# 改为从客户端池取该请求自己的 gRPC 客户端，直接挂到模型对象上 (SDK 只在 _client 为空时才用全局配置)。
+def get_gemini_model(req: AIRequest, asynchronous: bool = False):
+    model = genai.GenerativeModel(model_name=req.model or "gemini-2.5-flash")
+    if asynchronous:
+        model._async_client = get_provider_client("gemini_async", req)
+    else:
+        model._client = get_provider_client("gemini", req)
+    return model
+
+# --- [新增] 各提供商请求构造 (同步/流式接口共用) ---
+
+def build_gemini_content(req: AIRequest) -> list:
+    # 允许 Native Doc (PDF) 和 Image
+    text_part, media_parts = collect_attachments(req, allow_native_doc=True, allow_image=True)
+    
+    # 拼接文本上下文
+    prompt_full = req.systemPrompt + "\n\n=== CONTEXT ===\n" + req.context + text_part + "\n\n=== INSTRUCTION ===\n" + req.userPrompt
+    
+    # 构造 Gemini 请求部分
+    content_list = [prompt_full]
+    for m in media_parts:
+        content_list.append({"mime_type": m["mime_type"], "data": m["data"]})
+    return content_list
+
+def build_claude_content(req: AIRequest) -> list:
+    # 不允许 Native Doc (转文本)，允许 Image
+    text_part, media_parts = collect_attachments(req, allow_native_doc=False, allow_image=True)
+    
+    content_blocks = []
+    # 添加图片
+    for m in media_parts:
+        mime = m["mime_type"]
+        # Claude 严格的 mime 校验
+        if mime not in ["image/jpeg", "image/png", "image/gif", "image/webp"]:
+            mime = "image/jpeg"
+        content_blocks.append({
+            "type": "image",
+            "source": {"type": "base64", "media_type": mime, "data": m["data"]}
+        })
+    
+    # 添加文本
+    if req.promptCache:
+        # [新增] 上下文 (世界状态 + 附件) 作为可缓存前缀，只有指令部分每次变化
+        content_blocks.append({"type": "text", "text": f"=== CONTEXT ===\n{req.context}\n{text_part}\n",
+                               "cache_control": {"type": "ephemeral"}})
+        content_blocks.append({"type": "text", "text": f"=== INSTRUCTION ===\n{req.userPrompt}"})
+    else:
+        final_text = f"=== CONTEXT ===\n{req.context}\n{text_part}\n=== INSTRUCTION ===\n{req.userPrompt}"
+        content_blocks.append({"type": "text", "text": final_text})
+    return content_blocks
+
+def build_openai_messages(req: AIRequest, can_see_image: bool) -> list:
+    # 根据模型能力决定是否允许图片
+    # 不允许 Native Doc (OpenAI API 不支持直接传 PDF)，根据 can_see_image 决定是否允许 Image
+    text_part, media_parts = collect_attachments(req, allow_native_doc=False, allow_image=can_see_image)
+
+    final_text = f"=== CONTEXT ===\n{req.context}\n{text_part}\n=== INSTRUCTION ===\n{req.userPrompt}"
+    
+    messages = [{"role": "system", "content": req.systemPrompt}]
+    
+    # 如果有媒体文件 (图片)，必须使用 content 数组格式
+    if len(media_parts) > 0:
+        user_content = [{"type": "text", "text": final_text}]
+        for m in media_parts:
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{m['mime_type']};base64,{m['data']}"}
+            })
+        messages.append({"role": "user", "content": user_content})
+    else:
+        # 只有文本，直接发字符串 (DeepSeek 最兼容的格式)
+        messages.append({"role": "user", "content": final_text})
+    return messages
+
+# --- [新增] AI 响应缓存 ---
+# 重试/重跑分支时请求往往完全相同，按 (提供商, 模型, 规范化后的提示词, 附件哈希) 缓存结果。
+RESPONSE_CACHE_TTL = 3600           # 秒
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+_response_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (过期时间, 结果)
+_response_cache_lock = threading.Lock()
+
+def _normalize_prompt(text: str) -> str:
+    # 统一换行、去掉行尾空白，避免 UI 细微差异导致缓存失效
+    return "\n".join(line.rstrip() for line in (text or "").replace("\r\n", "\n").split("\n")).strip()
+
+def response_cache_key(req: AIRequest) -> str:
+    h = hashlib.sha256()
+    parts = [req.provider.lower(), req.model, req.baseUrl.strip(),
+             _normalize_prompt(req.systemPrompt), _normalize_prompt(req.history),
+             _normalize_prompt(req.context), _normalize_prompt(req.userPrompt)]
+    for att in req.attachments:
+        data_b64 = re.sub(r'^data:.*?;base64,', '', att.get('data', '')).strip()
+        parts.append(_attachment_cache_key(att.get('type', ''), data_b64))
+    parts.extend(req.attachmentIds)  # 文档 ID 本身就是内容哈希
+    for p in parts:
+        h.update(p.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def response_cache_get(key: str):
+    with _response_cache_lock:
+        hit = _response_cache.get(key)
+        if not hit:
+            return None
+        if hit[0] < time.time():
+            del _response_cache[key]
+            return None
+        _response_cache.move_to_end(key)
+        return hit[1]
+
+def response_cache_put(key: str, result_text: str):
+    if not key or not result_text or result_text == "Blocked.":
+        return
+    with _response_cache_lock:
+        _response_cache[key] = (time.time() + RESPONSE_CACHE_TTL, result_text)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+
+def build_claude_system(req: AIRequest):
+    # [新增] 提示词缓存：长而稳定的系统提示词标记为可缓存前缀
+    if req.promptCache and req.systemPrompt:
+        return [{"type": "text", "text": req.systemPrompt, "cache_control": {"type": "ephemeral"}}]
+    return req.systemPrompt
+
+def provider_usage(obj) -> dict:
+    """从各家 SDK 的返回对象 (或流式分片) 中取出 token 用量，没有则返回空字典"""
+    usage = getattr(obj, "usage_metadata", None)  # Gemini
+    if usage is not None:
+        return {"prompt": getattr(usage, "prompt_token_count", 0) or 0,
+                "completion": getattr(usage, "candidates_token_count", 0) or 0}
+    usage = getattr(obj, "usage", None)
+    if usage is None:
+        return {}
+    if hasattr(usage, "input_tokens"):  # Claude
+        return {"prompt": usage.input_tokens or 0, "completion": usage.output_tokens or 0,
+                "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+                "cache_write": getattr(usage, "cache_creation_input_tokens", 0) or 0}
+    return {"prompt": getattr(usage, "prompt_tokens", 0) or 0,  # OpenAI 兼容
+            "completion": getattr(usage, "completion_tokens", 0) or 0}
+
 @app.post("/api/ai/generate")
 def ai_generate(req: AIRequest):
     # 1. 日志记录
-    raw_dump = req.model_dump()
-    safe_log_req = smart_clean_payload(raw_dump)
-    logger.info(f"AI Request Received. Payload:\n{json.dumps(safe_log_req, indent=2, ensure_ascii=False)}")
-    
-    # 2. 代理设置
-    if req.useProxy and req.proxyPort:
-        os.environ["HTTP_PROXY"] = f"http://127.0.0.1:{req.proxyPort}"
-        os.environ["HTTPS_PROXY"] = f"http://127.0.0.1:{req.proxyPort}"
-    else:
-        os.environ.pop("HTTP_PROXY", None)
-        os.environ.pop("HTTPS_PROXY", None)
+    # [新增] payload 延迟到日志线程再 model_dump / 脱敏 / 序列化
+    logger.info("AI Request Received", extra={"payload": req})
 
+    # [新增] 响应缓存
+    cache_key = response_cache_key(req) if req.cache else None
+    if cache_key and not req.bypassCache:
+        cached = response_cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"AI Response (cache hit {cache_key[:12]})")
+            record_ai_call(req, "generate", 0, "cached")
+            return {"result": cached, "cached": True}
+    
+    started = time.perf_counter()
     try:
         provider = req.provider.lower()
         model_name = req.model.lower()
@@ -543,135 +2255,367 @@ def ai_generate(req: AIRequest):
         # === A. Gemini (原生支持 PDF 和 图片) ===
         if provider == "gemini":
             if not req.apiKey: raise HTTPException(status_code=400, detail="Missing API Key")
-            genai.configure(api_key=req.apiKey)
-            model = genai.GenerativeModel(model_name=req.model or "gemini-2.5-flash")
-            
-            # 允许 Native Doc (PDF) 和 Image
-            text_part, media_parts = process_attachments_smart(req.attachments, allow_native_doc=True, allow_image=True)
-            
-            # 拼接文本上下文
-            prompt_full = req.systemPrompt + "\n\n=== CONTEXT ===\n" + req.context + text_part + "\n\n=== INSTRUCTION ===\n" + req.userPrompt
-            
-            # 构造 Gemini 请求部分
-            content_list = [prompt_full]
-            for m in media_parts:
-                content_list.append({"mime_type": m["mime_type"], "data": m["data"]})
+            model = get_gemini_model(req)
             
-            response = model.generate_content(content_list)
+            response = model.generate_content(build_gemini_content(req))
             result_text = response.text if response.text else "Blocked."
-            logger.info(f"AI Response (Gemini): {result_text}")
+            logger.info("AI Response (Gemini)", extra={"payload": result_text})
+            record_ai_call(req, "generate", started, "ok", provider_usage(response))
+            response_cache_put(cache_key, result_text)
             return {"result": result_text}
 
         # === B. Claude (支持图片，但不支持原生 PDF 文件流，需转文本) ===
         elif provider == "claude":
             if not req.apiKey: raise HTTPException(status_code=400, detail="Missing API Key")
-            client = anthropic.Anthropic(api_key=req.apiKey)
+            client = get_provider_client("claude", req)
             
-            # 不允许 Native Doc (转文本)，允许 Image
-            text_part, media_parts = process_attachments_smart(req.attachments, allow_native_doc=False, allow_image=True)
-            
-            final_text = f"=== CONTEXT ===\n{req.context}\n{text_part}\n=== INSTRUCTION ===\n{req.userPrompt}"
-            
-            content_blocks = []
-            # 添加图片
-            for m in media_parts:
-                mime = m["mime_type"]
-                # Claude 严格的 mime 校验
-                if mime not in ["image/jpeg", "image/png", "image/gif", "image/webp"]:
-                    mime = "image/jpeg"
-                content_blocks.append({
-                    "type": "image",
-                    "source": {"type": "base64", "media_type": mime, "data": m["data"]}
-                })
-            
-            # 添加文本
-            content_blocks.append({"type": "text", "text": final_text})
-
             message = client.messages.create(
                 model=req.model or "claude-3-5-sonnet-20240620",
                 max_tokens=4096,
-                system=req.systemPrompt,
-                messages=[{"role": "user", "content": content_blocks}]
+                system=build_claude_system(req),
+                messages=[{"role": "user", "content": build_claude_content(req)}]
             )
             result_text = message.content[0].text
-            logger.info(f"AI Response (Claude): {result_text}")
+            logger.info("AI Response (Claude)", extra={"payload": result_text})
+            record_ai_call(req, "generate", started, "ok", provider_usage(message))
+            response_cache_put(cache_key, result_text)
             return {"result": result_text}
 
         # === C. OpenAI Compatible (DeepSeek, GPT, Qwen, etc) ===
         else:
             if not req.apiKey: raise HTTPException(status_code=400, detail="Missing API Key")
-            base_url = req.baseUrl.strip() or "https://api.openai.com/v1"
-            client = OpenAI(api_key=req.apiKey, base_url=base_url)
-            
-            # 根据模型能力决定是否允许图片
-            # 不允许 Native Doc (OpenAI API 不支持直接传 PDF)，根据 can_see_image 决定是否允许 Image
-            text_part, media_parts = process_attachments_smart(req.attachments, allow_native_doc=False, allow_image=can_see_image)
-
-            final_text = f"=== CONTEXT ===\n{req.context}\n{text_part}\n=== INSTRUCTION ===\n{req.userPrompt}"
-            
-            messages = [{"role": "system", "content": req.systemPrompt}]
+            client = get_provider_client("openai", req)
             
-            # 如果有媒体文件 (图片)，必须使用 content 数组格式
-            if len(media_parts) > 0:
-                user_content = [{"type": "text", "text": final_text}]
-                for m in media_parts:
-                    user_content.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:{m['mime_type']};base64,{m['data']}"}
-                    })
-                messages.append({"role": "user", "content": user_content})
-            else:
-                # 只有文本，直接发字符串 (DeepSeek 最兼容的格式)
-                messages.append({"role": "user", "content": final_text})
-
             completion = client.chat.completions.create(
                 model=req.model,
-                messages=messages,
+                messages=build_openai_messages(req, can_see_image),
                 temperature=0.7,
             )
             result_text = completion.choices[0].message.content
-            logger.info(f"AI Response (OpenAI/Compatible): {result_text}")
+            logger.info("AI Response (OpenAI/Compatible)", extra={"payload": result_text})
+            record_ai_call(req, "generate", started, "ok", provider_usage(completion))
+            response_cache_put(cache_key, result_text)
             return {"result": result_text}
 
     except Exception as e:
         logger.error(f"AI Generation Failed: {str(e)}", exc_info=True)
+        record_ai_call(req, "generate", started, "error")
         raise HTTPException(status_code=500, detail=f"AI Error: {str(e)}")
 
+# --- [新增] 流式生成 (SSE) ---
+# 使用各家 SDK 的异步客户端 + 流式接口，不占用线程池，前端可以实时看到输出。
+async def _stream_gemini(req: AIRequest, content_list: list, usage: dict = None):
+    model = get_gemini_model(req, asynchronous=True)
+    response = await model.generate_content_async(content_list, stream=True)
+    async for chunk in response:
+        if usage is not None:
+            usage.update(provider_usage(chunk))  # 用量在最后一个分片里
+        try:
+            text = chunk.text
+        except ValueError:
+            # 被安全策略拦截的分片没有 text
+            continue
+        if text:
+            yield text
+
+async def _stream_claude(req: AIRequest, content_blocks: list, max_retries: int = None, usage: dict = None):
+    client = get_provider_client("claude_async", req)
+    if max_retries is not None:
+        client = client.with_options(max_retries=max_retries)
+    async with client.messages.stream(
+        model=req.model or "claude-3-5-sonnet-20240620",
+        max_tokens=4096,
+        system=build_claude_system(req),
+        messages=[{"role": "user", "content": content_blocks}]
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+        if usage is not None:
+            usage.update(provider_usage(await stream.get_final_message()))
+
+async def _stream_openai(req: AIRequest, messages: list, max_retries: int = None, usage: dict = None):
+    client = get_provider_client("openai_async", req)
+    if max_retries is not None:
+        client = client.with_options(max_retries=max_retries)
+    stream = await client.chat.completions.create(
+        model=req.model,
+        messages=messages,
+        temperature=0.7,
+        stream=True,
+    )
+    async for chunk in stream:
+        if usage is not None and getattr(chunk, "usage", None):
+            # 部分兼容接口 (如 DeepSeek) 会在最后一个分片附带用量
+            usage.update(provider_usage(chunk))
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def open_provider_stream(req: AIRequest, max_retries: int = None, usage: dict = None):
+    """usage: 传入字典时，流结束后填入 token 用量 (提供商返回了的话)"""
+    provider = req.provider.lower()
+    # 附件解析是 CPU 密集的同步代码，丢到线程池里做，不阻塞事件循环
+    if provider == "gemini":
+        payload = await run_in_threadpool(build_gemini_content, req)
+        return _stream_gemini(req, payload, usage)
+    if provider == "claude":
+        payload = await run_in_threadpool(build_claude_content, req)
+        return _stream_claude(req, payload, max_retries, usage)
+    can_see_image = is_vision_model(provider, req.model.lower())
+    payload = await run_in_threadpool(build_openai_messages, req, can_see_image)
+    return _stream_openai(req, payload, max_retries, usage)
+
+def _sse(payload: dict, event: str = "") -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.post("/api/ai/stream")
+async def ai_stream(req: AIRequest):
+    logger.info("AI Stream Request Received", extra={"payload": req})
+
+    if not req.apiKey:
+        raise HTTPException(status_code=400, detail="Missing API Key")
+
+    # [新增] 响应缓存：命中时把完整结果作为单个片段推送
+    cache_key = response_cache_key(req) if req.cache else None
+    if cache_key and not req.bypassCache:
+        cached = response_cache_get(cache_key)
+        if cached is not None:
+            logger.info(f"AI Stream Response (cache hit {cache_key[:12]})")
+            record_ai_call(req, "stream", 0, "cached")
+            async def cached_stream():
+                yield _sse({"delta": cached})
+                yield _sse({"result": cached, "cached": True}, event="done")
+            return StreamingResponse(cached_stream(), media_type="text/event-stream",
+                                     headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    provider = req.provider.lower()
+    started, usage = time.perf_counter(), {}
+    try:
+        chunks = await open_provider_stream(req, usage=usage)
+    except Exception:
+        record_ai_call(req, "stream", started, "error")
+        raise
+
+    async def event_stream():
+        parts = []
+        try:
+            async for text in chunks:
+                parts.append(text)
+                yield _sse({"delta": text})
+            result_text = "".join(parts) or "Blocked."
+            logger.info(f"AI Stream Response ({provider})", extra={"payload": result_text})
+            record_ai_call(req, "stream", started, "ok", usage)
+            response_cache_put(cache_key, result_text)
+            yield _sse({"result": result_text}, event="done")
+        except Exception as e:
+            logger.error(f"AI Stream Failed: {str(e)}", exc_info=True)
+            record_ai_call(req, "stream", started, "error")
+            yield _sse({"detail": f"AI Error: {str(e)}"}, event="error")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- [新增] 批量推演：并发 + 按提供商限流 + 抖动退避重试 ---
+# 同一账号 (提供商 + 接口地址 + Key) 共享一个并发上限和令牌桶；结果按完成顺序以 SSE 推送。
+BATCH_MAX_REQUESTS = 32
+BATCH_MAX_RETRIES = 4
+BATCH_BACKOFF_BASE = 1.0      # 秒，第 n 次重试的退避上限为 base * 2^n
+BATCH_BACKOFF_MAX = 30.0
+PROVIDER_LIMITS = {           # 提供商 -> (最大并发, 每秒请求数, 突发容量)
+    "gemini": (4, 1.0, 4),
+    "claude": (4, 1.0, 4),
+    "default": (6, 2.0, 6),
+}
+
+class AIBatchRequest(BaseModel):
+    requests: List[AIRequest]
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, seconds: float):
+        # 收到 429 时清空令牌，让同一账号的其他请求一起放缓
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+_provider_limiters: Dict[tuple, tuple] = {}
+
+def _provider_limiter(req: AIRequest):
+    provider = req.provider.lower()
+    key = (provider, req.baseUrl.strip(), hashlib.sha256(req.apiKey.encode("utf-8")).hexdigest())
+    limiter = _provider_limiters.get(key)
+    if limiter is None:
+        concurrency, rate, burst = PROVIDER_LIMITS.get(provider, PROVIDER_LIMITS["default"])
+        limiter = (asyncio.Semaphore(concurrency), _TokenBucket(rate, burst))
+        _provider_limiters[key] = limiter
+    return limiter
+
+def _retry_delay(exc: Exception):
+    """可重试的错误返回建议等待秒数 (来自 Retry-After，可能为 0)，否则返回 None"""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        code = getattr(exc, "code", None)  # google.api_core 异常
+        status = code if isinstance(code, int) else None
+    retryable = status in (408, 409, 429) or (status is not None and status >= 500)
+    if status is None:
+        # 只检查已加载的 SDK：异常来自某个 SDK，说明它一定已经导入了
+        sdk_errors = tuple(m.APIConnectionError for m in (anthropic, openai) if m.loaded)
+        retryable = isinstance(exc, (asyncio.TimeoutError, ConnectionError) + sdk_errors)
+    if not retryable:
+        return None
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+async def _generate_with_retry(req: AIRequest):
+    """返回 (结果文本, 尝试次数, 是否命中缓存)"""
+    cache_key = response_cache_key(req) if req.cache else None
+    if cache_key and not req.bypassCache:
+        cached = response_cache_get(cache_key)
+        if cached is not None:
+            record_ai_call(req, "batch", 0, "cached")
+            return cached, 0, True
+
+    semaphore, bucket = _provider_limiter(req)
+    attempt = 0
+    while True:
+        attempt += 1
+        started, usage = time.perf_counter(), {}
+        try:
+            async with semaphore:
+                await bucket.acquire()
+                started = time.perf_counter()  # 不计排队等待
+                # SDK 自带的重试关掉，统一由这里按账号限流后重试
+                chunks = await open_provider_stream(req, max_retries=0, usage=usage)
+                result_text = "".join([text async for text in chunks]) or "Blocked."
+            record_ai_call(req, "batch", started, "ok", usage)
+            response_cache_put(cache_key, result_text)
+            return result_text, attempt, False
+        except Exception as e:
+            record_ai_call(req, "batch", started, "error")
+            wait = _retry_delay(e)
+            if wait is None or attempt > BATCH_MAX_RETRIES:
+                raise
+            backoff = random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF_BASE * (2 ** (attempt - 1))))
+            delay = max(wait, backoff)
+            if getattr(e, "status_code", None) == 429 or getattr(e, "code", None) == 429:
+                bucket.penalize(delay)
+            logger.warning(f"Batch request retry {attempt}/{BATCH_MAX_RETRIES} in {delay:.1f}s: {str(e)}")
+            await asyncio.sleep(delay)
+
+@app.post("/api/ai/batch")
+async def ai_batch(batch: AIBatchRequest):
+    if not batch.requests:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(batch.requests) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"Too many requests (max {BATCH_MAX_REQUESTS})")
+    if any(not r.apiKey for r in batch.requests):
+        raise HTTPException(status_code=400, detail="Missing API Key")
+    logger.info(f"AI Batch Request Received: {len(batch.requests)} requests")
+
+    async def run_one(index: int, req: AIRequest):
+        started = time.monotonic()
+        try:
+            result_text, attempts, cached = await _generate_with_retry(req)
+            logger.info(f"AI Batch Response #{index} ({req.provider})", extra={"payload": result_text})
+            return "result", {"index": index, "result": result_text, "attempts": attempts, "cached": cached,
+                              "elapsed": round(time.monotonic() - started, 3)}
+        except Exception as e:
+            logger.error(f"AI Batch #{index} Failed: {str(e)}", exc_info=True)
+            return "failed", {"index": index, "detail": f"AI Error: {str(e)}"}
+
+    async def event_stream():
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(run_one(i, r)) for i, r in enumerate(batch.requests)]
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                event, payload = await next_done
+                failed += event == "failed"
+                yield _sse(payload, event=event)
+            yield _sse({"total": len(tasks), "failed": failed,
+                        "elapsed": round(time.monotonic() - started, 3)}, event="done")
+        finally:
+            # 客户端断开时取消仍在进行的请求
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # --- 托管网页 ---
+# [新增] 页面文件缓存在内存里 (改动后按 mtime 自动重新读取)，预压缩 gzip/br，带强 ETag；
+# no-cache 表示每次都向服务端确认，内容没变时只返回 304
+STATIC_PAGES = ["www/index.html", "www/map_editor.html", "www/api_layer.js", "www/logo.png"]
+STATIC_PAGE_CACHE_CONTROL = "no-cache"
+static_assets = AssetCache()
+
 @app.get("/")
-async def read_index():
-    if not os.path.exists("www/index.html"): # 指向 www
-        return JSONResponse(status_code=404, content={"error": "www/index.html not found"})
+async def read_index(request: Request):
     try:
-        with open("www/index.html", "r", encoding="utf-8") as f: # 指向 www
-            html_content = f.read()
-        return Response(content=html_content, media_type="text/html", headers={"Cache-Control": "no-cache"})
+        response = static_assets.response(request, "www/index.html", STATIC_PAGE_CACHE_CONTROL)  # 指向 www
     except Exception as e:
         logger.error(f"Index load error: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
+    if response is None:
+        return JSONResponse(status_code=404, content={"error": "www/index.html not found"})
+    return response
 
 @app.get("/logo.png")
-async def get_logo():
-    if os.path.exists("www/logo.png"): return FileResponse("www/logo.png")
-    return {"error": "Logo not found"}
+async def get_logo(request: Request):
+    response = static_assets.response(request, "www/logo.png", STATIC_PAGE_CACHE_CONTROL)
+    return response if response is not None else {"error": "Logo not found"}
 
 # ★★★ 新增：允许浏览器加载 api_layer.js ★★★
 @app.get("/api_layer.js")
-async def get_api_layer():
-    if os.path.exists("www/api_layer.js"):  # 指向 www
-        return FileResponse("www/api_layer.js", headers={"Cache-Control": "no-cache"}) 
-    return Response(status_code=404)
+async def get_api_layer(request: Request):
+    response = static_assets.response(request, "www/api_layer.js", STATIC_PAGE_CACHE_CONTROL)  # 指向 www
+    return response if response is not None else Response(status_code=404)
 
 
 # --- [新增] 地图编辑器路由 ---
 @app.get("/map_editor")
-async def get_map_editor():
-    if not os.path.exists("www/map_editor.html"): 
+async def get_map_editor(request: Request):
+    response = static_assets.response(request, "www/map_editor.html", STATIC_PAGE_CACHE_CONTROL)
+    if response is None:
         return Response(content="<h1>map_editor.html not found</h1>", media_type="text/html")
-    with open("www/map_editor.html", "r", encoding="utf-8") as f:
-        return Response(content=f.read(), media_type="text/html")
+    return response
 
 if __name__ == "__main__":
-    webbrowser.open("http://127.0.0.1:8000")
+    # PDF 进程池在打包后的 Windows 版本中需要这一行
+    multiprocessing.freeze_support()
+    # [新增] 启动参数：--workers N 起 N 个 worker 进程 (多张桌子同时推演时用满多核)，存档读写由 save_lock 跨进程互斥
+    parser = argparse.ArgumentParser(description="LevantD Engine Backend")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="worker 进程数 (默认 1)")
+    parser.add_argument("--no-browser", action="store_true", help="不自动打开浏览器 (服务器部署)")
+    args = parser.parse_args()
+
+    if not args.no_browser:
+        webbrowser.open(f"http://127.0.0.1:{args.port}")
     print("系统启动中... 日志保存在 logs/system.log")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    if args.workers > 1:
+        # 多进程模式下 uvicorn 需要按导入路径在每个 worker 里重新加载应用
+        os.environ[WORKERS_ENV] = str(args.workers)
+        uvicorn.run("server:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,142 @@
+"""
+静态资源缓存：index.html / map_editor.html / api_layer.js 等页面文件读入内存，
+预先压缩好 gzip (安装了 brotli 时再加一份 br)，按内容生成强 ETag，
+浏览器重新加载时只需一次 304。文件 mtime/大小变化时自动重新读取并压缩。
+
+    assets = AssetCache()
+    return assets.response(request, "www/index.html")   # 文件不存在时返回 None
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.staticfiles import StaticFiles
+
+try:
+    import brotli  # 可选依赖：比 gzip 再小 15~20%
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS_BYTES = 1024  # 太小的文件压缩不划算
+
+
+class Asset:
+    def __init__(self, path: str, stamp: tuple, body: bytes, media_type: str):
+        self.path = path
+        self.stamp = stamp
+        self.media_type = media_type
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants: Dict[str, bytes] = {"identity": body}  # Content-Encoding -> 内容
+
+    @property
+    def compressible(self) -> bool:
+        return len(self.variants) > 1
+
+    def etag(self, encoding: str) -> str:
+        # 不同编码的字节不同，强 ETag 也必须不同
+        return f'"{self.digest}"' if encoding == "identity" else f'"{self.digest}-{encoding}"'
+
+    def etags(self) -> List[str]:
+        return [self.etag(e) for e in self.variants]
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+
+class AssetCache:
+    def __init__(self, gzip_level: int = 9, brotli_quality: int = 9):
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._assets: Dict[str, Asset] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Optional[Asset]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_mtime_ns, st.st_size)
+        asset = self._assets.get(path)
+        if asset is not None and asset.stamp == stamp:
+            return asset
+        with self._lock:
+            asset = self._assets.get(path)
+            if asset is None or asset.stamp != stamp:
+                asset = self._load(path, stamp)
+                self._assets[path] = asset
+        return asset
+
+    def _load(self, path: str, stamp: tuple) -> Asset:
+        with open(path, "rb") as f:
+            body = f.read()
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if media_type.startswith("text/"):
+            media_type += "; charset=utf-8"
+        asset = Asset(path, stamp, body, media_type)
+        if len(body) >= MIN_COMPRESS_BYTES and media_type.startswith(COMPRESSIBLE_TYPES):
+            asset.variants["gzip"] = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+            if brotli is not None:
+                asset.variants["br"] = brotli.compress(body, quality=self.brotli_quality)
+        return asset
+
+    def preload(self, paths: List[str]):
+        """提前读入并压缩 (服务启动后在后台调用)，首次访问页面时就不必等压缩"""
+        for path in paths:
+            self.get(path)
+
+    def response(self, request: Request, path: str, cache_control: str = "no-cache") -> Optional[Response]:
+        asset = self.get(path)
+        if asset is None:
+            return None
+
+        encoding = "identity"
+        if asset.compressible:
+            accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+            for candidate in ("br", "gzip"):
+                if candidate in asset.variants and accepted.get(candidate, 0) > 0:
+                    encoding = candidate
+                    break
+
+        headers = {"ETag": asset.etag(encoding), "Cache-Control": cache_control}
+        if asset.compressible:
+            headers["Vary"] = "Accept-Encoding"
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = {t.strip()[2:] if t.strip().startswith("W/") else t.strip() for t in if_none_match.split(",")}
+            if "*" in tags or tags & set(asset.etags()):
+                return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=asset.variants[encoding], media_type=asset.media_type, headers=headers)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles 本身已支持 Range (音频拖动进度条) 与 ETag/Last-Modified 校验，这里只补上缓存时长"""
+
+    def __init__(self, *args, cache_control: str = "public, max-age=604800", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = self.cache_control
+        return response
@@ -0,0 +1,935 @@
+"""
+存档存储层：server.py 的读档/存档/增量补丁/删除都经由 SaveStorage 接口完成。
+
+- JSON 文件 (默认)：每个存档一个 saves/xxx.json + 增量日志，实现在 server.py (JsonFileStorage)。
+- SQLite (可选)：单个 WAL 模式数据库，势力/规则集/资料条目/回合/事件/影响各占一张带索引的表。
+  写入时按行摘要比较，只重写变化的行；读档结果按修订号缓存。
+- 分支存档 (BranchStorage)：包在上述后端之外，分支只保存分叉后的回合与改动过的字段，其余与父存档共享 (写时复制)。
+- 多进程部署 (uvicorn --workers N)：文件一律先写临时文件再 os.replace (atomic_write)，
+  同一存档 (分支族) 的读写由 SaveLocks 的锁文件在进程间互斥。
+
+导入/导出工具：
+    python storage.py import saves/levant.db saves/*.json     # JSON 存档 -> SQLite
+    python storage.py export saves/levant.db out_dir [names]  # SQLite -> JSON 存档
+    python storage.py list saves/levant.db
+导入时会先重放各存档的增量日志；分支存档保留分支关系 (父存档需一并导入或已在库中)，导出时展开为完整的独立存档。
+"""
+import copy
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+try:
+    import orjson  # 可选依赖：更快的 JSON 编解码
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # POSIX 文件锁
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt  # Windows 文件锁
+except ImportError:
+    msvcrt = None
+
+LOCK_TIMEOUT = 30.0         # 等待其他进程释放存档锁的最长时间 (秒)
+LOCK_POLL_INTERVAL = 0.01
+
+
+def _dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def _loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# --- 原子写入与进程间锁 ---
+
+def _fsync_dir(path: str):
+    if os.name == "nt":
+        return  # Windows 无法打开目录做 fsync，os.replace 本身已是原子的
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, data: bytes, durable: bool = True):
+    """
+    先写同目录下的临时文件再 os.replace：读者 (包括其他进程) 只会看到旧文件或完整的新文件。
+    durable 时 fsync 文件与所在目录，崩溃/断电后也不会留下截断的文件。
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"  # 进程/线程各用各的临时文件
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    if durable:
+        _fsync_dir(os.path.dirname(path))
+
+
+def append_durable(path: str, data: bytes, durable: bool = True):
+    """追加写 (增量日志)；O_APPEND 下多进程各自追加的整行不会互相穿插"""
+    with open(path, "ab") as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class FileLock:
+    """
+    进程间排他锁 (POSIX flock / Windows msvcrt.locking)，锁随文件句柄关闭或进程退出自动释放。
+    同一个 FileLock 对象在进程内的线程之间也互斥；不可重入。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+        self._thread_lock = threading.Lock()
+
+    def acquire(self, timeout: float = LOCK_TIMEOUT):
+        if not self._thread_lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Timed out waiting for lock: {self.path}")
+        try:
+            self._fd = self._acquire_file(timeout)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def _acquire_file(self, timeout: float) -> int:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                elif msvcrt is not None:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    raise TimeoutError(f"Timed out waiting for lock: {self.path}")
+                time.sleep(LOCK_POLL_INTERVAL)
+        return fd
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SaveLocks:
+    """
+    按存档名加锁：进程内每个名字一把 threading.Lock，进程间在 lock_dir 下每个名字一个锁文件
+    (不删除，避免与正在等待的进程竞争)。不同存档的读写互不阻塞；多个名字按排序后的顺序加锁，不会死锁。
+    """
+
+    def __init__(self, lock_dir: str, timeout: float = LOCK_TIMEOUT):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        self._thread_locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _thread_lock(self, name: str) -> threading.Lock:
+        with self._guard:
+            return self._thread_locks.setdefault(name, threading.Lock())
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.lock_dir, hashlib.sha1(name.encode("utf-8")).hexdigest()[:16] + ".lock")
+
+    @contextmanager
+    def hold(self, *names: str):
+        held = []
+        try:
+            for name in sorted(set(names)):
+                thread_lock = self._thread_lock(name)
+                if not thread_lock.acquire(timeout=self.timeout):
+                    raise TimeoutError(f"Timed out waiting for save lock: {name}")
+                held.append(thread_lock)
+                lock = FileLock(self._path(name))
+                lock.acquire(self.timeout)
+                held.append(lock)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+
+class SaveStorage:
+    """
+    存储后端接口。load 返回的文档可能是缓存对象，调用方在读写前需持有该存档的锁 (server 的 save_lock)；
+    不同存档可能在不同线程里同时读写，后端内部的共享缓存要自己加锁。
+    """
+
+    name = "base"
+
+    def list_saves(self) -> List[str]:
+        raise NotImplementedError
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def load(self, name: str) -> dict:
+        raise NotImplementedError
+
+    def save(self, name: str, doc: dict):
+        raise NotImplementedError
+
+    def prepare_patch(self, name: str, doc: dict, ops: List[Dict[str, Any]], extra_keys: Iterable[str] = ()):
+        """
+        doc (load 的结果) 即将被 ops 就地修改、尚未修改时调用；extra_keys 是随后还会改动的其他顶层字段
+        (如公式重算的结果)。默认什么都不做。
+        """
+
+    def commit_patch(self, name: str, doc: dict, ops: List[Dict[str, Any]]) -> int:
+        """doc 已经应用了 ops，持久化这次修改；返回未压缩的增量条数 (无日志的后端返回 0)"""
+        self.save(name, doc)
+        return 0
+
+    def delete(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def invalidate(self, name: str):
+        """丢弃缓存 (内存中的文档可能已被部分修改)"""
+
+    def lock_name(self, name: str) -> str:
+        """读写 name 时要持有的进程间锁 (见 SaveLocks)；会连带修改其他存档的后端返回它们共同的锁名"""
+        return name
+
+    def stamp(self, name: str) -> Optional[list]:
+        """廉价的版本标记 (文件 mtime/大小、修订号)，存档被修改后一定会变；不存在时返回 None"""
+        raise NotImplementedError
+
+    def stat(self, name: str) -> Dict[str, Any]:
+        """{"size": 占用字节数, "mtime": 最后修改时间戳}"""
+        raise NotImplementedError
+
+    def find_impacts(self, name: str, target_id: str) -> List[dict]:
+        """某个实体受到的全部影响，按时间顺序"""
+        out = []
+        for t_idx, turn in enumerate(self.load(name).get("timeline", [])):
+            for e_idx, event in enumerate(turn.get("events", [])):
+                for impact in event.get("impacts", []) or []:
+                    if impact.get("targetId") == target_id:
+                        out.append({"turnId": turn.get("id"), "turnIndex": t_idx, "eventIndex": e_idx,
+                                    "summary": event.get("summary", ""), "impact": impact})
+        return out
+
+    def blob_refs_text(self):
+        """逐个产出可能包含 blob 引用的文本，供 blob GC 扫描"""
+        for name in self.list_saves():
+            yield _dumps(self.load(name))
+
+
+# --- SQLite 后端 ---
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saves (
+    name TEXT PRIMARY KEY,
+    rev INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    meta TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS factions (
+    save TEXT NOT NULL, idx INTEGER NOT NULL, id TEXT, name TEXT, digest TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (save, idx)
+);
+CREATE INDEX IF NOT EXISTS factions_by_id ON factions (save, id);
+CREATE TABLE IF NOT EXISTS rule_sets (
+    save TEXT NOT NULL, idx INTEGER NOT NULL, id TEXT, digest TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (save, idx)
+);
+CREATE TABLE IF NOT EXISTS lore_entries (
+    save TEXT NOT NULL, idx INTEGER NOT NULL, keys TEXT, mode TEXT, digest TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (save, idx)
+);
+CREATE TABLE IF NOT EXISTS turns (
+    save TEXT NOT NULL, idx INTEGER NOT NULL, id INTEGER, time_range TEXT, digest TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (save, idx)
+);
+CREATE TABLE IF NOT EXISTS events (
+    save TEXT NOT NULL, turn_idx INTEGER NOT NULL, idx INTEGER NOT NULL, faction_id TEXT, summary TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (save, turn_idx, idx)
+);
+CREATE INDEX IF NOT EXISTS events_by_faction ON events (save, faction_id);
+CREATE TABLE IF NOT EXISTS impacts (
+    save TEXT NOT NULL, turn_idx INTEGER NOT NULL, event_idx INTEGER NOT NULL, idx INTEGER NOT NULL,
+    target_id TEXT, attr_key TEXT, data TEXT NOT NULL,
+    PRIMARY KEY (save, turn_idx, event_idx, idx)
+);
+CREATE INDEX IF NOT EXISTS impacts_by_target ON impacts (save, target_id);
+"""
+
+# 顶层列表字段 -> (表名, 额外列, 取值函数)
+_LIST_TABLES = {
+    "players": ("factions", ("id", "name"), lambda e: (e.get("id"), e.get("name"))),
+    "rule_sets": ("rule_sets", ("id",), lambda e: (e.get("id"),)),
+    "lorebook": ("lore_entries", ("keys", "mode"), lambda e: (e.get("keys"), e.get("mode"))),
+}
+
+
+class SqliteStorage(SaveStorage):
+    name = "sqlite"
+
+    def __init__(self, path: str, cache_size: int = 4, on_load: Optional[Callable[[dict], Any]] = None,
+                 durable: bool = True):
+        self.path = path
+        self.cache_size = cache_size
+        self.durable = durable  # False 时 synchronous=NORMAL：断电可能丢最近的提交，但不会损坏数据库
+        self.on_load = on_load  # 读档后的处理 (如把内联 base64 抽到 blob 存储)
+        self._local = threading.local()
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()  # name -> (rev, doc)
+        self._cache_lock = threading.Lock()
+        with self._conn() as db:
+            db.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(f"PRAGMA synchronous={'FULL' if self.durable else 'NORMAL'}")
+            db.execute("PRAGMA foreign_keys=OFF")
+            self._local.db = db
+        return db
+
+    # --- 读 ---
+
+    def list_saves(self) -> List[str]:
+        return [r[0] for r in self._conn().execute("SELECT name FROM saves ORDER BY name")]
+
+    def exists(self, name: str) -> bool:
+        return self._rev(name) is not None
+
+    def _rev(self, name: str) -> Optional[int]:
+        row = self._conn().execute("SELECT rev FROM saves WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, name: str) -> dict:
+        rev = self._rev(name)
+        if rev is None:
+            raise FileNotFoundError(name)
+        with self._cache_lock:
+            cached = self._cache.get(name)
+            if cached and cached[0] == rev:
+                self._cache.move_to_end(name)
+                return cached[1]
+
+        db = self._conn()
+        db.execute("BEGIN")
+        try:
+            rev, meta = db.execute("SELECT rev, meta FROM saves WHERE name = ?", (name,)).fetchone()
+            doc = _loads(meta)
+            for key, (table, _, _) in _LIST_TABLES.items():
+                doc[key] = [_loads(d) for (d,) in
+                            db.execute(f"SELECT data FROM {table} WHERE save = ? ORDER BY idx", (name,))]
+
+            impacts: Dict[tuple, list] = {}
+            for t_idx, e_idx, data in db.execute(
+                    "SELECT turn_idx, event_idx, data FROM impacts WHERE save = ? ORDER BY turn_idx, event_idx, idx",
+                    (name,)):
+                impacts.setdefault((t_idx, e_idx), []).append(_loads(data))
+            events: Dict[int, list] = {}
+            for t_idx, e_idx, data in db.execute(
+                    "SELECT turn_idx, idx, data FROM events WHERE save = ? ORDER BY turn_idx, idx", (name,)):
+                event = _loads(data)
+                event["impacts"] = impacts.get((t_idx, e_idx), [])
+                events.setdefault(t_idx, []).append(event)
+            timeline = []
+            for t_idx, data in db.execute("SELECT idx, data FROM turns WHERE save = ? ORDER BY idx", (name,)):
+                turn = _loads(data)
+                turn["events"] = events.get(t_idx, [])
+                timeline.append(turn)
+            doc["timeline"] = timeline
+        finally:
+            db.execute("COMMIT")
+
+        if self.on_load:
+            self.on_load(doc)
+        self._remember(name, rev, doc)
+        return doc
+
+    def _remember(self, name: str, rev: int, doc: dict):
+        with self._cache_lock:
+            self._cache[name] = (rev, doc)
+            self._cache.move_to_end(name)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, name: str):
+        with self._cache_lock:
+            self._cache.pop(name, None)
+
+    def stamp(self, name: str) -> Optional[list]:
+        rev = self._rev(name)
+        return None if rev is None else [rev]
+
+    def stat(self, name: str) -> Dict[str, Any]:
+        db = self._conn()
+        row = db.execute("SELECT updated_at, length(meta) FROM saves WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(name)
+        size = row[1]
+        for table in ("factions", "rule_sets", "lore_entries", "turns", "events", "impacts"):
+            size += db.execute(f"SELECT COALESCE(SUM(length(data)), 0) FROM {table} WHERE save = ?",
+                               (name,)).fetchone()[0]
+        return {"size": size, "mtime": row[0]}
+
+    def find_impacts(self, name: str, target_id: str) -> List[dict]:
+        rows = self._conn().execute(
+            "SELECT i.turn_idx, i.event_idx, t.id, e.summary, i.data FROM impacts i "
+            "JOIN events e ON e.save = i.save AND e.turn_idx = i.turn_idx AND e.idx = i.event_idx "
+            "JOIN turns t ON t.save = i.save AND t.idx = i.turn_idx "
+            "WHERE i.save = ? AND i.target_id = ? ORDER BY i.turn_idx, i.event_idx, i.idx",
+            (name, target_id))
+        return [{"turnId": turn_id, "turnIndex": t_idx, "eventIndex": e_idx, "summary": summary or "",
+                 "impact": _loads(data)} for t_idx, e_idx, turn_id, summary, data in rows]
+
+    # --- 写 ---
+
+    def save(self, name: str, doc: dict):
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            meta = {k: v for k, v in doc.items() if k not in _LIST_TABLES and k != "timeline"}
+            row = db.execute("SELECT rev FROM saves WHERE name = ?", (name,)).fetchone()
+            rev = (row[0] if row else 0) + 1
+            db.execute("INSERT OR REPLACE INTO saves (name, rev, updated_at, meta) VALUES (?, ?, ?, ?)",
+                       (name, rev, time.time(), _dumps(meta)))
+            for key, (table, cols, extract) in _LIST_TABLES.items():
+                self._sync_rows(db, name, table, cols, extract, doc.get(key, []) or [])
+            self._sync_turns(db, name, doc.get("timeline", []) or [])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            self.invalidate(name)
+            raise
+        self._remember(name, rev, doc)
+
+    def _sync_rows(self, db, name, table, cols, extract, items):
+        old = dict(db.execute(f"SELECT idx, digest FROM {table} WHERE save = ?", (name,)).fetchall())
+        placeholders = ", ".join("?" * (len(cols) + 4))
+        for idx, item in enumerate(items):
+            data = _dumps(item)
+            digest = _digest(data)
+            if old.get(idx) != digest:
+                db.execute(f"INSERT OR REPLACE INTO {table} (save, idx, {', '.join(cols)}, digest, data) "
+                           f"VALUES ({placeholders})", (name, idx, *extract(item), digest, data))
+        db.execute(f"DELETE FROM {table} WHERE save = ? AND idx >= ?", (name, len(items)))
+
+    def _sync_turns(self, db, name, timeline):
+        old = dict(db.execute("SELECT idx, digest FROM turns WHERE save = ?", (name,)).fetchall())
+        for t_idx, turn in enumerate(timeline):
+            digest = _digest(_dumps(turn))
+            if old.get(t_idx) == digest:
+                continue
+            # 回合有变化：整回合 (含事件与影响) 重写，其余回合不动
+            db.execute("DELETE FROM events WHERE save = ? AND turn_idx = ?", (name, t_idx))
+            db.execute("DELETE FROM impacts WHERE save = ? AND turn_idx = ?", (name, t_idx))
+            head = {k: v for k, v in turn.items() if k != "events"}
+            db.execute("INSERT OR REPLACE INTO turns (save, idx, id, time_range, digest, data) VALUES (?, ?, ?, ?, ?, ?)",
+                       (name, t_idx, turn.get("id"), turn.get("timeRange"), digest, _dumps(head)))
+            for e_idx, event in enumerate(turn.get("events", []) or []):
+                body = {k: v for k, v in event.items() if k != "impacts"}
+                db.execute("INSERT INTO events (save, turn_idx, idx, faction_id, summary, data) VALUES (?, ?, ?, ?, ?, ?)",
+                           (name, t_idx, e_idx, event.get("factionId"), event.get("summary"), _dumps(body)))
+                db.executemany(
+                    "INSERT INTO impacts (save, turn_idx, event_idx, idx, target_id, attr_key, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(name, t_idx, e_idx, i_idx, imp.get("targetId"), imp.get("attrKey"), _dumps(imp))
+                     for i_idx, imp in enumerate(event.get("impacts", []) or [])])
+        n = len(timeline)
+        for table in ("turns", "events"):
+            col = "idx" if table == "turns" else "turn_idx"
+            db.execute(f"DELETE FROM {table} WHERE save = ? AND {col} >= ?", (name, n))
+        db.execute("DELETE FROM impacts WHERE save = ? AND turn_idx >= ?", (name, n))
+
+    def delete(self, name: str) -> bool:
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            found = db.execute("DELETE FROM saves WHERE name = ?", (name,)).rowcount > 0
+            for table in ("factions", "rule_sets", "lore_entries", "turns", "events", "impacts"):
+                db.execute(f"DELETE FROM {table} WHERE save = ?", (name,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        self.invalidate(name)
+        return found
+
+
+# --- 分支存档 (写时复制) ---
+# 分支存档只保存自己的部分：{"branch": {"parent", "turns": 继承的回合数, "keys": 继承的顶层字段}, 其余字段, "timeline": 分叉后的回合}
+# 读档时从父存档补齐继承的部分；父存档修改了被继承的回合/字段时，先把旧内容复制到子分支再落盘。
+
+BRANCH_KEY = "branch"  # 分支存档记录父存档与继承范围的字段 (服务端维护)
+
+
+def _touched(ops: List[Dict[str, Any]]):
+    """补丁涉及的 (顶层字段集合, 最小回合下标)；整体替换 timeline 或根节点时回合下标为 0"""
+    keys, first_turn = set(), None
+    for op in ops:
+        for path in (op.get("path"), op.get("from")):
+            if path is None:
+                continue
+            tokens = [t.replace("~1", "/").replace("~0", "~") for t in path.split("/")[1:]]
+            if not tokens:
+                return None, 0  # 根节点被替换
+            if tokens[0] != "timeline":
+                keys.add(tokens[0])
+                continue
+            idx = 0
+            if len(tokens) > 1:
+                idx = int(tokens[1]) if tokens[1].isdigit() else None  # "-" 表示追加，不影响已有回合
+            if idx is not None:
+                first_turn = idx if first_turn is None else min(first_turn, idx)
+    return keys, first_turn
+
+
+def _common_prefix(a: list, b: list, limit: int) -> int:
+    n = min(len(a), len(b), limit)
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class BranchStorage(SaveStorage):
+    """包装任意后端，增加写时复制的分支存档；非分支存档原样透传"""
+
+    def __init__(self, inner: SaveStorage, index_path: str, cache_size: int = 4, durable: bool = True):
+        self.inner = inner
+        self.name = inner.name
+        self.index_path = index_path
+        self.cache_size = cache_size
+        self.durable = durable
+        self._index: Optional[Dict[str, dict]] = None  # 子存档名 -> {"parent", "turns", "keys"}
+        self._index_stamp = None  # 索引文件的 (mtime, size, inode)，其他进程改写后重新读取
+        self._index_lock = FileLock(index_path + ".lock")
+        self._resolved: "OrderedDict[str, tuple]" = OrderedDict()  # 子存档名 -> (stamp, 完整文档)
+        self._cache_lock = threading.Lock()  # 只保护 _resolved 字典本身
+        self._prepared: Dict[str, tuple] = {}  # 存档名 -> (已保护的字段, 已保护的起始回合, 当时的子分支)
+
+    # --- 分支索引 ---
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _branches(self) -> Dict[str, dict]:
+        stamp = self._file_stamp()
+        if self._index is None or stamp != self._index_stamp:
+            if stamp is None or not self._read_index():
+                with self._index_lock:
+                    self._refresh()
+        return self._index
+
+    def _read_index(self) -> bool:
+        try:
+            stamp = self._file_stamp()
+            with open(self.index_path, "rb") as f:
+                index = _loads(f.read())
+        except (OSError, ValueError):
+            return False
+        self._index, self._index_stamp = index, stamp
+        return True
+
+    def _refresh(self):
+        """持有索引锁时调用：索引文件被其他进程改过就重新读取，丢失或损坏时重建"""
+        if self._index is not None and self._file_stamp() == self._index_stamp:
+            return
+        if not self._read_index():
+            self._rebuild_index()
+
+    def _rebuild_index(self):
+        # 索引丢失：扫描一遍存档重建
+        index = {}
+        for name in self.inner.list_saves():
+            try:
+                info = self.inner.load(name).get(BRANCH_KEY)
+            except Exception:
+                continue
+            if isinstance(info, dict) and info.get("parent"):
+                index[name] = info
+        self._index = index
+        self._write_index()
+
+    def _write_index(self):
+        atomic_write(self.index_path, _dumps(self._index).encode("utf-8"), durable=self.durable)
+        self._index_stamp = self._file_stamp()
+
+    def _set_branch(self, name: str, info: Optional[dict]):
+        """
+        改一条索引：多个进程共用同一个索引文件，先在锁内重新读取，避免覆盖别人的改动。
+        改的是副本再整体替换，其他线程正在遍历的旧字典不受影响。
+        """
+        with self._index_lock:
+            self._refresh()
+            index = dict(self._index)
+            if info is None:
+                index.pop(name, None)
+            else:
+                index[name] = info
+            self._index = index
+            self._write_index()
+
+    def lock_name(self, name: str) -> str:
+        # 父存档的修改会写时复制到子分支，分支的读取也依赖父存档：同一分支族共用根存档的锁
+        seen = set()
+        info = self.branch_info(name)
+        while info is not None and name not in seen:
+            seen.add(name)
+            name = info["parent"]
+            info = self.branch_info(name)
+        return name
+
+    def branch_info(self, name: str) -> Optional[dict]:
+        return self._branches().get(name)
+
+    def children(self, name: str) -> List[str]:
+        return sorted(c for c, info in self._branches().items() if info.get("parent") == name)
+
+    # --- 读 ---
+
+    def list_saves(self) -> List[str]:
+        return self.inner.list_saves()
+
+    def exists(self, name: str) -> bool:
+        return self.inner.exists(name)
+
+    def stamp(self, name: str) -> Optional[list]:
+        return self.inner.stamp(name)
+
+    def stat(self, name: str) -> Dict[str, Any]:
+        return self.inner.stat(name)
+
+    def blob_refs_text(self):
+        return self.inner.blob_refs_text()
+
+    def load(self, name: str) -> dict:
+        info = self.branch_info(name)
+        if info is None:
+            return self.inner.load(name)
+        stamp = self._chain_stamp(name)
+        with self._cache_lock:
+            cached = self._resolved.get(name)
+            if cached and cached[0] == stamp:
+                self._resolved.move_to_end(name)
+                return cached[1]
+
+        own = self.inner.load(name)
+        parent = self.load(info["parent"])
+        doc = {k: v for k, v in own.items() if k not in info["keys"] and k not in ("timeline", BRANCH_KEY)}
+        for key in info["keys"]:
+            if key in parent:
+                doc[key] = copy.deepcopy(parent[key])
+        doc["timeline"] = copy.deepcopy(parent.get("timeline", [])[:info["turns"]]) + own.get("timeline", [])
+        doc[BRANCH_KEY] = dict(info)
+        self._remember(name, doc, stamp)
+        return doc
+
+    def _chain_stamp(self, name: str) -> list:
+        # 自身及各级父存档的 stamp：父存档被外部改动 (如手工替换文件) 时也能发现
+        stamps, seen = [], set()
+        while name is not None and name not in seen:
+            seen.add(name)
+            stamps.append(self.inner.stamp(name))
+            info = self.branch_info(name)
+            name = info["parent"] if info else None
+        return stamps
+
+    def _remember(self, name: str, doc: dict, stamp: Optional[list] = None):
+        stamp = stamp or self._chain_stamp(name)
+        with self._cache_lock:
+            self._resolved[name] = (stamp, doc)
+            self._resolved.move_to_end(name)
+            while len(self._resolved) > self.cache_size:
+                self._resolved.popitem(last=False)
+
+    def _forget(self, name: str):
+        with self._cache_lock:
+            return self._resolved.pop(name, None)
+
+    def _load_fresh(self, name: str) -> dict:
+        """绕过缓存重新读档 (缓存中的文档可能已被就地修改)"""
+        self.invalidate(name)
+        return self.load(name)
+
+    def invalidate(self, name: str):
+        self.inner.invalidate(name)
+        self._forget(name)
+        self._prepared.pop(name, None)
+
+    def find_impacts(self, name: str, target_id: str) -> List[dict]:
+        if self.branch_info(name) is None:
+            return self.inner.find_impacts(name, target_id)
+        return super().find_impacts(name, target_id)
+
+    # --- 写 ---
+
+    def create_branch(self, parent: str, name: str, turns: int) -> dict:
+        """O(1) 建分支：继承父存档前 turns 个回合和全部其他字段，自身什么都不存"""
+        doc = self.load(parent)
+        turns = max(0, min(turns, len(doc.get("timeline", []))))
+        keys = sorted(k for k in doc if k not in ("timeline", BRANCH_KEY))
+        info = {"parent": parent, "turns": turns, "keys": keys}
+        self._store(name, info, {})
+        return info
+
+    def _store(self, name: str, info: dict, own: dict):
+        """把分支自身的部分落盘并更新索引"""
+        own = dict(own)
+        own[BRANCH_KEY] = info
+        self.inner.save(name, own)
+        self._set_branch(name, info)
+
+    def _own_part(self, doc: dict, info: dict) -> dict:
+        own = {k: v for k, v in doc.items() if k not in info["keys"] and k not in ("timeline", BRANCH_KEY)}
+        own["timeline"] = doc.get("timeline", [])[info["turns"]:]
+        return own
+
+    def save(self, name: str, doc: dict):
+        if self.children(name) and self.exists(name):
+            old = self.load(name)
+            self._protect_children(name, old if old is not doc else self._load_fresh(name), doc=doc)
+
+        info = self.branch_info(name)
+        if info is None:
+            doc.pop(BRANCH_KEY, None)
+            self.inner.save(name, doc)
+            return
+        # 全量保存：与父存档重新比对，仍然相同的回合/字段继续共享
+        parent = self.load(info["parent"])
+        info = {
+            "parent": info["parent"],
+            "turns": _common_prefix(doc.get("timeline", []), parent.get("timeline", []), info["turns"]),
+            # 所有与父存档相同的字段都共享 (包括之前因写时复制而分开、后来又变得相同的，例如两边都迁移过)
+            "keys": sorted(k for k in doc if k not in ("timeline", BRANCH_KEY) and k in parent and doc[k] == parent[k]),
+        }
+        self._store(name, info, self._own_part(doc, info))
+        doc[BRANCH_KEY] = dict(info)
+        self._remember(name, doc)
+
+    def commit_patch(self, name: str, doc: dict, ops: List[Dict[str, Any]]) -> int:
+        keys, first_turn = _touched(ops)
+        prepared = self._prepared.pop(name, None)
+        if self.children(name) and not self._covers(prepared, name, keys, first_turn):
+            # 没有事先 prepare_patch：缓存中的文档已经应用了补丁，旧内容只能从存储重新读取 (整份解析)
+            self._protect_children(name, self._load_fresh(name), keys=keys, first_turn=first_turn)
+
+        info = self.branch_info(name)
+        if info is None:
+            return self.inner.commit_patch(name, doc, ops)
+        turns = info["turns"] if first_turn is None else min(info["turns"], first_turn)
+        info = {"parent": info["parent"], "turns": turns,
+                "keys": [] if keys is None else [k for k in info["keys"] if k not in keys]}
+        self._store(name, info, self._own_part(doc, info))
+        doc[BRANCH_KEY] = dict(info)
+        self._remember(name, doc)
+        return 0
+
+    def prepare_patch(self, name: str, doc: dict, ops: List[Dict[str, Any]], extra_keys: Iterable[str] = ()):
+        # 趁 doc 还是旧内容，先把子分支会受影响的继承部分复制过去；commit_patch 时就不必重新读档
+        keys, first_turn = _touched(ops)
+        if keys is not None:
+            keys |= set(extra_keys)
+        children = tuple(self.children(name))
+        if children:
+            self._protect_children(name, doc, keys=keys, first_turn=first_turn)
+        self._prepared[name] = (keys, first_turn, children)
+
+    def _covers(self, prepared: Optional[tuple], name: str, keys: Optional[set], first_turn: Optional[int]) -> bool:
+        """prepare_patch 时保护过的范围是否覆盖这次实际提交的修改 (其间子分支没有变化)"""
+        if prepared is None:
+            return False
+        p_keys, p_turn, children = prepared
+        if children != tuple(self.children(name)):
+            return False
+        if p_keys is not None and (keys is None or not keys <= p_keys):
+            return False
+        return first_turn is None or (p_turn is not None and p_turn <= first_turn)
+
+    def _protect_children(self, name: str, old: dict, doc: Optional[dict] = None,
+                          keys: Optional[set] = None, first_turn: Optional[int] = 0):
+        """
+        写时复制：name 即将被修改 (新内容为 doc，或补丁涉及 keys/first_turn)，
+        子分支继承的部分如果会变，先把旧内容复制进子分支。
+        """
+        old_timeline = old.get("timeline", [])
+        for child in self.children(name):
+            info = self.branch_info(child)
+            if not self.inner.exists(child):
+                self._set_branch(child, None)
+                continue
+            if doc is not None:
+                turns = _common_prefix(old_timeline, doc.get("timeline", []), info["turns"])
+                changed = {k for k in info["keys"] if (k in old) != (k in doc) or old.get(k) != doc.get(k)}
+            else:
+                turns = info["turns"] if first_turn is None else min(info["turns"], first_turn)
+                changed = set(info["keys"]) if keys is None else set(info["keys"]) & keys
+            if turns == info["turns"] and not changed:
+                continue
+            self._materialize(child, info, old, turns, changed)
+
+    def _materialize(self, child: str, info: dict, parent_doc: dict, turns: int, keys):
+        own = self.inner.load(child)
+        own = {k: v for k, v in own.items() if k != BRANCH_KEY}
+        for key in keys:
+            if key in parent_doc:
+                own[key] = copy.deepcopy(parent_doc[key])
+        own["timeline"] = (copy.deepcopy(parent_doc.get("timeline", [])[turns:info["turns"]])
+                           + own.get("timeline", []))
+        new_info = {"parent": info["parent"], "turns": turns, "keys": [k for k in info["keys"] if k not in keys]}
+        with self._cache_lock:
+            cached = self._resolved.get(child)
+        self._store(child, new_info, own)
+        if cached is not None:
+            # 子分支的完整内容没变，只是存储形式变了：保留同一个文档对象
+            cached[1][BRANCH_KEY] = dict(new_info)
+            self._remember(child, cached[1])
+
+    def delete(self, name: str) -> bool:
+        # 父存档没了：子分支补齐继承的内容，成为独立存档
+        for child in self.children(name):
+            if self.inner.exists(child):
+                doc = copy.deepcopy(self.load(child))
+                doc.pop(BRANCH_KEY, None)
+                self.inner.save(child, doc)
+            self._set_branch(child, None)
+            self._forget(child)
+        if name in self._branches():
+            self._set_branch(name, None)
+        self._forget(name)
+        return self.inner.delete(name)
+
+
+# --- 导入/导出工具 ---
+
+def _branch_storage(db_path: str) -> BranchStorage:
+    # 与 server.py 的 create_storage 相同：分支索引放在数据库同目录下，按后端命名
+    store = SqliteStorage(db_path)
+    return BranchStorage(store, os.path.join(os.path.dirname(db_path) or ".", f"branches.{store.name}.idx"))
+
+
+def import_json_saves(db_path: str, files: List[str]) -> int:
+    # 快照 + 增量日志的展开逻辑在 server.py (JsonFileStorage)，导入时复用，日志里的修改不会丢
+    from server import load_state_document
+
+    store = _branch_storage(db_path)
+    branches = {}
+    count = 0
+    for path in files:
+        name = os.path.basename(path)
+        doc = copy.deepcopy(load_state_document(path))
+        info = doc.get(BRANCH_KEY)
+        if isinstance(info, dict) and info.get("parent"):
+            branches[name] = doc  # 分支只存了自身的部分，等父存档导入后再登记
+            continue
+        store.save(name, doc)
+        count += 1
+        print(f"imported {path}")
+
+    # 分支按父子顺序导入：保留 "自身部分 + 分支信息"，继承的回合/字段照旧与父存档共享
+    while branches:
+        ready = [n for n, doc in branches.items() if store.exists(doc[BRANCH_KEY]["parent"])]
+        if not ready:
+            break
+        for name in sorted(ready):
+            own = branches.pop(name)
+            info = own.pop(BRANCH_KEY)
+            store._store(name, info, own)
+            count += 1
+            print(f"imported {name} (branch of {info['parent']})")
+    for name, doc in sorted(branches.items()):
+        print(f"skipped {name}: parent save {doc[BRANCH_KEY]['parent']} is neither in the database nor imported")
+    return count
+
+
+def export_json_saves(db_path: str, out_dir: str, names: Optional[List[str]] = None) -> int:
+    store = _branch_storage(db_path)
+    os.makedirs(out_dir, exist_ok=True)
+    names = names or store.list_saves()
+    for name in names:
+        out = os.path.join(out_dir, name if name.endswith(".json") else name + ".json")
+        # 分支导出为完整的独立存档 (补齐继承的部分，去掉分支信息)
+        doc = dict(store.load(name))
+        doc.pop(BRANCH_KEY, None)
+        atomic_write(out, json.dumps(doc, ensure_ascii=False, indent=2).encode("utf-8"))
+        print(f"exported {name} -> {out}")
+    return len(names)
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 2 or argv[0] not in ("import", "export", "list"):
+        print(__doc__)
+        return 2
+    cmd, db_path, rest = argv[0], argv[1], argv[2:]
+    if cmd == "import":
+        files = [p for pattern in rest for p in (glob.glob(pattern) or [pattern])]
+        import_json_saves(db_path, files)
+    elif cmd == "export":
+        if not rest:
+            print(__doc__)
+            return 2
+        export_json_saves(db_path, rest[0], rest[1:])
+    else:
+        for name in SqliteStorage(db_path).list_saves():
+            print(name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
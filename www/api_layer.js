@@ -53,6 +53,34 @@ const Utils = {
             }
         });
         return { textPart, mediaParts };
+    },
+
+    // [新增] 计算 JSON-Patch 差异 (RFC 6902 子集)，用于增量存档
+    // 数组只比较公共前缀，多出的元素 add，少掉的元素从尾部 remove
+    diffJson(oldVal, newVal, path = '', ops = []) {
+        if (oldVal === newVal) return ops;
+        const isObj = v => v !== null && typeof v === 'object';
+        if (!isObj(oldVal) || !isObj(newVal) || Array.isArray(oldVal) !== Array.isArray(newVal)) {
+            ops.push({ op: 'replace', path: path, value: newVal });
+            return ops;
+        }
+        const esc = k => String(k).replace(/~/g, '~0').replace(/\//g, '~1');
+        if (Array.isArray(newVal)) {
+            const common = Math.min(oldVal.length, newVal.length);
+            for (let i = 0; i < common; i++) this.diffJson(oldVal[i], newVal[i], `${path}/${i}`, ops);
+            for (let i = oldVal.length - 1; i >= common; i--) ops.push({ op: 'remove', path: `${path}/${i}` });
+            for (let i = common; i < newVal.length; i++) ops.push({ op: 'add', path: `${path}/-`, value: newVal[i] });
+            return ops;
+        }
+        for (const k of Object.keys(oldVal)) {
+            if (!(k in newVal)) ops.push({ op: 'remove', path: `${path}/${esc(k)}` });
+        }
+        for (const k of Object.keys(newVal)) {
+            if (newVal[k] === undefined) continue;
+            if (!(k in oldVal)) ops.push({ op: 'add', path: `${path}/${esc(k)}`, value: newVal[k] });
+            else this.diffJson(oldVal[k], newVal[k], `${path}/${esc(k)}`, ops);
+        }
+        return ops;
     }
 };
 
@@ -141,6 +169,21 @@ const NativeAI = {
 
 // 4. 核心 API 适配层 (挂载到 window)
 window.LevantAPI = {
+    // [新增] 每个存档最后一次与后端同步的状态，用于计算增量
+    _lastSynced: {},
+    // [新增] 每个存档最后一次读到/写入的修订号 (ETag)，保存时通过 If-Match 带回，后端据此拒绝覆盖别人的改动
+    _etags: {},
+
+    _conditional(filename) {
+        const etag = this._etags[filename];
+        return etag ? { headers: { 'If-Match': etag } } : {};
+    },
+
+    _rememberEtag(filename, res) {
+        const etag = res && res.headers && res.headers.etag;
+        if (etag) this._etags[filename] = etag;
+    },
+
     // --- 内部辅助：动态加载 Capacitor Filesystem 插件 ---
     // 这是为了防止在没有安装插件的普通浏览器环境中报错
     async _getCapacitorFs() {
@@ -230,10 +273,11 @@ window.LevantAPI = {
     },
     
     // --- A. 存档系统 (使用真实文件系统) ---
-    async getSaves() {
+    // [新增] details=true 时桌面版额外返回 saves: [{name, turns, lastTimeRange, factions, size, mtime, thumbnail, ...}]
+    async getSaves(details = false) {
         // 1. 桌面模式
         if (!window.IS_NATIVE_APP) {
-            return (await axios.get(`${PYTHON_API_BASE}/api/saves`)).data;
+            return (await axios.get(`${PYTHON_API_BASE}/api/saves`, { params: details ? { details: true } : {} })).data;
         }
 
         // 2. 安卓模式：读取 Documents/saves 目录
@@ -268,7 +312,11 @@ window.LevantAPI = {
 
     async loadGame(filename) {
         if (!window.IS_NATIVE_APP) {
-            return (await axios.get(`${PYTHON_API_BASE}/api/state?filename=${filename}`)).data;
+            const res = await axios.get(`${PYTHON_API_BASE}/api/state?filename=${filename}`);
+            const data = res.data;
+            this._lastSynced[filename] = JSON.parse(JSON.stringify(data));
+            this._rememberEtag(filename, res);
+            return data;
         }
 
         const { Filesystem, Encoding } = await this._getCapacitorFs();
@@ -288,7 +336,34 @@ window.LevantAPI = {
 
     async saveGame(filename, data) {
         if (!window.IS_NATIVE_APP) {
-            return await axios.post(`${PYTHON_API_BASE}/api/state?filename=${filename}`, data);
+            // ★★★ [新增] 增量存档：只发送与上次同步的差异，失败时回退到全量保存 ★★★
+            const snapshot = JSON.parse(JSON.stringify(data));
+            const base = this._lastSynced[filename];
+            if (base) {
+                // 只比较界面提交的顶层字段：revision / schemaVersion / branch 等由服务端维护，界面状态里没有
+                const shared = {};
+                for (const k of Object.keys(snapshot)) if (k in base) shared[k] = base[k];
+                const ops = Utils.diffJson(shared, snapshot);
+                try {
+                    const res = await axios.patch(`${PYTHON_API_BASE}/api/state?filename=${filename}`, { ops: ops }, this._conditional(filename));
+                    this._lastSynced[filename] = snapshot;
+                    this._rememberEtag(filename, res);
+                    return res;
+                } catch (e) {
+                    // 412：存档已被其他窗口/玩家修改，全量保存同样会被拒绝，交给界面提示重新读档
+                    if (e.response && e.response.status === 412) throw new Error(e.response.data.detail);
+                    console.warn("[Levant] Delta save rejected, falling back to full save:", e.message);
+                }
+            }
+            try {
+                const res = await axios.post(`${PYTHON_API_BASE}/api/state?filename=${filename}`, data, this._conditional(filename));
+                this._lastSynced[filename] = snapshot;
+                this._rememberEtag(filename, res);
+                return res;
+            } catch (e) {
+                if (e.response && e.response.status === 412) throw new Error(e.response.data.detail);
+                throw e;
+            }
         }
 
         const { Filesystem, Encoding } = await this._getCapacitorFs();
@@ -319,6 +394,8 @@ window.LevantAPI = {
 
     async deleteSave(filename) {
         if (!window.IS_NATIVE_APP) {
+            delete this._lastSynced[filename];
+            delete this._etags[filename];
             return await axios.delete(`${PYTHON_API_BASE}/api/saves/${filename}`);
         }
 
@@ -332,6 +409,126 @@ window.LevantAPI = {
         return { status: "deleted" };
     },
 
+    // [新增] 分支存档 (仅桌面版)：从第 turn 个回合分叉出新存档，未改动的回合与资源和父存档共享
+    async branchSave(filename, name, turn = null) {
+        if (window.IS_NATIVE_APP) throw new Error("Branching is only supported on desktop");
+        const params = turn === null ? { name } : { name, turn };
+        return (await axios.post(`${PYTHON_API_BASE}/api/saves/${filename}/branch`, null, { params })).data;
+    },
+
+    // [新增] 地图区块查询 (仅桌面版，服务端用游程编码遮罩 + R 树计算)，坐标为底图百分比
+    async getRegionsAt(filename, x, y) {
+        return (await axios.get(`${PYTHON_API_BASE}/api/map/regions/at`, { params: { filename, x, y } })).data;
+    },
+
+    async getRegions(filename, owner = null) {
+        const params = owner === null ? { filename } : { filename, owner };
+        return (await axios.get(`${PYTHON_API_BASE}/api/map/regions`, { params })).data;
+    },
+
+    async getRegionNeighbors(filename, regionId) {
+        return (await axios.get(`${PYTHON_API_BASE}/api/map/regions/${encodeURIComponent(regionId)}/neighbors`,
+            { params: { filename } })).data;
+    },
+
+    // [新增] 比较两个存档/分支：共同回合数、各自分叉后的回合、势力属性与全局变量差异
+    async diffSaves(a, b) {
+        if (window.IS_NATIVE_APP) throw new Error("Save diff is only supported on desktop");
+        return (await axios.get(`${PYTHON_API_BASE}/api/saves/diff`, { params: { a, b } })).data;
+    },
+
+    // [新增] 把后端 blob 引用 (/api/blobs/<sha256>.<ext>) 还原成 data URL，用于导出
+    async inlineBlobs(obj) {
+        if (Array.isArray(obj)) {
+            for (let i = 0; i < obj.length; i++) obj[i] = await this.inlineBlobs(obj[i]);
+            return obj;
+        }
+        if (obj !== null && typeof obj === 'object') {
+            for (const k of Object.keys(obj)) obj[k] = await this.inlineBlobs(obj[k]);
+            return obj;
+        }
+        if (typeof obj === 'string' && obj.startsWith('/api/blobs/')) {
+            const blob = (await axios.get(`${PYTHON_API_BASE}${obj}`, { responseType: 'blob' })).data;
+            return await new Promise((resolve, reject) => {
+                const reader = new FileReader();
+                reader.onload = () => resolve(reader.result);
+                reader.onerror = reject;
+                reader.readAsDataURL(blob);
+            });
+        }
+        return obj;
+    },
+
+    // [新增] 只读取存档的部分顶层字段，如 loadStateFields(f, ['players', 'global_vars'])
+    async loadStateFields(filename, fields) {
+        if (window.IS_NATIVE_APP) {
+            const data = await this.loadGame(filename);
+            return Object.fromEntries(fields.filter(k => k in data).map(k => [k, data[k]]));
+        }
+        const url = `${PYTHON_API_BASE}/api/state?filename=${encodeURIComponent(filename)}&fields=${encodeURIComponent(fields.join(','))}`;
+        return (await axios.get(url)).data;
+    },
+
+    // [新增] 分页读取回合，offset 省略时返回最近的 limit 个回合；返回 { total, offset, limit, items }
+    async loadTimelinePage(filename, { offset = null, limit = 20, summary = false } = {}) {
+        const params = new URLSearchParams({ filename, limit, summary });
+        if (offset !== null) params.set('offset', offset);
+        return (await axios.get(`${PYTHON_API_BASE}/api/state/timeline?${params}`)).data;
+    },
+
+    // [新增] 分页读取地图图层；includeData=false 时只返回图层列表
+    async loadMapLayers(filename, { offset = 0, limit = 20, ids = [], includeData = true } = {}) {
+        const params = new URLSearchParams({ filename, offset, limit, ids: ids.join(','), include_data: includeData });
+        return (await axios.get(`${PYTHON_API_BASE}/api/state/layers?${params}`)).data;
+    },
+
+    // [新增] 服务端全量重算公式，返回 { ops, formulas, cycles, errors }，ops 为需要应用到本地状态的 JSON-Patch
+    async recalculateFormulas(filename) {
+        if (window.IS_NATIVE_APP) return null;
+        return (await axios.post(`${PYTHON_API_BASE}/api/formulas/recalculate?filename=${encodeURIComponent(filename)}`)).data;
+    },
+
+    // [新增] 上传文档到后端文档库 (原始字节，无需 Base64)，返回 { id, status, ... }
+    // 原生 App 模式没有后端，返回 null，由调用方回退到内联附件
+    async uploadDocument(file) {
+        if (window.IS_NATIVE_APP) return null;
+        const type = file.type || 'application/octet-stream';
+        const url = `${PYTHON_API_BASE}/api/documents?name=${encodeURIComponent(file.name)}&type=${encodeURIComponent(type)}`;
+        return (await axios.post(url, file, { headers: { 'Content-Type': 'application/octet-stream' } })).data;
+    },
+
+    // [新增] 后端资料库关键词索引匹配，返回命中条目下标的 Set；
+    // 条目较少、原生模式或后端存档与本地不一致时返回 null，由调用方本地扫描
+    // 资料库 (keys, mode) 的 32 位 FNV-1a 摘要 (按 UTF-16 码元)，与 lore_index.signature_digest 一致
+    loreDigest(lorebook) {
+        let h = 0x811c9dc5;
+        for (const e of lorebook) {
+            const s = `${e.keys || ''}\u0001${e.mode || 'auto'}\u0000`;
+            for (let i = 0; i < s.length; i++) h = Math.imul(h ^ s.charCodeAt(i), 0x01000193) >>> 0;
+        }
+        return h.toString(16).padStart(8, '0');
+    },
+
+    async matchLore(filename, text, lorebook) {
+        if (window.IS_NATIVE_APP || !filename || lorebook.length < 200) return null;
+        try {
+            const data = (await axios.post(`${PYTHON_API_BASE}/api/lore/match`, { filename, text })).data;
+            if (data.count !== lorebook.length) return null;
+            // 本地改过关键词/模式但还没存盘时，服务端索引是旧的：摘要对不上就本地扫描
+            if (data.digest !== this.loreDigest(lorebook)) return null;
+            return new Set(data.triggered);
+        } catch (e) {
+            console.warn("[Levant] Lore match failed, scanning locally:", e.message);
+            return null;
+        }
+    },
+
+    // [新增] 后端按 token 预算装配上下文，返回 { context, tokens, included, dropped, ... }
+    async assembleContext(filename, query, options = {}) {
+        if (window.IS_NATIVE_APP) return null;
+        return (await axios.post(`${PYTHON_API_BASE}/api/context/assemble`, { filename, query, ...options })).data;
+    },
+
     // --- B. AI 接口 ---
     async generateAI(req) {
         // 1. 桌面模式：依然优先走 Python (支持 PDF 解析和日志)
@@ -361,6 +558,85 @@ window.LevantAPI = {
             // OpenAI / DeepSeek / Compatible
             return await NativeAI.callOpenAICompatible(req, fullContext, mediaParts);
         }
+    },
+
+    // ★★★ [新增] 流式 AI 接口：onDelta(片段, 已累计全文) 实时回调，最终返回 { result } ★★★
+    async generateAIStream(req, onDelta) {
+        // 原生 App 模式没有 Python 后端，退化为一次性返回
+        if (window.IS_NATIVE_APP) {
+            const data = await this.generateAI(req);
+            if (onDelta) onDelta(data.result, data.result);
+            return data;
+        }
+
+        const response = await fetch(`${PYTHON_API_BASE}/api/ai/stream`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(req)
+        });
+        if (!response.ok) throw new Error(`Stream Error ${response.status}: ${await response.text()}`);
+
+        let fullText = "";
+        let final = null;
+        await this._readSSE(response, (event, payload) => {
+            if (event === 'error') throw new Error(payload.detail);
+            if (event === 'done') { final = { result: payload.result }; return; }
+            fullText += payload.delta;
+            if (onDelta) onDelta(payload.delta, fullText);
+        });
+        return final || { result: fullText };
+    },
+
+    // [新增] 批量推演：所有请求并发执行，每完成一个回调 onResult(index, data)
+    // 返回与 reqs 等长的数组，元素为 { result } 或 { error }
+    async generateAIBatch(reqs, onResult) {
+        const results = new Array(reqs.length).fill(null);
+        if (window.IS_NATIVE_APP) {
+            await Promise.all(reqs.map(async (req, i) => {
+                try { results[i] = await this.generateAI(req); }
+                catch (e) { results[i] = { error: e.message }; }
+                if (onResult) onResult(i, results[i]);
+            }));
+            return results;
+        }
+
+        const response = await fetch(`${PYTHON_API_BASE}/api/ai/batch`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ requests: reqs })
+        });
+        if (!response.ok) throw new Error(`Batch Error ${response.status}: ${await response.text()}`);
+        await this._readSSE(response, (event, payload) => {
+            if (event === 'result') results[payload.index] = { result: payload.result };
+            else if (event === 'failed') results[payload.index] = { error: payload.detail };
+            else return;
+            if (onResult) onResult(payload.index, results[payload.index]);
+        });
+        return results;
+    },
+
+    // SSE 解析：以空行分隔事件，逐个回调 onEvent(event, payload)
+    async _readSSE(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const raw = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let event = 'message', data = '';
+                raw.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (data) onEvent(event, JSON.parse(data));
+            }
+        }
     }
 };
 /* --- END OF FILE api_layer.js --- */
\ No newline at end of file